@@ -0,0 +1,298 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from collections import OrderedDict
+import numpy as np
+from fastconv.backends import flush_scope
+from inference_plan import PlanExecutor, trace_model
+
+
+# Prefix activation cache for per-layer flush sweeps. Evaluating a plan on a fixed input set can save the values that
+# cross chosen op boundaries ("checkpoints"), together with the flush count of the ops before them. A later plan whose
+# first j ops are identical (same kinds, parameters incl. flush levels, pre-flushed constants and wiring) on the same
+# inputs resumes from the longest such checkpoint, so changing the flush level of layer k only recomputes the suffix
+# of the network from layer k on. Checkpoints are kept in memory up to memory_bytes and optionally spilled to a
+# directory up to disk_bytes, both evicting the least recently used entries. With a directory, new checkpoints are
+# written batch by batch into memory-mapped files, otherwise they are filled in memory; checkpoints that do not fit
+# the budget of where they are filled (together with the ones before them) are not taken.
+
+
+def _digest(x):
+    return hashlib.sha1(np.ascontiguousarray(x, dtype="float32")).hexdigest()
+
+
+def prefix_keys(plan, x_digest):
+    # keys[j] identifies the values after ops[:j] of plan run on the inputs with digest x_digest
+    producers = {plan.storage(plan.input_name): -1}
+    h = hashlib.sha1(x_digest.encode())
+    keys = [h.hexdigest()]
+    for i, op in enumerate(plan.ops):
+        desc = [op.kind, sorted(op.params.items()), [producers[plan.storage(n)] for n in op.inputs],
+                [(k, a.shape) for k, a in sorted(op.arrays.items())]]
+        h.update(json.dumps(desc, default=str).encode())
+        for k, a in sorted(op.arrays.items()):
+            h.update(np.ascontiguousarray(a))
+        producers[plan.storage(op.output)] = i
+        keys.append(h.hexdigest())
+    return keys
+
+
+def layer_ops(plan, model):
+    # index of the first op of each emulated layer of the keras model the plan was traced from
+    from cifar10models import flush_layers
+    first = {}
+    for i, op in enumerate(plan.ops):
+        first.setdefault(op.name, i)
+    return [first[layer.name] for layer in flush_layers(model) if layer.name in first]
+
+
+class ActivationCache:
+
+    def __init__(self, memory_bytes=2 << 30, directory=None, disk_bytes=20 << 30):
+        self.memory_bytes = memory_bytes
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()  # key -> (values in boundary order, prefix flush count), oldest first
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _size(self, entry):
+        return sum(v.nbytes for v in entry[0])
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > 1 and sum(self._size(e) for e in self.entries.values()) > self.memory_bytes:
+            self.entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.directory is None or not os.path.isdir(self._path(key)):
+            return None
+        path = self._path(key)
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        values = [np.load(os.path.join(path, "%d.npy" % i), mmap_mode="r") for i in range(meta["values"])]
+        os.utime(path)
+        entry = (values, meta["flushes"])
+        self._remember(key, entry)
+        return entry
+
+    def _tmp(self, key):
+        tmp = "%s.%d.tmp" % (self._path(key), os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        return tmp
+
+    def _commit(self, key, tmp, count, flushes):
+        # move the value files of a finished checkpoint from tmp into place
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"values": count, "flushes": flushes}, f)
+        try:
+            os.rename(tmp, self._path(key))
+        except OSError:
+            shutil.rmtree(tmp)  # another process stored it first
+        self._evict_disk()
+
+    def put(self, key, values, flushes):
+        entry = (values, flushes)
+        if self.directory is not None and not os.path.isdir(self._path(key)):
+            tmp = self._tmp(key)
+            for i, v in enumerate(values):
+                np.save(os.path.join(tmp, "%d.npy" % i), v)
+            self._commit(key, tmp, len(values), flushes)
+        self._remember(key, entry)
+
+    def _budget_cuts(self, plan, n, cuts):
+        # the cuts whose values fit the budget together with the ones taken before them
+        budget = self.disk_bytes if self.directory is not None else self.memory_bytes
+        taken = []
+        for c in cuts:
+            size = 4 * n * sum(int(np.prod(plan.shapes[name])) for name in plan.boundary(0, c)[1])
+            if size <= budget:
+                taken.append(c)
+                budget -= size
+        return taken
+
+    def _checkpoint_arrays(self, plan, key, c, n):
+        # (arrays the values crossing cut c are saved into, tmp directory or None)
+        shapes = [(n,) + tuple(plan.shapes[name]) for name in plan.boundary(0, c)[1]]
+        if self.directory is None:
+            return [np.empty(shape, dtype="float32") for shape in shapes], None
+        tmp = self._tmp(key)
+        return [np.lib.format.open_memmap(os.path.join(tmp, "%d.npy" % i), mode="w+", dtype="float32", shape=shape)
+                for i, shape in enumerate(shapes)], tmp
+
+    def _evict_disk(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if key.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.disk_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def predict(self, plan, x, batch_size=50, checkpoints=()):
+        # (outputs, flush count) of plan on x, checkpoints: op indices after which to cache the crossing values
+        n = len(x)
+        keys = prefix_keys(plan, _digest(x))
+        start = 0
+        live = None
+        flushes = 0
+        for j in range(len(plan.ops), 0, -1):
+            entry = self.get(keys[j])
+            if entry is not None:
+                start = j
+                live = dict(zip(plan.boundary(0, j)[1], entry[0]))
+                flushes = entry[1]
+                break
+        if start:
+            self.hits += 1
+        else:
+            self.misses += 1
+            live = {plan.storage(plan.input_name): x}
+        cuts = sorted({c for c in checkpoints if start < c < len(plan.ops) and self.get(keys[c]) is None})
+        cuts = self._budget_cuts(plan, n, cuts)
+        segments = list(zip([start] + cuts, cuts + [len(plan.ops)]))
+        saved, tmps = {}, {}
+        for c in cuts:
+            saved[c], tmps[c] = self._checkpoint_arrays(plan, keys[c], c, n)
+        saved_flushes = dict.fromkeys(cuts, flushes)
+        out_name = plan.storage(plan.output_name)
+        result = np.empty((n,) + tuple(plan.shapes[out_name]), dtype="float32")
+        executors = {}
+        total = flushes
+        for i in range(0, n, batch_size):
+            size = min(batch_size, n - i)
+            values = {name: v[i:i + size] for name, v in live.items()}
+            for first, last in segments:
+                if (first, size) not in executors:
+                    executors[(first, size)] = PlanExecutor(plan, size, first, last)
+                ex = executors[(first, size)]
+                for name in plan.boundary(first, last)[0]:
+                    np.copyto(ex.values[name], values[name])
+                with flush_scope() as counter:
+                    ex.execute()
+                count = counter.get()
+                total += count
+                for c in saved_flushes:
+                    if last <= c:
+                        saved_flushes[c] += count
+                needed = plan.boundary(0, last)[1]
+                values = {name: ex.values[name] if name in ex.values else values[name] for name in needed}
+                if last in saved:
+                    for name, v in zip(needed, saved[last]):
+                        v[i:i + size] = values[name]
+            result[i:i + size] = values[out_name]
+        for c in cuts:
+            if tmps[c] is None:
+                self.put(keys[c], saved[c], saved_flushes[c])
+            else:
+                for v in saved[c]:
+                    v.flush()
+                del saved[c]
+                self._commit(keys[c], tmps[c], len(plan.boundary(0, c)[1]), saved_flushes[c])
+        return result, total
+
+
+def layer_sweep(modtype, level, base=0, layers=None, n=10000, batch_size=50, cache=None):
+    # accuracy and flush count with emulated layer k at flush level `level` and all others at `base`, for each k in
+    # layers (default: all). The base configuration is evaluated first with a checkpoint before every layer, each
+    # variant then only runs the ops from its changed layer on.
+    # returns [(layer index, layer name, accuracy, flushes)], the base result has layer index None
+    import cifar10cache
+    from cifar10models import build_model, flush_layers, set_flush
+    cache = cache if cache is not None else ActivationCache()
+    x = cifar10cache.normalized("test")[:n]
+    y = cifar10cache.labels("test")[:n].reshape(-1)
+    model = build_model(modtype, load=True, flush=base)
+    names = [layer.name for layer in flush_layers(model.model)]
+    layers = range(len(names)) if layers is None else layers
+
+    plan = trace_model(model.model)
+    starts = layer_ops(plan, model.model)
+    logits, flushes = cache.predict(plan, x, batch_size, checkpoints=starts)
+    results = [(None, None, float(np.mean(np.argmax(logits, 1) == y)), flushes)]
+    for k in layers:
+        levels = [base] * len(names)
+        levels[k] = level
+        set_flush(model.model, levels)
+        logits, flushes = cache.predict(trace_model(model.model), x, batch_size)
+        results.append((k, names[k], float(np.mean(np.argmax(logits, 1) == y)), flushes))
+    return results
+
+
+def budget_check(modtype="alexnet", n=20, batch_size=10):
+    # checkpoints before every layer under a budget of half their total size: the ones taken have to fit it, both in
+    # memory and on disk, where they must not be allocated in memory; results must not change
+    import inspect
+    import tempfile
+    import tracemalloc
+    import cifar10cache
+    from cifar10models import build_model
+    x = np.asarray(cifar10cache.normalized("test")[:n])
+    model = build_model(modtype, load=True, flush=120)
+    plan = trace_model(model.model)
+    starts = layer_ops(plan, model.model)
+    reference = ActivationCache(0).predict(plan, x, batch_size)
+    sizes = [4 * n * sum(int(np.prod(plan.shapes[name])) for name in plan.boundary(0, c)[1]) for c in starts if c > 0]
+    budget = sum(sizes) // 2
+    source, first = inspect.getsourcelines(ActivationCache._checkpoint_arrays)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        for cache in [ActivationCache(budget), ActivationCache(0, directory, budget)]:
+            tracemalloc.start()
+            logits, flushes = cache.predict(plan, x, batch_size, checkpoints=starts)
+            # memory still held by checkpoint arrays (memory-mapped files are not traced)
+            held = sum(s.size for s in tracemalloc.take_snapshot().statistics("lineno")
+                       if s.traceback[0].filename == __file__ and first <= s.traceback[0].lineno < first + len(source))
+            tracemalloc.stop()
+            if cache.directory is None:
+                used = sum(cache._size(e) for e in cache.entries.values())
+                ok &= held <= budget
+            else:
+                used = sum(os.path.getsize(os.path.join(root, f)) - 128 for root, _, files in os.walk(directory)
+                           for f in files if f.endswith(".npy"))  # without the .npy headers
+                ok &= held < min(sizes)
+            ok &= 0 < used <= budget and np.array_equal(logits, reference[0]) and flushes == reference[1]
+            print("%-6s budget %d used %d held in memory %d" % ("disk" if cache.directory else "memory", budget, used,
+                                                                held))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtype", default="resnet")
+    parser.add_argument("--level", type=int, default=113, help="flush level applied to one layer at a time")
+    parser.add_argument("--base", type=int, default=0, help="flush level of all other layers")
+    parser.add_argument("--n", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--cache-dir", help="keep checkpoints on disk as well, shared between runs")
+    parser.add_argument("--memory-gb", type=float, default=2)
+    parser.add_argument("--check-budget", action="store_true", help="check that checkpoints respect the budgets")
+    args = parser.parse_args()
+
+    if args.check_budget:
+        ok = budget_check()
+        print("budget ok" if ok else "budget EXCEEDED")
+        exit(0 if ok else 1)
+
+    cache = ActivationCache(int(args.memory_gb * (1 << 30)), args.cache_dir)
+    for k, name, acc, flushes in layer_sweep(args.modtype, args.level, args.base, n=args.n,
+                                             batch_size=args.batch_size, cache=cache):
+        print("base" if k is None else "%d %s" % (k, name), acc, flushes)
@@ -0,0 +1,129 @@
+import sys
+import numpy as np
+from fastconv import backends
+from fastconv.backends import PROFILE_KINDS, PROFILE_BINS, PROFILE_WEIGHTS
+
+
+# Conformance suite for the fastconv backends: every available backend has to reproduce the numpy reference backend
+# bit for bit, with the same flush counts and exponent profiles. Inputs are scaled so that many products and partial
+# sums fall below the flush thresholds.
+
+FLUSHES = [0, 113, 120]
+
+
+def _inputs(rng, shape, scale):
+    # zeros of both signs, fz turns -0 into +0 like any other flushed value
+    x = (rng.normal(size=shape) * scale).astype("float32")
+    x[rng.random(shape) < 0.05] = 0
+    x[rng.random(shape) < 0.05] = -0.0
+    return x
+
+
+def _shift_add(backend, prod, n, h_p, w_p, kh, kw, flush, profile=None, filter_blocks=None):
+    result = np.empty((prod.shape[0] // (kh * kw), prod.shape[1]), dtype="float32")
+    backend.kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, profile, filter_blocks=filter_blocks)
+    return result
+
+
+KERNELS = {
+    "fz_arr": lambda backend: backend.fz_arr,
+    "tiled_matmul": lambda backend: backend.tiled_matmul,
+    "kn2row_shift_add": lambda backend: lambda *args, **kwargs: _shift_add(backend, *args, **kwargs),
+    "kn2row": lambda backend: backend.kn2row,
+    "gemv": lambda backend: backend.gemv,
+    "direct_conv": lambda backend: backend.direct_conv,
+    "channel_affine": lambda backend: backend.channel_affine,
+    "elem_add": lambda backend: backend.elem_add,
+    # max_pool does no arithmetic, so there is nothing to profile
+    "max_pool": lambda backend: lambda *args, profile=None, **kwargs: backend.max_pool(*args, **kwargs),
+    "avg_pool": lambda backend: backend.avg_pool,
+}
+
+
+def _call(backend, fn, *args, **kwargs):
+    # (result, result without profiling, flush count, profile) of one kernel
+    profile = np.zeros((PROFILE_KINDS, PROFILE_BINS), dtype=np.uint64)
+    kernel = KERNELS[fn](backend)
+    backend.get_flush_count(clear=True)
+    result = kernel(*args, profile=profile, **kwargs)
+    counted = backend.get_flush_count(clear=True)
+    plain = kernel(*args, **kwargs)
+    assert backend.get_flush_count(clear=True) == counted  # profiling must not change the counts
+    return np.array(result), np.array(plain), counted, profile
+
+
+def cases(rng):
+    # (description, kernel name, args, kwargs)
+    for flush in FLUSHES:
+        yield ("fz_arr flush %d" % flush, "fz_arr", (_inputs(rng, (3, 7, 9, 5), 1e-4), flush), {})
+        yield ("channel_affine flush %d" % flush, "channel_affine",
+               (_inputs(rng, (2, 5, 6, 7), 1e-2), _inputs(rng, (7,), 1e-2), _inputs(rng, (7,), 1e-4), flush), {})
+        yield ("elem_add flush %d" % flush, "elem_add",
+               (_inputs(rng, (2, 5, 6, 7), 1e-4), _inputs(rng, (2, 5, 6, 7), 1e-4), flush), {})
+        for pool, strides, mode in [((2, 2), None, "valid"), ((3, 3), (2, 2), "same"), ((3, 2), (1, 2), "valid"),
+                                    ((2, 2), (1, 1), "same")]:
+            for fn in ["max_pool", "avg_pool"]:
+                args = (_inputs(rng, (2, 7, 9, 5), 1e-4), pool, strides, mode) + ((flush,) if fn == "avg_pool" else ())
+                yield ("%s %s strides %s %s flush %d" % (fn, pool, strides, mode, flush), fn, args, {})
+        for rows, inner, cols in [(1, 1, 1), (5, 70, 3), (65, 129, 66), (130, 64, 20)]:
+            for split_k in [False, True]:
+                yield ("tiled_matmul %dx%dx%d flush %d split_k %s" % (rows, inner, cols, flush, split_k),
+                       "tiled_matmul", (_inputs(rng, (rows, inner), 1e-2), _inputs(rng, (inner, cols), 1e-2), flush),
+                       {"split_k": split_k})
+        for filter_blocks in [1, 3, 7, 8]:
+            yield ("kn2row_shift_add filter blocks %d flush %d" % (filter_blocks, flush), "kn2row_shift_add",
+                   (_inputs(rng, (3 * 3 * 7, 2 * 6 * 5), 1e-2), 2, 6, 5, 3, 3, flush), {"filter_blocks": filter_blocks})
+        for kh, kw in [(3, 3), (5, 3), (1, 1)]:
+            for strides in [(1, 1), (2, 2)]:
+                if kh == 1 and strides != (1, 1):
+                    continue
+                yield ("kn2row %dx%d strides %s flush %d" % (kh, kw, strides, flush), "kn2row",
+                       (_inputs(rng, (2, 9, 11, 6), 1e-2), _inputs(rng, (kh, kw, 6, 7), 1e-2), "same", strides,
+                        flush), {})
+                # the latency kernels have to match kn2row/tiled_matmul of the reference
+                for filter_block in [4, 16]:
+                    yield ("direct_conv %dx%d strides %s filter block %d flush %d" % (kh, kw, strides, filter_block,
+                                                                                     flush), "direct_conv",
+                           (_inputs(rng, (1, 9, 11, 70), 1e-2), _inputs(rng, (kh, kw, 70, 9), 1e-2), "same", strides,
+                            flush), {"filter_block": filter_block})
+        for rows, inner, cols in [(1, 1, 1), (1, 70, 3), (2, 129, 130)]:
+            yield ("gemv %dx%dx%d flush %d" % (rows, inner, cols, flush), "gemv",
+                   (_inputs(rng, (rows, inner), 1e-2), _inputs(rng, (inner, cols), 1e-2), flush), {})
+        # with the buffers a plan executor passes in
+        yield ("gemv with out and scratch flush %d" % flush, "gemv",
+               (_inputs(rng, (2, 129), 1e-2), _inputs(rng, (129, 70), 1e-2), flush),
+               {"out": np.empty((2, 70), dtype="float32"), "scratch": np.empty(70, dtype="float32")})
+        yield ("direct_conv with result and scratch flush %d" % flush, "direct_conv",
+               (_inputs(rng, (2, 9, 11, 70), 1e-2), _inputs(rng, (3, 3, 70, 9), 1e-2), "same", (1, 1), flush),
+               {"result": np.empty((2, 11 * 13, 9), dtype="float32"), "scratch": np.empty((2, 2, 9), dtype="float32")})
+
+
+def check(name, reference, seed=0):
+    # list of failed case descriptions
+    backend = backends.load(name)
+    failed = []
+    for desc, fn, args, kwargs in cases(np.random.default_rng(seed)):
+        r_res, r_plain, r_count, r_prof = _call(reference, fn, *args, **kwargs)
+        b_res, b_plain, b_count, b_prof = _call(backend, fn, *args, **kwargs)
+        # an empty result would compare equal to anything
+        ok = (r_res.size > 0 and r_res.shape == b_res.shape and
+              np.array_equal(r_res.view(np.uint32), b_res.view(np.uint32)) and
+              np.array_equal(b_res.view(np.uint32), b_plain.view(np.uint32)) and r_count == b_count)
+        # the reference profiles the padded input of kn2row the same way, so all histograms must match
+        ok = ok and np.array_equal(r_prof, b_prof)
+        if not ok:
+            failed.append(desc)
+    return failed
+
+
+if __name__ == '__main__':
+    reference = backends.load("numpy")
+    names = sys.argv[1:] or backends.available()
+    ok = True
+    for name in names:
+        failed = check(name, reference)
+        print(name, "ok" if not failed else "FAILED: " + ", ".join(failed))
+        ok = ok and not failed
+    for name in set(backends.BACKENDS) - set(backends.available()):
+        print(name, "not available")
+    exit(0 if ok else 1)
@@ -1,13 +1,14 @@
 from __future__ import print_function
 
-import keras.losses
 from keras.models import Sequential
 from keras.layers import Dense, Dropout, Activation, Flatten
-from keras.layers import MaxPooling2D, AveragePooling2D, BatchNormalization, RandomRotation, RandomFlip, RandomZoom, Input
+from keras.layers import RandomRotation, RandomFlip, RandomZoom, Input
 import numpy as np
-from keras import optimizers, callbacks
+from cifar10models import set_flush, load_weights, save_weights
 from myconv2d import MyConv2D
 from mydense import MyDense
+from mybatchnorm import MyBatchNormalization
+from mypooling import MyMaxPooling2D
 
 
 class cifar10alexnet:
@@ -16,11 +17,13 @@ class cifar10alexnet:
         self.x_shape = [32, 32, 3]
 
         self.orig = orig
-        self.flush = flush
+        # flush: one level for all emulated layers or a per-layer map, see cifar10models.set_flush
+        self.flush = flush if not isinstance(flush, (dict, list, tuple)) else 0
 
         self.model = self.build_model()
+        set_flush(self.model, flush)
         if load:
-            self.model.load_weights('cifar10alexnet.weights.h5')
+            load_weights(self.model, 'cifar10alexnet.weights.h5')
 
     def build_model(self):
         # Build modified AlexNet as seen on https://github.com/Natsu6767/Modified-AlexNet-Tensorflow
@@ -36,46 +39,49 @@ class cifar10alexnet:
         model.add(MyConv2D(96, (11, 11), strides=(2, 2), padding='same',
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         #model.add(Dropout(0.1))
 
-        model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), padding='same', use_original=self.orig,
+                                 denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(192, (5, 5), padding='same', use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         #model.add(Dropout(0.1))
 
-        model.add(MaxPooling2D(pool_size=(2, 2), padding='same'))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), padding='same', use_original=self.orig,
+                                 denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(384, (3, 3), padding='same', use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         #model.add(Dropout(0.1))
 
         model.add(MyConv2D(256, (3, 3), padding='same', use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         #model.add(Dropout(0.1))
 
         model.add(MyConv2D(256, (3, 3), padding='same', use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         # model.add(Dropout(0.1))
 
-        # model.add(AveragePooling2D(pool_size=(2, 2), padding='same'))
+        # model.add(MyAveragePooling2D(pool_size=(2, 2), padding='same', use_original=self.orig,
+        #                              denorm_flush_zero=self.flush))
 
         model.add(Flatten())
 
         model.add(Dropout(0.5))
         model.add(MyDense(4096, use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(Dropout(0.5))
         model.add(MyDense(1024, use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(MyDense(self.num_classes, use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('softmax'))
@@ -110,7 +116,9 @@ class cifar10alexnet:
             x = self.normalize_production(x)
         return self.model.predict(x, batch_size)
 
-    def train(self, x, y, xt, yt):
+    def train(self, x, y, xt, yt, normalized=False):
+        from keras import optimizers, callbacks
+
         # training parameters
         batch_size = 100
         maxepochs = 100
@@ -118,7 +126,8 @@ class cifar10alexnet:
         weight_decay = 5e-4
         lr_drop = 20
 
-        x, xt = self.normalize(x, xt)
+        if not normalized:
+            x, xt = self.normalize(x, xt)
 
         def lr_scheduler(epoch):
             return learning_rate * (0.5 ** (epoch // lr_drop))
@@ -133,4 +142,4 @@ class cifar10alexnet:
 
         historytemp = self.model.fit(x, y, batch_size=batch_size, epochs=maxepochs, validation_data=(xt, yt),
                                      callbacks=[reduce_lr], verbose=1)
-        self.model.save_weights('cifar10alexnet.weights.h5')
+        save_weights(self.model, 'cifar10alexnet.weights.h5')
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+
+
+# Normalised float32 CIFAR-10 tensors cached on disk as .npy files, keyed by the normalisation constants. They are
+# opened as read-only memmaps, so all processes on a host (sharded workers, sweep cells) share one copy in the page
+# cache instead of each decoding, casting and normalising the dataset into private memory. Files are written to a
+# temporary name and renamed, so concurrent first runs never see a partial file.
+
+CACHE_DIR = os.environ.get("CIFAR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nn-denorm"))
+
+# normalize_production constants of the models
+PRODUCTION_MEAN = 120.707
+PRODUCTION_STD = 64.15
+
+CHUNK = 1000  # samples normalised at a time while filling the cache
+
+
+def _path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def _key(mean, std):
+    return "%r-%r" % (float(mean), float(std))
+
+
+def _write(path, fill, shape, dtype):
+    # fill(out) writes the array contents into an open_memmap
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=shape)
+    fill(out)
+    out.flush()
+    del out
+    os.replace(tmp, path)
+
+
+def _raw():
+    from keras.datasets import cifar10
+    (x_train, y_train), (x_test, y_test) = cifar10.load_data()
+    return {"train": (x_train, y_train), "test": (x_test, y_test)}
+
+
+def labels(split):
+    path = _path("cifar10-%s-labels.npy" % split)
+    if not os.path.exists(path):
+        y = _raw()[split][1]
+        _write(path, lambda out: np.copyto(out, y), y.shape, y.dtype)
+    return np.load(path, mmap_mode="r")
+
+
+def training_constants():
+    # mean and std of the training set as computed by the models' normalize()
+    path = _path("cifar10-train-stats.npy")
+    if not os.path.exists(path):
+        x = _raw()["train"][0].astype("float32")
+        stats = np.array([np.mean(x, axis=(0, 1, 2, 3)), np.std(x, axis=(0, 1, 2, 3))], dtype="float32")
+        _write(path, lambda out: np.copyto(out, stats), stats.shape, stats.dtype)
+    mean, std = np.load(path)
+    return mean, std
+
+
+def normalized(split, mean=PRODUCTION_MEAN, std=PRODUCTION_STD):
+    # read-only float32 memmap of (x - mean) / (std + 1e-7), bit-identical to the models' normalisation
+    path = _path("cifar10-%s-%s.npy" % (split, _key(mean, std)))
+    if not os.path.exists(path):
+        x = _raw()[split][0]
+
+        def fill(out):
+            for i in range(0, len(x), CHUNK):
+                out[i:i + CHUNK] = (x[i:i + CHUNK].astype("float32") - mean) / (std + 1e-7)
+
+        _write(path, fill, x.shape, np.float32)
+    return np.load(path, mmap_mode="r")
+
+
+def batches(x, batch_size):
+    # zero-copy slices of a (memmapped) array
+    for i in range(0, len(x), batch_size):
+        yield x[i:i + batch_size]
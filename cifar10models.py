@@ -0,0 +1,73 @@
+import importlib
+from contextlib import contextmanager
+from flush_levels import tag_model
+
+
+# Model builders by name, each architecture module (and with it tensorflow) is only imported once it is requested.
+
+MODELS = {
+    "vgg": ("cifar10vgg", "cifar10vgg"),
+    "alexnet": ("cifar10alexnet", "cifar10alexnet"),
+    "resnet": ("cifar10resnet", "cifar10resnet"),
+}
+
+
+def model_class(modtype):
+    module, cls = MODELS[modtype]
+    return getattr(importlib.import_module(module), cls)
+
+
+@contextmanager
+def checkpoint_names():
+    # weight files address layers by their snake-cased class name, the checkpoints store the emulated batch
+    # normalization as the stock layer, so the name is switched while weights are loaded or saved
+    from mybatchnorm import MyBatchNormalization
+    MyBatchNormalization.__name__ = "BatchNormalization"
+    try:
+        yield
+    finally:
+        MyBatchNormalization.__name__ = "MyBatchNormalization"
+
+
+def load_weights(model, path):
+    with checkpoint_names():
+        model.load_weights(path)
+
+
+def save_weights(model, path):
+    with checkpoint_names():
+        model.save_weights(path)
+
+
+def build_model(modtype, load=True, orig=False, flush=0):
+    return model_class(modtype)(load=load, orig=orig, flush=flush)
+
+
+def flush_layers(model):
+    # emulated layers of a built keras model in order, their positions index per-layer flush maps
+    return [layer for layer in model.layers if hasattr(layer, "orig") and hasattr(layer, "flush")]
+
+
+def set_flush(model, flush):
+    # flush: one level for every emulated layer, a list with one level per emulated layer, or a dict of layer index
+    # or layer name -> level where unlisted layers run unflushed
+    layers = flush_layers(model)
+    if isinstance(flush, (list, tuple)):
+        if len(flush) != len(layers):
+            raise ValueError("flush map has %d levels for %d emulated layers" % (len(flush), len(layers)))
+        levels = list(flush)
+    elif isinstance(flush, dict):
+        names = {layer.name: i for i, layer in enumerate(layers)}
+        levels = [0] * len(layers)
+        for key, level in flush.items():
+            if isinstance(key, str):
+                if key not in names:
+                    raise ValueError("no emulated layer named " + key)
+                key = names[key]
+            levels[key] = level
+    else:
+        levels = [flush] * len(layers)
+    for layer, level in zip(layers, levels):
+        layer.flush = int(level)
+    # the flushed levels of the layer inputs depend on the levels of the layers before
+    tag_model(model)
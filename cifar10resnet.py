@@ -1,11 +1,16 @@
 from __future__ import print_function
 
-from keras.layers import Dense, Dropout, Activation, Flatten, Add, Rescaling
-from keras.layers import MaxPooling2D, BatchNormalization, RandomRotation, RandomFlip, RandomZoom, Input
+from keras.layers import Dense, Dropout, Activation, Flatten
+from keras.layers import RandomRotation, RandomFlip, RandomZoom, Input
 import numpy as np
-from keras import optimizers, callbacks, Model
+from keras import Model
+from cifar10models import set_flush, load_weights, save_weights
 from myconv2d import MyConv2D
 from mydense import MyDense
+from mybatchnorm import MyBatchNormalization
+from mypooling import MyMaxPooling2D
+from mymerge import MyAdd
+from myrescaling import MyRescaling
 
 
 class cifar10resnet:
@@ -14,11 +19,13 @@ class cifar10resnet:
         self.x_shape = [32, 32, 3]
 
         self.orig = orig
-        self.flush = flush
+        # flush: one level for all emulated layers or a per-layer map, see cifar10models.set_flush
+        self.flush = flush if not isinstance(flush, (dict, list, tuple)) else 0
 
         self.model = self.build_model()
+        set_flush(self.model, flush)
         if load:
-            self.model.load_weights('cifar10resnet.weights.h5')
+            load_weights(self.model, 'cifar10resnet.weights.h5')
 
     def build_model(self):
         # Build ResNet as described in https://myrtle.ai/learn/how-to-train-your-resnet-4-architecture/
@@ -26,14 +33,14 @@ class cifar10resnet:
         def base_conv(p, channels):
             p_i = MyConv2D(channels, (3, 3), padding='same', use_original=self.orig,
                            denorm_flush_zero=self.flush)(p)
-            p_i = BatchNormalization()(p_i)
+            p_i = MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush)(p_i)
             p_i = Activation('relu')(p_i)
             return p_i
 
         def res(p, channels):
             p_i = base_conv(p, channels)
             p_i = base_conv(p_i, channels)
-            p_i = Add()([p, p_i])
+            p_i = MyAdd(use_original=self.orig, denorm_flush_zero=self.flush)([p, p_i])
             return p_i
 
         inputs = Input(self.x_shape)
@@ -45,20 +52,20 @@ class cifar10resnet:
         x = base_conv(x, 64)  # prep
 
         x = base_conv(x, 128)  # layer 1
-        x = MaxPooling2D(pool_size=(2, 2))(x)
+        x = MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush)(x)
         x = res(x, 128)
 
         x = base_conv(x, 256)  # layer 2
-        x = MaxPooling2D(pool_size=(2, 2))(x)
+        x = MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush)(x)
 
         x = base_conv(x, 512)  # layer 3
-        x = MaxPooling2D(pool_size=(2, 2))(x)
+        x = MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush)(x)
         x = res(x, 512)
 
-        x = MaxPooling2D(pool_size=(2, 2))(x)  # classifier
+        x = MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush)(x)  # classifier
         x = Flatten()(x)
         x = MyDense(self.num_classes, use_original=self.orig, denorm_flush_zero=self.flush)(x)
-        x = Rescaling(.125)(x)
+        x = MyRescaling(.125, use_original=self.orig, denorm_flush_zero=self.flush)(x)
         x = Activation('softmax')(x)
 
         model = Model(inputs=inputs, outputs=x)
@@ -93,7 +100,9 @@ class cifar10resnet:
             x = self.normalize_production(x)
         return self.model.predict(x, batch_size)
 
-    def train(self, x, y, xt, yt):
+    def train(self, x, y, xt, yt, normalized=False):
+        from keras import optimizers, callbacks
+
         # training parameters
         batch_size = 512
         maxepochs = 20
@@ -101,7 +110,8 @@ class cifar10resnet:
         learning_rate = 0.4
         weight_decay = 5e-4
 
-        x, xt = self.normalize(x, xt)
+        if not normalized:
+            x, xt = self.normalize(x, xt)
 
         def lr_scheduler(epoch):
             if epoch < lr_max_epoch:
@@ -119,4 +129,4 @@ class cifar10resnet:
 
         historytemp = self.model.fit(x, y, batch_size=batch_size, epochs=maxepochs, validation_data=(xt, yt),
                                      callbacks=[reduce_lr], verbose=1)
-        self.model.save_weights('cifar10resnet.weights.h5')
+        save_weights(self.model, 'cifar10resnet.weights.h5')
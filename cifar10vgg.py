@@ -1,12 +1,15 @@
 from __future__ import print_function
 from keras.models import Sequential
 from keras.layers import Dropout, Activation, Flatten
-from keras.layers import MaxPooling2D, BatchNormalization, RandomRotation, RandomFlip, RandomZoom, Input
+from keras.layers import RandomRotation, RandomFlip, RandomZoom, Input
 import numpy as np
-from keras import regularizers, optimizers, callbacks
+from keras import regularizers
 
+from cifar10models import set_flush, load_weights, save_weights
 from myconv2d import MyConv2D
 from mydense import MyDense
+from mybatchnorm import MyBatchNormalization
+from mypooling import MyMaxPooling2D
 
 
 # Adapted from https://github.com/geifmany/cifar-vgg
@@ -17,11 +20,13 @@ class cifar10vgg:
         self.x_shape = [32, 32, 3]
 
         self.orig = orig
-        self.flush = flush
+        # flush: one level for all emulated layers or a per-layer map, see cifar10models.set_flush
+        self.flush = flush if not isinstance(flush, (dict, list, tuple)) else 0
 
         self.model = self.build_model()
+        set_flush(self.model, flush)
         if load:
-            self.model.load_weights('cifar10vgg.h5')
+            load_weights(self.model, 'cifar10vgg.h5')
 
     def build_model(self):
         # Build the network of vgg for 10 classes with massive dropout and weight decay as described in the paper.
@@ -38,92 +43,92 @@ class cifar10vgg:
         model.add(MyConv2D(64, (3, 3), padding='same', kernel_regularizer=regularizers.l2(weight_decay),
                            input_shape=self.x_shape, use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.3))
 
         model.add(MyConv2D(64, (3, 3), padding='same', kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
-        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(128, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(128, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
-        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(256, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(256, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(256, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
-        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
-        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.4))
 
         model.add(MyConv2D(512, (3, 3), padding='same',kernel_regularizer=regularizers.l2(weight_decay),
                            use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
-        model.add(MaxPooling2D(pool_size=(2, 2)))
+        model.add(MyMaxPooling2D(pool_size=(2, 2), use_original=self.orig, denorm_flush_zero=self.flush))
         model.add(Dropout(0.5))
 
         model.add(Flatten())
         model.add(MyDense(512, kernel_regularizer=regularizers.l2(weight_decay), use_original=self.orig,
                           denorm_flush_zero=self.flush))
         model.add(Activation('relu'))
-        model.add(BatchNormalization())
+        model.add(MyBatchNormalization(use_original=self.orig, denorm_flush_zero=self.flush))
 
         model.add(Dropout(0.5))
         model.add(MyDense(self.num_classes, use_original=self.orig, denorm_flush_zero=self.flush))
@@ -159,7 +164,9 @@ class cifar10vgg:
             x = self.normalize_production(x)
         return self.model.predict(x,batch_size)
 
-    def train(self, x, y, xt, yt):
+    def train(self, x, y, xt, yt, normalized=False):
+        from keras import optimizers, callbacks
+
         # training parameters
         batch_size = 100
         maxepochs = 50
@@ -167,7 +174,8 @@ class cifar10vgg:
         lr_decay = 1e-6
         lr_drop = 10
 
-        x, xt = self.normalize(x, xt)
+        if not normalized:
+            x, xt = self.normalize(x, xt)
 
         def lr_scheduler(epoch):
             return learning_rate * (0.5 ** (epoch // lr_drop))
@@ -182,4 +190,4 @@ class cifar10vgg:
 
         historytemp = self.model.fit(x, y, batch_size=batch_size, epochs=maxepochs, validation_data=(xt, yt),
                                      callbacks=[reduce_lr], verbose=1)
-        self.model.save_weights('cifar10vgg.weights.h5')
+        save_weights(self.model, 'cifar10vgg.weights.h5')
@@ -0,0 +1,112 @@
+import os
+import time
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+
+
+# Aggregate throughput of several flush configurations evaluated at the same time, either as python threads of one
+# process (sharing the normalised test set and the tensorflow runtime, each thread counting flushes in its own flush
+# scope) or as separate processes (each importing tensorflow and building its model). Every configuration's flush
+# count is checked against a sequential run of the same configuration. The OpenMP cores are split evenly between the
+# concurrent runs in both modes.
+
+
+def _predictor(model, use_plan, batch_size):
+    if use_plan:
+        from inference_plan import compile_plan
+        return compile_plan(model.model, batch_size).predict
+    return lambda x: np.asarray(model.model.predict_on_batch(x))
+
+
+def _evaluate(predict, x, batch_size, threads):
+    # (logits, flushes) counted in a scope of the calling thread
+    from fastconv.backends import set_num_threads
+    from fastconv.backends import flush_scope
+    set_num_threads(threads)
+    with flush_scope() as counter:
+        logits = np.concatenate([predict(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+    return logits, counter.get()
+
+
+def _process_worker(modtype, flush, n, batch_size, use_plan, threads, results):
+    import cifar10cache
+    from cifar10models import build_model
+    model = build_model(modtype, load=True, flush=flush)
+    x = cifar10cache.normalized("test")[:n]
+    results.put((flush,) + _evaluate(_predictor(model, use_plan, batch_size), x, batch_size, threads))
+
+
+def run_threads(modtype, flushes, n, batch_size=50, use_plan=False):
+    # (wall time, {flush: (logits, flush count)})
+    import cifar10cache
+    from cifar10models import build_model
+    from fastconv.backends import get_max_threads
+    threads = max(1, get_max_threads() // len(flushes))
+    start = time.perf_counter()
+    x = np.asarray(cifar10cache.normalized("test")[:n])
+    predictors = {flush: _predictor(build_model(modtype, load=True, flush=flush), use_plan, batch_size)
+                  for flush in flushes}
+    results = {}
+
+    def work(flush):
+        results[flush] = _evaluate(predictors[flush], x, batch_size, threads)
+
+    workers = [threading.Thread(target=work, args=(flush,)) for flush in flushes]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, results
+
+
+def run_processes(modtype, flushes, n, batch_size=50, use_plan=False):
+    # (wall time, {flush: (logits, flush count)}), process start-up included
+    ctx = multiprocessing.get_context("spawn")
+    threads = max(1, (os.cpu_count() or 1) // len(flushes))
+    queue = ctx.Queue()
+    start = time.perf_counter()
+    workers = [ctx.Process(target=_process_worker, args=(modtype, flush, n, batch_size, use_plan, threads, queue))
+               for flush in flushes]
+    for p in workers:
+        p.start()
+    results = {}
+    for _ in workers:
+        flush, logits, count = queue.get()
+        results[flush] = (logits, count)
+    for p in workers:
+        p.join()
+    return time.perf_counter() - start, results
+
+
+def run_sequential(modtype, flushes, n, batch_size=50, use_plan=False):
+    import cifar10cache
+    from cifar10models import build_model
+    from fastconv.backends import get_max_threads
+    start = time.perf_counter()
+    x = np.asarray(cifar10cache.normalized("test")[:n])
+    results = {flush: _evaluate(_predictor(build_model(modtype, load=True, flush=flush), use_plan, batch_size), x,
+                                batch_size, get_max_threads())
+               for flush in flushes}
+    return time.perf_counter() - start, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtype", default="alexnet")
+    parser.add_argument("--flushes", default="0,113,120,125", help="flush levels evaluated concurrently")
+    parser.add_argument("--n", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--use-plan", action="store_true")
+    args = parser.parse_args()
+
+    flushes = [int(f) for f in args.flushes.split(",")]
+    base_time, reference = run_sequential(args.modtype, flushes, args.n, args.batch_size, args.use_plan)
+    for mode, run in [("threads", run_threads), ("processes", run_processes)]:
+        elapsed, results = run(args.modtype, flushes, args.n, args.batch_size, args.use_plan)
+        ok = all(results[f][1] == reference[f][1] and np.array_equal(results[f][0], reference[f][0])
+                 for f in flushes)
+        print("%-10s %7.1f s  %7.1f images/s  %s" % (mode, elapsed, len(flushes) * args.n / elapsed,
+                                                    "counts match" if ok else "MISMATCH"))
+    print("%-10s %7.1f s  %7.1f images/s" % ("sequential", base_time, len(flushes) * args.n / base_time))
@@ -47,6 +47,15 @@ def dense_count(bi, ni, nk):
     return count
 
 
+def affine_count(bi, ri, ci, ni):
+    # batch normalization / rescaling: one multiply and one add per element
+    return 2 * bi * ri * ci * ni
+
+
+def add_count(bi, ri, ci, ni):
+    return bi * ri * ci * ni
+
+
 modeltype = "resnet"
 count = 0
 flushcount = 18342683092
@@ -63,6 +72,13 @@ if modeltype == "alexnet":
         + dense_count(batchsize, 4096, 4096)
         + dense_count(batchsize, 4096, 1024)
         + dense_count(batchsize, 1024, 10)
+        + affine_count(batchsize, 16, 16, 96)
+        + affine_count(batchsize, 8, 8, 192)
+        + affine_count(batchsize, 4, 4, 384)
+        + affine_count(batchsize, 4, 4, 256)
+        + affine_count(batchsize, 4, 4, 256)
+        + affine_count(batchsize, 1, 1, 4096)
+        + affine_count(batchsize, 1, 1, 1024)
     )
 elif modeltype == "vgg":
     count = batchcount * (
@@ -81,6 +97,12 @@ elif modeltype == "vgg":
         + c2d_count(batchsize, 2, 2, 512, 3, 3, 512, "same", (1, 1))
         + dense_count(batchsize, 512, 512)
         + dense_count(batchsize, 512, 10)
+        + affine_count(batchsize, 32, 32, 64) * 2
+        + affine_count(batchsize, 16, 16, 128) * 2
+        + affine_count(batchsize, 8, 8, 256) * 3
+        + affine_count(batchsize, 4, 4, 512) * 3
+        + affine_count(batchsize, 2, 2, 512) * 3
+        + affine_count(batchsize, 1, 1, 512)
     )
 elif modeltype == "resnet":
     count = batchcount * (
@@ -93,6 +115,15 @@ elif modeltype == "resnet":
         + c2d_count(batchsize, 4, 4, 512, 3, 3, 512, "same", (1, 1))
         + c2d_count(batchsize, 4, 4, 512, 3, 3, 512, "same", (1, 1))
         + dense_count(batchsize, 2048, 10)
+        + affine_count(batchsize, 32, 32, 64)
+        + affine_count(batchsize, 32, 32, 128)
+        + affine_count(batchsize, 16, 16, 128) * 2
+        + affine_count(batchsize, 16, 16, 256)
+        + affine_count(batchsize, 8, 8, 512)
+        + affine_count(batchsize, 4, 4, 512) * 2
+        + add_count(batchsize, 16, 16, 128)
+        + add_count(batchsize, 4, 4, 512)
+        + affine_count(batchsize, 1, 1, 10)
     )
 else:
     exit(1)
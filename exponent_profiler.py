@@ -0,0 +1,114 @@
+import csv
+import threading
+import contextvars
+import numpy as np
+from fastconv.backends import backend, PROFILE_WEIGHTS, PROFILE_ACTIVATIONS, PROFILE_PRODUCTS, PROFILE_ACCUMULATORS, \
+    PROFILE_KINDS, PROFILE_BINS
+
+
+# Streaming per-layer histograms of float32 exponents. While a profiler is active, the emulated layers and plan ops
+# hand their layer's histogram to the fastconv kernels, which bin every value by its biased exponent at the flush
+# points themselves (weights and inputs in fz_arr, products and partial sums in the matmul/shift-add/affine/add/pool
+# loops), so a single inference pass yields the distributions needed to pick flush thresholds. The active profiler
+# belongs to the context it was entered in (like the flush scopes of fastconv/counters.py), threads started in a copy
+# of that context (e.g. pipeline stages) profile into it as well, other threads do not.
+
+KIND_NAMES = {
+    PROFILE_WEIGHTS: "weights",
+    PROFILE_ACTIVATIONS: "activations",
+    PROFILE_PRODUCTS: "products",
+    PROFILE_ACCUMULATORS: "accumulators",
+}
+ZERO_BIN = PROFILE_BINS - 1
+
+_active = contextvars.ContextVar("exponent_profiler", default=None)
+
+
+def layer_profile(name):
+    # histogram array of a layer if profiling, None otherwise
+    profiler = _active.get()
+    if profiler is None:
+        return None
+    return profiler.layer(name)
+
+
+def weight_profile(name, weight="kernel"):
+    # like layer_profile, but only the first time for each weight of a layer, weights are recorded once, not per batch
+    profiler = _active.get()
+    if profiler is None:
+        return None
+    with profiler.lock:
+        if (name, weight) in profiler.weights_seen:
+            return None
+        profiler.weights_seen.add((name, weight))
+    return profiler.layer(name)
+
+
+def exponents():
+    # unbiased exponent of each non-zero bin, bin 0 (subnormals) is reported as -127
+    return np.arange(PROFILE_BINS - 1) - 127
+
+
+class ExponentProfiler:
+
+    def __init__(self):
+        self.layers = {}
+        self.weights_seen = set()
+        self.lock = threading.Lock()
+        self._tokens = []
+
+    def __enter__(self):
+        self._tokens.append(_active.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        _active.reset(self._tokens.pop())
+
+    def layer(self, name):
+        with self.lock:
+            if name not in self.layers:
+                self.layers[name] = np.zeros((PROFILE_KINDS, PROFILE_BINS), dtype=np.uint64)
+            return self.layers[name]
+
+    def record_weights(self, model):
+        # histogram all kernels and biases of a keras model without running it
+        for l in model.layers:
+            for weight in ("kernel", "bias"):
+                if getattr(l, weight, None) is not None and (l.name, weight) not in self.weights_seen:
+                    backend().fz_arr(np.ascontiguousarray(getattr(l, weight).numpy(), dtype="float32"), 0,
+                                     profile=self.layer(l.name), kind=PROFILE_WEIGHTS)
+                    self.weights_seen.add((l.name, weight))
+
+    def total(self, kind):
+        # histogram of one kind of value summed over all layers
+        total = np.zeros(PROFILE_BINS, dtype=np.uint64)
+        for h in self.layers.values():
+            total += h[kind]
+        return total
+
+    def fraction_below(self, level, kind, layer=None):
+        # fraction of the non-zero values with a biased exponent below level, i.e. the ones flushing at that level
+        h = self.total(kind) if layer is None else self.layers[layer][kind]
+        nonzero = h[:ZERO_BIN].sum()
+        return h[:level].sum() / nonzero if nonzero else 0.0
+
+    def to_csv(self, path):
+        with open(path, "w", newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(["layer", "kind", "biased_exponent", "exponent", "count"])
+            for name, h in self.layers.items():
+                for kind, kind_name in KIND_NAMES.items():
+                    for e in np.nonzero(h[kind][:ZERO_BIN])[0]:
+                        writer.writerow([name, kind_name, e, e - 127, h[kind][e]])
+                    if h[kind][ZERO_BIN]:
+                        writer.writerow([name, kind_name, "zero", "zero", h[kind][ZERO_BIN]])
+
+    def to_npz(self, path):
+        np.savez(path, **self.layers)
+
+    @staticmethod
+    def from_npz(path):
+        profiler = ExponentProfiler()
+        with np.load(path) as data:
+            profiler.layers = {name: data[name] for name in data.files}
+        return profiler
@@ -0,0 +1,107 @@
+import os
+import sys
+import logging
+import importlib
+from fastconv import counters
+from fastconv.counters import flush_scope, FlushCounter
+from fastconv.numpy_backend import PROFILE_WEIGHTS, PROFILE_ACTIVATIONS, PROFILE_PRODUCTS, PROFILE_ACCUMULATORS, \
+    PROFILE_KINDS, PROFILE_BINS
+
+
+# Registry of implementations of fz_arr/tiled_matmul/kn2row_shift_add/kn2row, their small-batch variants
+# gemv/direct_conv, the element-wise and pooling kernels channel_affine/elem_add/max_pool/avg_pool (plus
+# get_flush_count/add_flush_count/set_num_threads/get_max_threads).
+# All backends compute bit-identical results and flush counts, see backend_conformance.py. The backend is chosen
+# once: FASTCONV_BACKEND (or select(name)) picks one explicitly and fails if it cannot be loaded, otherwise the first
+# loadable one in PREFERENCE is used, with a warning for every backend that was skipped.
+
+log = logging.getLogger("fastconv")
+
+BACKENDS = {
+    "cython": "fastconv.fastconv",
+    "numba": "fastconv.numba_backend",
+    "numpy": "fastconv.numpy_backend",
+}
+PREFERENCE = ("cython", "numba", "numpy")
+
+SMALL_BATCH = 8  # largest batch size for the latency kernels, same results either way
+
+_selected = None
+_selected_name = None
+
+
+def load(name):
+    # the backend module, raises ImportError if it is not available here
+    if name not in BACKENDS:
+        raise ValueError("unknown fastconv backend %s, expected one of %s" % (name, ", ".join(BACKENDS)))
+    return importlib.import_module(BACKENDS[name])
+
+
+def available():
+    names = []
+    for name in BACKENDS:
+        try:
+            load(name)
+            names.append(name)
+        except ImportError:
+            pass
+    return names
+
+
+def select(name=None):
+    global _selected, _selected_name
+    name = name or os.environ.get("FASTCONV_BACKEND")
+    if name:
+        _selected = load(name)
+        _selected_name = name
+        log.info("fastconv backend: %s (requested)", name)
+        return _selected
+    for name in PREFERENCE:
+        try:
+            _selected = load(name)
+        except ImportError as e:
+            log.warning("fastconv backend %s is not available (%s)", name, e)
+            continue
+        _selected_name = name
+        log.info("fastconv backend: %s", name)
+        return _selected
+    raise ImportError("no fastconv backend is available")
+
+
+def backend():
+    if _selected is None:
+        select()
+    return _selected
+
+
+def backend_name():
+    backend()
+    return _selected_name
+
+
+def get_flush_count(clear=False):
+    # flushes counted by all backends that were used in this process (numba shares the numpy backend's counter),
+    # inside a flush scope only the scope's count
+    scope = counters.current()
+    if scope is not None:
+        return scope.get(clear)
+    functions = {sys.modules[module].get_flush_count for module in BACKENDS.values() if module in sys.modules}
+    return sum(function(clear) for function in functions)
+
+
+def add_flush_count(count):
+    backend().add_flush_count(count)
+
+
+def set_num_threads(n):
+    # kernel threads for calls from the current python thread
+    backend().set_num_threads(n)
+
+
+def get_max_threads():
+    return backend().get_max_threads()
+
+
+def small_batch(n):
+    # whether a batch of n samples runs the latency kernels gemv/direct_conv instead of tiled_matmul/kn2row
+    return n <= SMALL_BATCH
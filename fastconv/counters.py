@@ -0,0 +1,52 @@
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+# Per-context flush counting. Every kernel call adds its flushes to its backend's process-wide counter and to the
+# counters of all flush scopes open in the calling context. Python threads start with an empty context, so scopes
+# opened in different threads (e.g. one per model instance) never see each other's flushes, and get_flush_count /
+# get_flush_count(clear=True) inside a scope only read and reset that scope. Threads started on behalf of a scope
+# (e.g. pipeline stages) have to run in a copy of the starting thread's context to count into it.
+
+_scopes = contextvars.ContextVar("fastconv_flush_scopes", default=())
+
+
+class FlushCounter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def add(self, count):
+        with self._lock:
+            self._count += count
+
+    def get(self, clear=False):
+        with self._lock:
+            count = self._count
+            if clear:
+                self._count = 0
+        return count
+
+
+@contextmanager
+def flush_scope(counter=None):
+    # counts the flushes of all kernel calls made in this context until the scope is left, scopes can be nested
+    counter = counter if counter is not None else FlushCounter()
+    token = _scopes.set(_scopes.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _scopes.reset(token)
+
+
+def current():
+    # innermost open scope of this context, or None
+    scopes = _scopes.get()
+    return scopes[-1] if scopes else None
+
+
+def add(count):
+    for counter in _scopes.get():
+        counter.add(count)
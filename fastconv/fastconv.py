@@ -1,163 +1,93 @@
-import cython
-from cython.parallel import prange
-import numpy as np
-from cython.cimports.libc.stdlib import abs as cabs
-from cython.cimports.openmp import omp_get_thread_num
-
-
-flush_counts = cython.declare(cython.ulonglong[128], [0] * 128)
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-@cython.cfunc
-@cython.inline
-@cython.nogil
-def fz(x: cython.float, flush: cython.int) -> cython.float:
-    global flush_counts
-    if flush == 0:
-        return x
-    i: cython.int = cython.cast(cython.pointer(cython.int), cython.address(x))[0]
-    e: cython.int = (i & 0x7F800000) >> 23
-    if e < flush:
-        if (e > 0) or ((i & 0x007FFFFF) != 0):
-            tn: cython.int = omp_get_thread_num()
-            flush_counts[tn] += 1
-        return 0
-    else:
-        return x
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-def fz_arr(x: np.ndarray, flush: int) -> np.ndarray:
-    if flush == 0:
-        return x
-    shape = x.shape
-    _flush: cython.int = flush
-    _x: cython.float[:] = np.reshape(x, (-1))
-    _y: cython.float[:] = np.empty_like(_x)
-    _len: cython.Py_ssize_t = len(_x)
-    i: cython.Py_ssize_t
-    for i in prange(_len, nogil=True):
-        _y[i] = fz(_x[i], _flush)
-    return np.reshape(_y, shape)
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-def get_flush_count(clear=False):
-    global flush_counts
-    count = 0
-    for i in range(128):
-        count += flush_counts[i]
-    if clear:
-        for i in range(128):
-            flush_counts[i] = 0
-    return count
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-@cython.ccall
-def tiled_matmul(a, b, flush=0):
-    _a: cython.float[:, :] = a
-    _b: cython.float[:, :] = np.transpose(b)
-    _flush: cython.int = flush
-    incr: cython.Py_ssize_t = 64
-    rows: cython.Py_ssize_t = a.shape[0]
-    cols: cython.Py_ssize_t = b.shape[1]
-    inner: cython.Py_ssize_t = a.shape[1]
-    assert inner == b.shape[0]
-    res: cython.float[:, :] = np.zeros((rows, cols), dtype="float32")
-    i: cython.Py_ssize_t
-    j: cython.Py_ssize_t
-    km: cython.Py_ssize_t = (inner + incr - 1) // incr
-    k: cython.Py_ssize_t
-    _k: cython.Py_ssize_t
-    x: cython.Py_ssize_t
-    y: cython.Py_ssize_t
-    z: cython.Py_ssize_t
-    xm: cython.Py_ssize_t
-    ym: cython.Py_ssize_t
-    zm: cython.Py_ssize_t
-    s: cython.float
-
-    for i in prange(0, rows, incr, nogil=True):
-        xm = min(i + incr, rows)
-        for j in prange(0, cols, incr):
-            ym = min(j + incr, cols)
-            for _k in range(km):
-                k = _k * incr
-                zm = min(k + incr, inner)
-                for x in range(i, xm):
-                    for y in range(j, ym):
-                        s = 0
-                        for z in range(k, zm):
-                            s = fz(s + fz(_a[x, z] * _b[y, z], _flush), _flush)
-                        res[x, y] = fz(res[x, y] + s, _flush)
-    return res.base
-
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.nonecheck(False)
-def kn2row(inputs, kernel, mode="same", strides=(1, 1), flush=0):
-    # input: (n, h_i, w_i, c)
-    # kernel: (kh, kw, c, n_f)
-    # out: (n, h_o, w_o, n_f)
-    n, h_i, w_i, c = inputs.shape
-    kh, kw, _, n_f = kernel.shape
-    str_h, str_w = strides
-    pad_h = (kh - 1) // 2
-    pad_w = (kw - 1) // 2
-    if mode == "same":
-        in_padded = np.pad(inputs, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
-    else:
-        in_padded = inputs
-    _, h_p, w_p, _ = in_padded.shape
-    in_mat = in_padded.transpose((3, 0, 1, 2)).reshape((c, -1))  # c rows, n*h_i*w_i columns
-    kern_mat = kernel.transpose((0, 1, 3, 2)).reshape((-1, c))  # kh*kw*n_f rows, c columns
-    _flush: cython.int = flush
-    prod: cython.float[:, :] = tiled_matmul(kern_mat, in_mat, flush)
-    result: cython.float[:, :] = np.zeros((n_f, n * h_p * w_p), dtype='float32')
-    samp_width: cython.Py_ssize_t = h_p * w_p  # width of single sample of batch within product/result matrix row
-    _n: cython.Py_ssize_t = n
-    _kh: cython.Py_ssize_t = kh
-    _kw: cython.Py_ssize_t = kw
-    _w_p: cython.Py_ssize_t = w_p
-    _n_f: cython.Py_ssize_t = n_f
-    s: cython.Py_ssize_t
-    samp_off: cython.Py_ssize_t
-    y: cython.Py_ssize_t
-    y_off: cython.Py_ssize_t
-    x: cython.Py_ssize_t
-    total_off: cython.Py_ssize_t
-    prod_off: cython.Py_ssize_t
-    res_start: cython.Py_ssize_t
-    prod_start: cython.Py_ssize_t
-    si: cython.Py_ssize_t
-    fi: cython.Py_ssize_t
-    for s in prange(_n, nogil=True):  # samples need separate handling
-        samp_off = s * samp_width  # offset of sample within product+result matrices
-        for y in range(_kh):
-            y_off = (y - ((_kh - 1) // 2)) * _w_p  # partial offset of these mask pixels in product row
-            for x in range(_kw):
-                total_off = y_off + x - ((_kw - 1) // 2)  # total offset of this mask pixel in product row
-                prod_off = (y * _kw + x) * _n_f  # product offset in column
-                if total_off < 0:
-                    res_start = samp_off - total_off
-                    prod_start = samp_off
-                else:
-                    res_start = samp_off
-                    prod_start = samp_off + total_off
-                for fi in range(_n_f):
-                    for si in range(samp_width - cabs(total_off)):
-                        result[fi, res_start+si] = fz(result[fi, res_start+si] + prod[prod_off+fi, prod_start+si], _flush)
-    s_h = pad_h + 1 if str_h > 1 else pad_h
-    s_w = pad_w + 1 if str_w > 1 else pad_w
-    return np.array(result).reshape((n_f, n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:-pad_h:str_h, s_w:-pad_w:str_w, :]
+import os
+import importlib
+
+
+# Import-time dispatch between the kernel builds of setup.py: the best compiled variant of kernels.py that this CPU
+# supports is loaded and its functions are re-exported here, so callers keep importing from fastconv.fastconv.
+# FASTCONV_ISA=<variant> forces a variant. Build the variants with `python setup.py build_ext --inplace` in this folder.
+
+VARIANTS = ("avx512", "avx2", "generic")  # best first
+
+# cpu features (numpy's names) each variant is compiled for
+REQUIRED = {
+    "avx512": ("AVX512F", "AVX512CD", "AVX512BW", "AVX512DQ", "AVX512VL", "AVX2", "FMA3"),
+    "avx2": ("AVX2", "FMA3"),
+    "generic": (),
+}
+
+# /proc/cpuinfo flag names of the above, used if numpy does not expose its detection
+_CPUINFO_FLAGS = {"AVX512F": "avx512f", "AVX512CD": "avx512cd", "AVX512BW": "avx512bw", "AVX512DQ": "avx512dq",
+                  "AVX512VL": "avx512vl", "AVX2": "avx2", "FMA3": "fma"}
+
+
+def cpu_features():
+    # set of supported features, numpy's detection also checks that the OS enables the wider registers
+    try:
+        from numpy._core._multiarray_umath import __cpu_features__
+    except ImportError:
+        try:
+            from numpy.core._multiarray_umath import __cpu_features__
+        except ImportError:
+            __cpu_features__ = None
+    if __cpu_features__ is not None:
+        return {name for name, present in __cpu_features__.items() if present}
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = next((line.split(":", 1)[1].split() for line in f if line.startswith("flags")), [])
+    except OSError:
+        return set()
+    return {name for name, flag in _CPUINFO_FLAGS.items() if flag in flags}
+
+
+def supported_variants(features=None):
+    features = cpu_features() if features is None else features
+    return [v for v in VARIANTS if all(f in features for f in REQUIRED[v])]
+
+
+def _load(variant):
+    return importlib.import_module(__package__ + "._kernels_" + variant)
+
+
+def _select():
+    # (variant, module, [(variant, reason) for each variant that was skipped])
+    override = os.environ.get("FASTCONV_ISA")
+    if override:
+        if override not in VARIANTS:
+            raise ValueError("FASTCONV_ISA=%s, expected one of %s" % (override, ", ".join(VARIANTS)))
+        return override, _load(override), []
+    skipped = []
+    supported = supported_variants()
+    for variant in VARIANTS:
+        if variant not in supported:
+            skipped.append((variant, "not supported by this cpu"))
+            continue
+        try:
+            return variant, _load(variant), skipped
+        except ImportError:
+            skipped.append((variant, "not built"))
+    raise ImportError("no fastconv kernel variant is built for this cpu (%s)"
+                      % ", ".join("%s: %s" % s for s in skipped))
+
+
+# kernel API re-exported from the selected variant
+__all__ = ["fz_arr", "get_flush_count", "add_flush_count", "set_num_threads", "get_max_threads", "tiled_matmul",
+           "kn2row_shift_add", "kn2row", "gemv", "direct_conv", "channel_affine", "elem_add", "pool_geometry",
+           "max_pool", "avg_pool", "PROFILE_WEIGHTS", "PROFILE_ACTIVATIONS", "PROFILE_PRODUCTS",
+           "PROFILE_ACCUMULATORS", "PROFILE_KINDS", "PROFILE_BINS"]
+
+selected, _kernels, _skipped = _select()
+globals().update({name: getattr(_kernels, name) for name in __all__})
+
+
+def report():
+    lines = ["fastconv kernels: %s (%s)" % (selected, _kernels.__file__)]
+    if os.environ.get("FASTCONV_ISA"):
+        lines.append("  forced by FASTCONV_ISA")
+    lines.append("  cpu supports: %s" % ", ".join(supported_variants()))
+    for variant, reason in _skipped:
+        lines.append("  skipped %s: %s" % (variant, reason))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    print(report())
@@ -0,0 +1,827 @@
+import threading
+import cython
+from cython.parallel import prange
+import numpy as np
+from cython.cimports.libc.stdlib import abs as cabs
+from cython.cimports.libc.math import fabs
+from cython.cimports.openmp import omp_get_thread_num, omp_set_num_threads, omp_get_max_threads
+from fastconv import counters
+
+
+flush_counts = cython.declare(cython.ulonglong[128], [0] * 128)
+
+# exponent profiles: per layer a (PROFILE_KINDS, PROFILE_BINS) uint64 array, counting values by biased float32
+# exponent (bins 0-255), the last bin counts exact zeros
+PROFILE_WEIGHTS = 0
+PROFILE_ACTIVATIONS = 1
+PROFILE_PRODUCTS = 2
+PROFILE_ACCUMULATORS = 3
+PROFILE_KINDS = 4
+PROFILE_BINS = 257
+_hist_stride = cython.declare(cython.int, 4 * 257)  # PROFILE_KINDS * PROFILE_BINS, per thread
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cfunc
+@cython.inline
+@cython.nogil
+def fz(x: cython.float, flush: cython.int, counts: cython.p_ulonglong, hist: cython.p_ulonglong) -> cython.float:
+    # counts: per-call, per-thread flush counters, see _clear_counts/_commit_counts
+    # hist: NULL or per-call exponent histogram of this kind of value, see _new_hist/_commit_hist
+    if flush == 0 and hist == cython.NULL:
+        return x
+    i: cython.int = cython.cast(cython.pointer(cython.int), cython.address(x))[0]
+    e: cython.int = (i & 0x7F800000) >> 23
+    if hist != cython.NULL:
+        if (e > 0) or ((i & 0x007FFFFF) != 0):
+            hist[omp_get_thread_num() * _hist_stride + e] += 1
+        else:
+            hist[omp_get_thread_num() * _hist_stride + 256] += 1
+    if e < flush:
+        if (e > 0) or ((i & 0x007FFFFF) != 0):
+            tn: cython.int = omp_get_thread_num()
+            counts[tn] += 1
+        return 0
+    else:
+        return x
+
+
+# Kernels count flushes in a local per-thread array and add the total to flush_counts once the parallel section is
+# done (with the GIL held), so kernels running concurrently in different python threads, each with their own OpenMP
+# team, do not race on the shared counters. The total also goes to the flush scopes of the calling context, see
+# counters.py.
+@cython.cfunc
+@cython.inline
+def _clear_counts(counts: cython.p_ulonglong):
+    i: cython.int
+    for i in range(128):
+        counts[i] = 0
+
+
+@cython.cfunc
+def _commit_counts(counts: cython.p_ulonglong):
+    global flush_counts
+    i: cython.int
+    total: cython.ulonglong = 0
+    for i in range(128):
+        total += counts[i]
+    flush_counts[0] += total
+    if total:
+        counters.add(total)
+
+
+def _new_hist(profile):
+    # per-thread exponent histograms for one kernel call, or None when not profiling
+    if profile is None:
+        return None
+    assert profile.shape == (PROFILE_KINDS, PROFILE_BINS) and profile.dtype == np.uint64
+    return np.zeros((omp_get_max_threads(), PROFILE_KINDS, PROFILE_BINS), dtype=np.uint64)
+
+
+@cython.cfunc
+def _hist_ptr(hist, kind: cython.int) -> cython.p_ulonglong:
+    # pointer to the first thread's row for the given kind of value, NULL when not profiling
+    _hist: cython.ulonglong[:, :, ::1]
+    if hist is None:
+        return cython.NULL
+    _hist = hist
+    return cython.address(_hist[0, kind, 0])
+
+
+_hist_lock = threading.Lock()  # a layer's histogram may be committed to from several threads
+
+
+def _commit_hist(hist, profile):
+    if hist is not None:
+        with _hist_lock:
+            profile += hist.sum(axis=0, dtype=np.uint64)
+
+
+def set_num_threads(n):
+    # OpenMP team size for kernels called from the current python thread
+    omp_set_num_threads(n)
+
+
+def get_max_threads():
+    return omp_get_max_threads()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def fz_arr(x: np.ndarray, flush: int, out=None, profile=None, kind=PROFILE_ACTIVATIONS) -> np.ndarray:
+    # out: optional preallocated contiguous array of the same size, may be x itself
+    # profile: optional layer exponent profile, x is recorded as the given kind of value
+    if flush == 0 and profile is None:
+        if out is None:
+            return x
+        np.copyto(np.reshape(out, x.shape), x)
+        return out
+    shape = x.shape
+    _flush: cython.int = flush
+    _x: cython.const[cython.float][:] = np.reshape(x, (-1))
+    _y: cython.float[:] = np.empty(len(_x), dtype="float32") if out is None else np.reshape(out, (-1))
+    _len: cython.Py_ssize_t = len(_x)
+    assert _y.shape[0] == _len
+    i: cython.Py_ssize_t
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hp: cython.p_ulonglong = _hist_ptr(hist, kind)
+    for i in prange(_len, nogil=True):
+        _y[i] = fz(_x[i], _flush, cp, hp)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    if out is not None:
+        return out
+    return np.reshape(_y, shape)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def get_flush_count(clear=False):
+    # inside a flush scope only the scope's count
+    global flush_counts
+    scope = counters.current()
+    if scope is not None:
+        return scope.get(clear)
+    count = 0
+    for i in range(128):
+        count += flush_counts[i]
+    if clear:
+        for i in range(128):
+            flush_counts[i] = 0
+    return count
+
+
+def add_flush_count(count):
+    # account for flushes that were done ahead of time (e.g. on pre-flushed weights)
+    global flush_counts
+    flush_counts[0] += count
+    counters.add(count)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.ccall
+def tiled_matmul(a, b, flush=0, out=None, profile=None, split_k=None):
+    # out: optional preallocated (rows, cols) float32 array receiving the result
+    # profile: optional layer exponent profile recording products and partial sums
+    # split_k: also hand out the 64-wide blocks of the inner dimension to different threads, see _tiled_matmul_split_k.
+    #   None: only if there are fewer output tiles than threads (e.g. a small dense layer)
+    _a: cython.const[cython.float][:, :] = a
+    _b: cython.const[cython.float][:, :] = np.transpose(b)
+    _flush: cython.int = flush
+    incr: cython.Py_ssize_t = 64
+    rows: cython.Py_ssize_t = a.shape[0]
+    cols: cython.Py_ssize_t = b.shape[1]
+    inner: cython.Py_ssize_t = a.shape[1]
+    assert inner == b.shape[0]
+    if out is None:
+        out = np.zeros((rows, cols), dtype="float32")
+    else:
+        out.fill(0)
+    km: cython.Py_ssize_t = (inner + incr - 1) // incr
+    if split_k is None:
+        split_k = km > 1 and ((rows + incr - 1) // incr) * ((cols + incr - 1) // incr) < omp_get_max_threads()
+    if split_k:
+        return _tiled_matmul_split_k(_a, _b, out, _flush, profile)
+    res: cython.float[:, :] = out
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    k: cython.Py_ssize_t
+    _k: cython.Py_ssize_t
+    x: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    z: cython.Py_ssize_t
+    xm: cython.Py_ssize_t
+    ym: cython.Py_ssize_t
+    zm: cython.Py_ssize_t
+    s: cython.float
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+
+    for i in prange(0, rows, incr, nogil=True):
+        xm = min(i + incr, rows)
+        for j in prange(0, cols, incr):
+            ym = min(j + incr, cols)
+            for _k in range(km):
+                k = _k * incr
+                zm = min(k + incr, inner)
+                for x in range(i, xm):
+                    for y in range(j, ym):
+                        s = 0
+                        for z in range(k, zm):
+                            s = fz(s + fz(_a[x, z] * _b[y, z], _flush, cp, hpp), _flush, cp, hpa)
+                        res[x, y] = fz(res[x, y] + s, _flush, cp, hpa)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cfunc
+def _tiled_matmul_split_k(_a: cython.const[cython.float][:, :], _b: cython.const[cython.float][:, :], out,
+                          _flush: cython.int, profile):
+    # split-k variant of tiled_matmul: every (row tile, column tile, k-block) is a separate work item writing its
+    # flushed partial sums to its own slice of a buffer, afterwards each result element adds up its partial sums in
+    # k-block order. This is exactly the sequence of additions and flushes of the sequential kernel.
+    incr: cython.Py_ssize_t = 64
+    rows: cython.Py_ssize_t = _a.shape[0]
+    cols: cython.Py_ssize_t = _b.shape[0]
+    inner: cython.Py_ssize_t = _a.shape[1]
+    ti: cython.Py_ssize_t = (rows + incr - 1) // incr
+    tj: cython.Py_ssize_t = (cols + incr - 1) // incr
+    km: cython.Py_ssize_t = (inner + incr - 1) // incr
+    partial_arr = np.empty((km, rows, cols), dtype="float32")
+    partial: cython.float[:, :, ::1] = partial_arr
+    res: cython.float[:, :] = out
+    t: cython.Py_ssize_t
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    kb: cython.Py_ssize_t
+    k: cython.Py_ssize_t
+    x: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    z: cython.Py_ssize_t
+    xm: cython.Py_ssize_t
+    ym: cython.Py_ssize_t
+    zm: cython.Py_ssize_t
+    s: cython.float
+    r: cython.float
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+
+    for t in prange(ti * tj * km, nogil=True):
+        kb = t % km
+        i = (t // km) // tj * incr
+        j = (t // km) % tj * incr
+        k = kb * incr
+        xm = min(i + incr, rows)
+        ym = min(j + incr, cols)
+        zm = min(k + incr, inner)
+        for x in range(i, xm):
+            for y in range(j, ym):
+                s = 0
+                for z in range(k, zm):
+                    s = fz(s + fz(_a[x, z] * _b[y, z], _flush, cp, hpp), _flush, cp, hpa)
+                partial[kb, x, y] = s
+
+    for x in prange(rows, nogil=True):
+        for y in range(cols):
+            r = 0
+            for kb in range(km):
+                r = fz(r + partial[kb, x, y], _flush, cp, hpa)
+            res[x, y] = r
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush=0, profile=None, filter_blocks=None):
+    # prod: (kh*kw*n_f, n*h_p*w_p), kernel matrix times padded input matrix
+    # result: (n_f, n*h_p*w_p), overwritten with the shifted sum over all kernel pixels
+    # filter_blocks: work is split into (sample, block of filters) pairs, every output element still gets the kernel
+    #   pixels added in the same order. None: one block per sample if there are at least as many samples as threads,
+    #   otherwise enough blocks to give every thread work
+    _flush: cython.int = flush
+    _prod: cython.const[cython.float][:, :] = prod
+    result.fill(0)
+    _result: cython.float[:, :] = result
+    n_f = _result.shape[0]
+    assert _prod.shape[0] == kh * kw * n_f and _prod.shape[1] == n * h_p * w_p == _result.shape[1]
+    samp_width: cython.Py_ssize_t = h_p * w_p  # width of single sample of batch within product/result matrix row
+    _n: cython.Py_ssize_t = n
+    _kh: cython.Py_ssize_t = kh
+    _kw: cython.Py_ssize_t = kw
+    _w_p: cython.Py_ssize_t = w_p
+    _n_f: cython.Py_ssize_t = n_f
+    s: cython.Py_ssize_t
+    samp_off: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    y_off: cython.Py_ssize_t
+    x: cython.Py_ssize_t
+    total_off: cython.Py_ssize_t
+    prod_off: cython.Py_ssize_t
+    res_start: cython.Py_ssize_t
+    prod_start: cython.Py_ssize_t
+    si: cython.Py_ssize_t
+    fi: cython.Py_ssize_t
+    if filter_blocks is None:
+        threads = omp_get_max_threads()
+        filter_blocks = 1 if n >= threads else min(n_f, (threads + n - 1) // n)
+    _fb: cython.Py_ssize_t = filter_blocks
+    f_size: cython.Py_ssize_t = (_n_f + _fb - 1) // _fb
+    t: cython.Py_ssize_t
+    f0: cython.Py_ssize_t
+    f1: cython.Py_ssize_t
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+    for t in prange(_n * _fb, nogil=True):  # samples need separate handling, filters are independent
+        s = t // _fb
+        f0 = (t % _fb) * f_size
+        f1 = min(f0 + f_size, _n_f)
+        samp_off = s * samp_width  # offset of sample within product+result matrices
+        for y in range(_kh):
+            y_off = (y - ((_kh - 1) // 2)) * _w_p  # partial offset of these mask pixels in product row
+            for x in range(_kw):
+                total_off = y_off + x - ((_kw - 1) // 2)  # total offset of this mask pixel in product row
+                prod_off = (y * _kw + x) * _n_f  # product offset in column
+                if total_off < 0:
+                    res_start = samp_off - total_off
+                    prod_start = samp_off
+                else:
+                    res_start = samp_off
+                    prod_start = samp_off + total_off
+                for fi in range(f0, f1):
+                    for si in range(samp_width - cabs(total_off)):
+                        _result[fi, res_start+si] = fz(_result[fi, res_start+si] + _prod[prod_off+fi, prod_start+si], _flush, cp, hpa)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def kn2row(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None):
+    # input: (n, h_i, w_i, c)
+    # kernel: (kh, kw, c, n_f)
+    # out: (n, h_o, w_o, n_f)
+    n, h_i, w_i, c = inputs.shape
+    kh, kw, _, n_f = kernel.shape
+    str_h, str_w = strides
+    pad_h = (kh - 1) // 2
+    pad_w = (kw - 1) // 2
+    if mode == "same":
+        in_padded = np.pad(inputs, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
+    else:
+        in_padded = inputs
+    _, h_p, w_p, _ = in_padded.shape
+    in_mat = in_padded.transpose((3, 0, 1, 2)).reshape((c, -1))  # c rows, n*h_i*w_i columns
+    kern_mat = kernel.transpose((0, 1, 3, 2)).reshape((-1, c))  # kh*kw*n_f rows, c columns
+    prod = tiled_matmul(kern_mat, in_mat, flush, profile=profile)
+    result = np.empty((n_f, n * h_p * w_p), dtype='float32')
+    kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, profile)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    return result.reshape((n_f, n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:h_p - pad_h:str_h,
+                                                                      s_w:w_p - pad_w:str_w, :]
+
+
+# Latency kernels for small batches. With one or a few samples, kn2row spends most of its time on the padded input
+# copy, the transposes and the product matrix, and tiled_matmul on a single row has a single row tile. gemv and
+# direct_conv use the weights in their keras layout (dense (inner, cols), conv (kh, kw, c, n_f)), need no
+# intermediate matrices and split the work over blocks of output units / filters. Every result element goes through
+# the same sequence of multiplications, additions and flushes as in tiled_matmul/kn2row, so results, flush counts
+# and profiles are identical.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cfunc
+@cython.inline
+@cython.nogil
+def _dot_block(x: cython.pointer(cython.const[cython.float]), w: cython.pointer(cython.const[cython.float]),
+               ld: cython.Py_ssize_t, inner: cython.Py_ssize_t, width: cython.Py_ssize_t, res: cython.p_float,
+               s: cython.p_float, flush: cython.int, thr: cython.float, counts: cython.p_ulonglong,
+               hpp: cython.p_ulonglong, hpa: cython.p_ulonglong) -> cython.void:
+    # res[y] for y < width: tiled_matmul result element of the row x (inner,) and column y of w, whose rows are ld
+    # apart. The partial sums of the width columns are kept side by side in s, so the column loop vectorizes. Without
+    # profiling, flushes are done branch-free by comparing magnitudes with thr = 2^(flush - 127): like fz, every value
+    # below it becomes +0 (zeros of either sign included) and the non-zero ones are counted.
+    _k: cython.Py_ssize_t
+    k: cython.Py_ssize_t
+    z: cython.Py_ssize_t
+    zm: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    a: cython.float
+    v: cython.float
+    f: cython.int
+    cnt: cython.ulonglong = 0
+    wz: cython.pointer(cython.const[cython.float])
+    for y in range(width):
+        res[y] = 0
+    for _k in range((inner + 63) // 64):
+        k = _k * 64
+        zm = min(k + 64, inner)
+        for y in range(width):
+            s[y] = 0
+        if hpp == cython.NULL:
+            for z in range(k, zm):
+                a = x[z]
+                wz = w + z * ld
+                for y in range(width):
+                    v = a * wz[y]
+                    f = fabs(v) < thr
+                    cnt += f & (v != 0)
+                    v = s[y] + (0 if f else v)
+                    f = fabs(v) < thr
+                    cnt += f & (v != 0)
+                    s[y] = 0 if f else v
+            for y in range(width):
+                v = res[y] + s[y]
+                f = fabs(v) < thr
+                cnt += f & (v != 0)
+                res[y] = 0 if f else v
+        else:
+            for z in range(k, zm):
+                a = x[z]
+                wz = w + z * ld
+                for y in range(width):
+                    s[y] = fz(s[y] + fz(a * wz[y], flush, counts, hpp), flush, counts, hpa)
+            for y in range(width):
+                res[y] = fz(res[y] + s[y], flush, counts, hpa)
+    counts[omp_get_thread_num()] += cnt
+
+
+_zero_buf = np.zeros(1, dtype="float32")
+
+
+def _zeros(n):
+    # shared read-only zeros, stand-in for the zero padding in profiled direct_conv calls
+    global _zero_buf
+    if len(_zero_buf) < n:
+        _zero_buf = np.zeros(n, dtype="float32")
+    return _zero_buf
+
+
+def _threshold(flush):
+    # a non-zero float32 has a biased exponent below flush iff its magnitude is below 2^(flush - 127)
+    return np.float32(2.0 ** (flush - 127)) if flush else np.float32(0)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def gemv(x, w, flush=0, out=None, profile=None, scratch=None):
+    # tiled_matmul(x, w) for a few rows of x, e.g. a dense layer on a single sample
+    # work items are 64 wide blocks of output columns, which stream through the rows of w
+    # out: the result is computed in place if it is a contiguous float32 array, scratch: optional (cols,) float32
+    x = np.ascontiguousarray(x, dtype="float32")
+    w = np.ascontiguousarray(w, dtype="float32")
+    _x: cython.const[cython.float][:, ::1] = x
+    _w: cython.const[cython.float][:, ::1] = w
+    _flush: cython.int = flush
+    thr: cython.float = _threshold(flush)
+    incr: cython.Py_ssize_t = 64
+    rows: cython.Py_ssize_t = _x.shape[0]
+    inner: cython.Py_ssize_t = _x.shape[1]
+    cols: cython.Py_ssize_t = _w.shape[1]
+    assert inner == _w.shape[0]
+    if out is not None and out.shape == (rows, cols) and out.dtype == np.float32 and out.flags.c_contiguous:
+        res_arr = out
+    else:
+        res_arr = np.empty((rows, cols), dtype="float32")
+    s_arr = np.empty(cols, dtype="float32") if scratch is None else scratch
+    _res: cython.float[:, ::1] = res_arr
+    _s: cython.float[::1] = s_arr
+    j: cython.Py_ssize_t
+    r: cython.Py_ssize_t
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+
+    if inner > 0:
+        for j in prange(0, cols, incr, nogil=True):
+            for r in range(rows):
+                _dot_block(cython.address(_x[r, 0]), cython.address(_w[0, j]), cols, inner, min(incr, cols - j),
+                           cython.address(_res[r, j]), cython.address(_s[j]), _flush, thr, cp, hpp, hpa)
+    else:
+        res_arr.fill(0)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    if out is None or out is res_arr:
+        return res_arr
+    np.copyto(out, res_arr)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def direct_conv(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None, out=None, result=None,
+                filter_block=None, scratch=None):
+    # kn2row for small batches, without the padded input and product matrices
+    # input: (n, h_i, w_i, c), kernel: (kh, kw, c, n_f), out: optional (n, h_o, w_o, n_f) array for the output
+    # result: optional (n, h_p*w_p, n_f) scratch, scratch: optional (2, n, n_f) float32 for the partial sums
+    # filter_block: filters per work item, None: up to 64, fewer if that leaves threads without work
+    # Every (sample, block of filters) work item walks over the positions of the padded input, computes the products
+    # of each kernel pixel with the input pixel there and adds them to the result position this kernel pixel shifts
+    # them to, which adds up the kernel pixels of every result position in kn2row's order. Products with the zero
+    # padding are +0 and flush nothing, they are only computed when profiling.
+    inputs = np.ascontiguousarray(inputs, dtype="float32")
+    kernel = np.ascontiguousarray(kernel, dtype="float32")
+    n, h_i, w_i, c = inputs.shape
+    kh, kw, _, n_f = kernel.shape
+    assert kernel.shape[2] == c
+    str_h, str_w = strides
+    pad_h = (kh - 1) // 2
+    pad_w = (kw - 1) // 2
+    in_h = pad_h if mode == "same" else 0
+    in_w = pad_w if mode == "same" else 0
+    h_p = h_i + 2 * in_h
+    w_p = w_i + 2 * in_w
+    if result is None:
+        result = np.empty((n, h_p * w_p, n_f), dtype="float32")
+    assert result.shape == (n, h_p * w_p, n_f)
+    if filter_block is None:
+        per_sample = (omp_get_max_threads() + n - 1) // n
+        filter_block = min(64, max(8, ((n_f + per_sample - 1) // per_sample + 7) // 8 * 8))
+    if scratch is None:
+        scratch = np.empty((2, n, n_f), dtype="float32")
+    assert scratch.shape == (2, n, n_f)
+    _x: cython.const[cython.float][:, :, :, ::1] = inputs
+    _k: cython.const[cython.float][:, :, :, ::1] = kernel
+    _r: cython.float[:, :, ::1] = result
+    _d: cython.float[:, :, ::1] = scratch
+    _zero: cython.const[cython.float][::1] = _zeros(c)
+    _flush: cython.int = flush
+    thr: cython.float = _threshold(flush)
+    _n: cython.Py_ssize_t = n
+    _n_f: cython.Py_ssize_t = n_f
+    _c: cython.Py_ssize_t = c
+    _kw: cython.Py_ssize_t = kw
+    _kk: cython.Py_ssize_t = kh * kw
+    _pad_h: cython.Py_ssize_t = pad_h
+    _pad_w: cython.Py_ssize_t = pad_w
+    _h_i: cython.Py_ssize_t = h_i
+    _w_i: cython.Py_ssize_t = w_i
+    _w_p: cython.Py_ssize_t = w_p
+    _in_h: cython.Py_ssize_t = in_h
+    _in_w: cython.Py_ssize_t = in_w
+    samp_width: cython.Py_ssize_t = h_p * w_p
+    _fb: cython.Py_ssize_t = filter_block
+    blocks: cython.Py_ssize_t = (_n_f + _fb - 1) // _fb
+    t: cython.Py_ssize_t
+    s: cython.Py_ssize_t
+    f0: cython.Py_ssize_t
+    width: cython.Py_ssize_t
+    f: cython.Py_ssize_t
+    q: cython.Py_ssize_t
+    p: cython.Py_ssize_t
+    i: cython.Py_ssize_t
+    iy: cython.Py_ssize_t
+    ix: cython.Py_ssize_t
+    xp: cython.pointer(cython.const[cython.float])
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+
+    result.fill(0)
+    if c > 0:
+        for t in prange(_n * blocks, nogil=True):  # samples need separate handling, filters are independent
+            s = t // blocks
+            f0 = (t % blocks) * _fb
+            width = min(_fb, _n_f - f0)
+            for q in range(samp_width):
+                iy = q // _w_p - _in_h
+                ix = q % _w_p - _in_w
+                if iy >= 0 and iy < _h_i and ix >= 0 and ix < _w_i:
+                    xp = cython.address(_x[s, iy, ix, 0])
+                elif hpp != cython.NULL:
+                    xp = cython.address(_zero[0])
+                else:
+                    continue
+                for i in range(_kk):
+                    _dot_block(xp, cython.address(_k[i // _kw, i % _kw, 0, f0]), _n_f, _c, width,
+                               cython.address(_d[0, s, f0]), cython.address(_d[1, s, f0]), _flush, thr, cp, hpp,
+                               hpa)
+                    p = q - (i // _kw - _pad_h) * _w_p - (i % _kw - _pad_w)
+                    if p >= 0 and p < samp_width:
+                        for f in range(f0, f0 + width):
+                            _r[s, p, f] = fz(_r[s, p, f] + _d[0, s, f], _flush, cp, hpa)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    cropped = result.reshape((n, h_p, w_p, n_f))[:, s_h:h_p - pad_h:str_h, s_w:w_p - pad_w:str_w, :]
+    if out is None:
+        return cropped
+    np.copyto(out, cropped)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def channel_affine(x, scale, offset, flush=0, out=None, profile=None):
+    # x: (..., c), scale/offset: (c,)
+    # out = x * scale + offset, per channel (batch normalization in inference mode, rescaling)
+    # out may be x itself
+    shape = x.shape
+    c = shape[len(shape) - 1]
+    _x: cython.const[cython.float][:, :] = np.reshape(x, (-1, c))
+    _s: cython.const[cython.float][:] = scale
+    _o: cython.const[cython.float][:] = offset
+    _flush: cython.int = flush
+    _rows: cython.Py_ssize_t = _x.shape[0]
+    _c: cython.Py_ssize_t = c
+    assert _s.shape[0] == _c and _o.shape[0] == _c
+    if out is None:
+        out = np.empty(shape, dtype="float32")
+    _y: cython.float[:, :] = np.reshape(out, (-1, c))
+    assert _y.shape[0] == _rows
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+    for i in prange(_rows, nogil=True):
+        for j in range(_c):
+            _y[i, j] = fz(fz(_x[i, j] * _s[j], _flush, cp, hpp) + _o[j], _flush, cp, hpa)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def elem_add(a, b, flush=0, out=None, profile=None):
+    assert a.shape == b.shape
+    shape = a.shape
+    _a: cython.const[cython.float][:] = np.reshape(a, (-1))
+    _b: cython.const[cython.float][:] = np.reshape(b, (-1))
+    _flush: cython.int = flush
+    _len: cython.Py_ssize_t = len(_a)
+    if out is None:
+        out = np.empty(shape, dtype="float32")
+    _y: cython.float[:] = np.reshape(out, (-1))
+    assert _y.shape[0] == _len
+    i: cython.Py_ssize_t
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+    for i in prange(_len, nogil=True):
+        _y[i] = fz(_a[i] + _b[i], _flush, cp, hpa)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    return out
+
+
+def pool_geometry(size, pool, stride, mode="valid"):
+    # output size and leading padding of one spatial dimension, matching keras/tf pooling
+    if mode == "same":
+        out = (size + stride - 1) // stride
+        pad = max((out - 1) * stride + pool - size, 0) // 2
+    else:
+        out = (size - pool) // stride + 1
+        pad = 0
+    return out, pad
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def max_pool(inputs, pool_size=(2, 2), strides=None, mode="valid", out=None):
+    # input: (n, h_i, w_i, c)
+    # out: (n, h_o, w_o, c)
+    # no arithmetic, so nothing to flush here - inputs are expected to be flushed already
+    n, h_i, w_i, c = inputs.shape
+    p_h, p_w = pool_size
+    str_h, str_w = pool_size if strides is None else strides
+    h_o, pad_h = pool_geometry(h_i, p_h, str_h, mode)
+    w_o, pad_w = pool_geometry(w_i, p_w, str_w, mode)
+    _x: cython.const[cython.float][:, :, :, :] = inputs
+    if out is None:
+        out = np.empty((n, h_o, w_o, c), dtype="float32")
+    _y: cython.float[:, :, :, :] = out
+    _rows: cython.Py_ssize_t = n * h_o
+    _h_i: cython.Py_ssize_t = h_i
+    _w_i: cython.Py_ssize_t = w_i
+    _h_o: cython.Py_ssize_t = h_o
+    _w_o: cython.Py_ssize_t = w_o
+    _c: cython.Py_ssize_t = c
+    _p_h: cython.Py_ssize_t = p_h
+    _p_w: cython.Py_ssize_t = p_w
+    _str_h: cython.Py_ssize_t = str_h
+    _str_w: cython.Py_ssize_t = str_w
+    _pad_h: cython.Py_ssize_t = pad_h
+    _pad_w: cython.Py_ssize_t = pad_w
+    r: cython.Py_ssize_t
+    s: cython.Py_ssize_t
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    ch: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    x: cython.Py_ssize_t
+    ys: cython.Py_ssize_t
+    ye: cython.Py_ssize_t
+    xs: cython.Py_ssize_t
+    xe: cython.Py_ssize_t
+    m: cython.float
+    for r in prange(_rows, nogil=True):
+        s = r // _h_o
+        i = r % _h_o
+        ys = max(i * _str_h - _pad_h, 0)
+        ye = min(i * _str_h - _pad_h + _p_h, _h_i)
+        for j in range(_w_o):
+            xs = max(j * _str_w - _pad_w, 0)
+            xe = min(j * _str_w - _pad_w + _p_w, _w_i)
+            for ch in range(_c):
+                m = _x[s, ys, xs, ch]
+                for y in range(ys, ye):
+                    for x in range(xs, xe):
+                        if _x[s, y, x, ch] > m:
+                            m = _x[s, y, x, ch]
+                _y[s, i, j, ch] = m
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def avg_pool(inputs, pool_size=(2, 2), strides=None, mode="valid", flush=0, out=None, profile=None):
+    # input: (n, h_i, w_i, c)
+    # out: (n, h_o, w_o, c)
+    # padded positions are excluded from the average, like in keras/tf
+    n, h_i, w_i, c = inputs.shape
+    p_h, p_w = pool_size
+    str_h, str_w = pool_size if strides is None else strides
+    h_o, pad_h = pool_geometry(h_i, p_h, str_h, mode)
+    w_o, pad_w = pool_geometry(w_i, p_w, str_w, mode)
+    _x: cython.const[cython.float][:, :, :, :] = inputs
+    if out is None:
+        out = np.empty((n, h_o, w_o, c), dtype="float32")
+    _y: cython.float[:, :, :, :] = out
+    _flush: cython.int = flush
+    _rows: cython.Py_ssize_t = n * h_o
+    _h_i: cython.Py_ssize_t = h_i
+    _w_i: cython.Py_ssize_t = w_i
+    _h_o: cython.Py_ssize_t = h_o
+    _w_o: cython.Py_ssize_t = w_o
+    _c: cython.Py_ssize_t = c
+    _p_h: cython.Py_ssize_t = p_h
+    _p_w: cython.Py_ssize_t = p_w
+    _str_h: cython.Py_ssize_t = str_h
+    _str_w: cython.Py_ssize_t = str_w
+    _pad_h: cython.Py_ssize_t = pad_h
+    _pad_w: cython.Py_ssize_t = pad_w
+    r: cython.Py_ssize_t
+    s: cython.Py_ssize_t
+    i: cython.Py_ssize_t
+    j: cython.Py_ssize_t
+    ch: cython.Py_ssize_t
+    y: cython.Py_ssize_t
+    x: cython.Py_ssize_t
+    ys: cython.Py_ssize_t
+    ye: cython.Py_ssize_t
+    xs: cython.Py_ssize_t
+    xe: cython.Py_ssize_t
+    acc: cython.float
+    counts: cython.ulonglong[128]
+    cp: cython.p_ulonglong = cython.address(counts[0])
+    _clear_counts(cp)
+    hist = _new_hist(profile)
+    hpp: cython.p_ulonglong = _hist_ptr(hist, PROFILE_PRODUCTS)
+    hpa: cython.p_ulonglong = _hist_ptr(hist, PROFILE_ACCUMULATORS)
+    for r in prange(_rows, nogil=True):
+        s = r // _h_o
+        i = r % _h_o
+        ys = max(i * _str_h - _pad_h, 0)
+        ye = min(i * _str_h - _pad_h + _p_h, _h_i)
+        for j in range(_w_o):
+            xs = max(j * _str_w - _pad_w, 0)
+            xe = min(j * _str_w - _pad_w + _p_w, _w_i)
+            for ch in range(_c):
+                acc = 0
+                for y in range(ys, ye):
+                    for x in range(xs, xe):
+                        acc = fz(acc + _x[s, y, x, ch], _flush, cp, hpa)
+                _y[s, i, j, ch] = fz(acc / ((ye - ys) * (xe - xs)), _flush, cp, hpp)
+    _commit_counts(cp)
+    _commit_hist(hist, profile)
+    return out
@@ -0,0 +1,185 @@
+import numpy as np
+import numba
+from numba import njit, prange
+from fastconv import numpy_backend
+from fastconv.numpy_backend import PROFILE_ACTIVATIONS, TILE, get_flush_count, add_flush_count, channel_affine, \
+    elem_add, pool_geometry, max_pool, avg_pool
+
+
+# Numba JIT versions of fz_arr, tiled_matmul and kn2row with the loop structure of the cython kernels, for hosts
+# without a C compiler. A value is flushed to +0 if its magnitude is below 2^(flush - 127), which is the same as a
+# biased exponent below flush, and counted if it is non-zero. Exponent profiling is left to the numpy backend. Flush
+# counts go to the numpy backend's counter. The element-wise and pooling kernels are the numpy backend's.
+
+
+def _threshold(flush):
+    return 2.0 ** (flush - 127) if flush else 0.0
+
+
+@njit(parallel=True, cache=True)
+def _fz_kernel(x, y, thr, counts):
+    for i in prange(len(x)):
+        v = x[i]
+        if abs(v) < thr:
+            if v != 0:
+                counts[i] = 1
+            v = np.float32(0)
+        y[i] = v
+
+
+@njit(parallel=True, cache=True)
+def _matmul_kernel(a, b, res, thr, counts):
+    # one block of up to TILE rows per prange iteration, counts: flushes per block
+    rows, inner = a.shape
+    cols = b.shape[1]
+    km = (inner + TILE - 1) // TILE
+    for ib in prange((rows + TILE - 1) // TILE):
+        i = ib * TILE
+        xm = min(i + TILE, rows)
+        cnt = 0
+        for j in range(0, cols, TILE):
+            ym = min(j + TILE, cols)
+            for kb in range(km):
+                k = kb * TILE
+                zm = min(k + TILE, inner)
+                for x in range(i, xm):
+                    for y in range(j, ym):
+                        s = np.float32(0)
+                        for z in range(k, zm):
+                            p = a[x, z] * b[z, y]
+                            if abs(p) < thr:
+                                if p != 0:
+                                    cnt += 1
+                                p = np.float32(0)
+                            s = s + p
+                            if abs(s) < thr:
+                                if s != 0:
+                                    cnt += 1
+                                s = np.float32(0)
+                        r = res[x, y] + s
+                        if abs(r) < thr:
+                            if r != 0:
+                                cnt += 1
+                            r = np.float32(0)
+                        res[x, y] = r
+        counts[ib] = cnt
+
+
+@njit(parallel=True, cache=True)
+def _shift_add_kernel(prod, result, n, h_p, w_p, kh, kw, thr, counts):
+    n_f = result.shape[0]
+    samp_width = h_p * w_p
+    for s in prange(n):
+        samp_off = s * samp_width
+        cnt = 0
+        for y in range(kh):
+            y_off = (y - ((kh - 1) // 2)) * w_p
+            for x in range(kw):
+                total_off = y_off + x - ((kw - 1) // 2)
+                prod_off = (y * kw + x) * n_f
+                if total_off < 0:
+                    res_start = samp_off - total_off
+                    prod_start = samp_off
+                else:
+                    res_start = samp_off
+                    prod_start = samp_off + total_off
+                for fi in range(n_f):
+                    for si in range(samp_width - abs(total_off)):
+                        r = result[fi, res_start + si] + prod[prod_off + fi, prod_start + si]
+                        if abs(r) < thr:
+                            if r != 0:
+                                cnt += 1
+                            r = np.float32(0)
+                        result[fi, res_start + si] = r
+        counts[s] = cnt
+
+
+def fz_arr(x, flush, out=None, profile=None, kind=PROFILE_ACTIVATIONS):
+    if profile is not None:
+        return numpy_backend.fz_arr(x, flush, out, profile, kind)
+    if flush == 0:
+        if out is None:
+            return x
+        np.copyto(np.reshape(out, x.shape), x)
+        return out
+    flat = np.ascontiguousarray(x, dtype="float32").reshape(-1)
+    y = np.empty(len(flat), dtype="float32") if out is None else np.reshape(out, (-1))
+    counts = np.zeros(len(flat), dtype=np.uint8)
+    _fz_kernel(flat, y, _threshold(flush), counts)
+    add_flush_count(np.count_nonzero(counts))
+    return out if out is not None else y.reshape(x.shape)
+
+
+def tiled_matmul(a, b, flush=0, out=None, profile=None, split_k=None):
+    # split_k is accepted for compatibility, the k-blocks are always summed sequentially here
+    if profile is not None:
+        return numpy_backend.tiled_matmul(a, b, flush, out, profile)
+    a = np.ascontiguousarray(a, dtype="float32")
+    b = np.ascontiguousarray(b, dtype="float32")
+    assert a.shape[1] == b.shape[0]
+    if out is None:
+        out = np.zeros((a.shape[0], b.shape[1]), dtype="float32")
+    else:
+        out.fill(0)
+    counts = np.zeros((a.shape[0] + TILE - 1) // TILE, dtype=np.int64)
+    _matmul_kernel(a, b, out, _threshold(flush), counts)
+    add_flush_count(counts.sum())
+    return out
+
+
+def kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush=0, profile=None, filter_blocks=None):
+    # filter_blocks is accepted for compatibility, the result does not depend on it
+    if profile is not None:
+        return numpy_backend.kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, profile)
+    assert prod.shape[0] == kh * kw * result.shape[0] and prod.shape[1] == n * h_p * w_p == result.shape[1]
+    result.fill(0)
+    counts = np.zeros(n, dtype=np.int64)
+    _shift_add_kernel(prod, result, n, h_p, w_p, kh, kw, _threshold(flush), counts)
+    add_flush_count(counts.sum())
+
+
+def kn2row(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None):
+    if profile is not None:
+        return numpy_backend.kn2row(inputs, kernel, mode, strides, flush, profile)
+    n, h_i, w_i, c = inputs.shape
+    kh, kw, _, n_f = kernel.shape
+    str_h, str_w = strides
+    pad_h = (kh - 1) // 2
+    pad_w = (kw - 1) // 2
+    if mode == "same":
+        in_padded = np.pad(inputs, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
+    else:
+        in_padded = inputs
+    _, h_p, w_p, _ = in_padded.shape
+    in_mat = in_padded.transpose((3, 0, 1, 2)).reshape((c, -1))
+    kern_mat = kernel.transpose((0, 1, 3, 2)).reshape((-1, c))
+    prod = tiled_matmul(kern_mat, in_mat, flush)
+    result = np.empty((n_f, n * h_p * w_p), dtype='float32')
+    kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    return result.reshape((n_f, n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:h_p - pad_h:str_h,
+                                                                      s_w:w_p - pad_w:str_w, :]
+
+
+def gemv(x, w, flush=0, out=None, profile=None, scratch=None):
+    return tiled_matmul(x, w, flush, out, profile)
+
+
+def direct_conv(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None, out=None, result=None,
+                filter_block=None, scratch=None):
+    # result, filter_block and scratch are accepted for compatibility
+    y = kn2row(np.asarray(inputs, dtype="float32"), kernel, mode, strides, flush, profile)
+    if out is None:
+        return y
+    np.copyto(out, y)
+    return out
+
+
+def set_num_threads(n):
+    # numba's thread count is per python thread, like the OpenMP team size of the cython kernels
+    numba.set_num_threads(max(1, min(n, numba.config.NUMBA_NUM_THREADS)))
+
+
+def get_max_threads():
+    return numba.get_num_threads()
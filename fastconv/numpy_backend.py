@@ -0,0 +1,270 @@
+import threading
+import numpy as np
+from fastconv import counters
+
+
+# Vectorised numpy versions of fz_arr, tiled_matmul and kn2row. They flush, count and profile exactly like the cython
+# kernels in kernels.py and add up in the same order (products summed per 64-wide tile of the inner dimension, tiles
+# summed into the result, shift-add over kernel pixels), so results and flush counts are bit-identical. Used where the
+# extension is not built, and as the reference of backend_conformance.py.
+
+# same as kernels.py
+PROFILE_WEIGHTS = 0
+PROFILE_ACTIVATIONS = 1
+PROFILE_PRODUCTS = 2
+PROFILE_ACCUMULATORS = 3
+PROFILE_KINDS = 4
+PROFILE_BINS = 257
+
+TILE = 64  # inner tile of tiled_matmul
+COLUMNS = 4096  # tiled_matmul works on this many result columns at a time to bound the temporaries
+
+_lock = threading.Lock()
+_flush_count = 0
+
+
+def get_flush_count(clear=False):
+    # inside a flush scope only the scope's count, see counters.py
+    global _flush_count
+    scope = counters.current()
+    if scope is not None:
+        return scope.get(clear)
+    with _lock:
+        count = _flush_count
+        if clear:
+            _flush_count = 0
+    return count
+
+
+def add_flush_count(count):
+    global _flush_count
+    with _lock:
+        _flush_count += int(count)
+    counters.add(int(count))
+
+
+def _fz(x, flush, hist=None, out=None):
+    # flush all values of x with a biased exponent below flush to +0 (like fz, zeros of either sign included),
+    # counting the non-zero ones
+    # hist: None or a (PROFILE_BINS,) row of a layer profile
+    if flush == 0 and hist is None:
+        if out is None:
+            return x
+        np.copyto(out, x)
+        return out
+    bits = x.view(np.uint32) & 0x7FFFFFFF
+    e = bits >> 23
+    if hist is not None:
+        counts = np.bincount(np.where(bits == 0, PROFILE_BINS - 1, e).reshape(-1),
+                             minlength=PROFILE_BINS).astype(np.uint64)
+        with _lock:
+            hist += counts
+    if out is None:
+        out = x.copy()
+    elif out is not x:
+        np.copyto(out, x)
+    if flush:
+        mask = e < flush
+        count = np.count_nonzero(mask & (bits != 0))
+        if count:
+            add_flush_count(count)
+        out[mask] = 0
+    return out
+
+
+def _hist(profile, kind):
+    return None if profile is None else profile[kind]
+
+
+def fz_arr(x, flush, out=None, profile=None, kind=PROFILE_ACTIVATIONS):
+    if flush == 0 and profile is None:
+        if out is None:
+            return x
+        np.copyto(np.reshape(out, x.shape), x)
+        return out
+    x = np.asarray(x, dtype="float32")
+    y = _fz(np.ascontiguousarray(x), flush, _hist(profile, kind))
+    if out is not None:
+        np.copyto(np.reshape(out, x.shape), y)
+        return out
+    return y
+
+
+def tiled_matmul(a, b, flush=0, out=None, profile=None, split_k=None):
+    # split_k is accepted for compatibility, the k-blocks are always summed sequentially here
+    a = np.asarray(a, dtype="float32")
+    b = np.asarray(b, dtype="float32")
+    rows, inner = a.shape
+    assert inner == b.shape[0]
+    cols = b.shape[1]
+    if out is None:
+        out = np.zeros((rows, cols), dtype="float32")
+    else:
+        out.fill(0)
+    hpp = _hist(profile, PROFILE_PRODUCTS)
+    hpa = _hist(profile, PROFILE_ACCUMULATORS)
+    for j in range(0, cols, COLUMNS):
+        res = out[:, j:j + COLUMNS]
+        bj = b[:, j:j + COLUMNS]
+        s = np.empty(res.shape, dtype="float32")
+        p = np.empty(res.shape, dtype="float32")
+        for k in range(0, inner, TILE):
+            s.fill(0)
+            for z in range(k, min(k + TILE, inner)):
+                np.multiply(a[:, z, None], bj[None, z, :], out=p)
+                _fz(p, flush, hpp, out=p)
+                np.add(s, p, out=s)
+                _fz(s, flush, hpa, out=s)
+            np.add(res, s, out=res)
+            _fz(res, flush, hpa, out=res)
+    return out
+
+
+def kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush=0, profile=None, filter_blocks=None):
+    # filter_blocks is accepted for compatibility, the result does not depend on it
+    n_f = result.shape[0]
+    assert prod.shape[0] == kh * kw * n_f and prod.shape[1] == n * h_p * w_p == result.shape[1]
+    result.fill(0)
+    hpa = _hist(profile, PROFILE_ACCUMULATORS)
+    samp_width = h_p * w_p
+    for s in range(n):
+        samp_off = s * samp_width
+        for y in range(kh):
+            y_off = (y - ((kh - 1) // 2)) * w_p
+            for x in range(kw):
+                total_off = y_off + x - ((kw - 1) // 2)
+                prod_off = (y * kw + x) * n_f
+                if total_off < 0:
+                    res_start = samp_off - total_off
+                    prod_start = samp_off
+                else:
+                    res_start = samp_off
+                    prod_start = samp_off + total_off
+                length = samp_width - abs(total_off)
+                r = result[:, res_start:res_start + length]
+                np.add(r, prod[prod_off:prod_off + n_f, prod_start:prod_start + length], out=r)
+                _fz(r, flush, hpa, out=r)
+
+
+def kn2row(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None):
+    # same steps as kernels.kn2row
+    n, h_i, w_i, c = inputs.shape
+    kh, kw, _, n_f = kernel.shape
+    str_h, str_w = strides
+    pad_h = (kh - 1) // 2
+    pad_w = (kw - 1) // 2
+    if mode == "same":
+        in_padded = np.pad(inputs, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
+    else:
+        in_padded = inputs
+    _, h_p, w_p, _ = in_padded.shape
+    in_mat = in_padded.transpose((3, 0, 1, 2)).reshape((c, -1))
+    kern_mat = kernel.transpose((0, 1, 3, 2)).reshape((-1, c))
+    prod = tiled_matmul(kern_mat, in_mat, flush, profile=profile)
+    result = np.empty((n_f, n * h_p * w_p), dtype='float32')
+    kn2row_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, profile)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    return result.reshape((n_f, n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:h_p - pad_h:str_h,
+                                                                      s_w:w_p - pad_w:str_w, :]
+
+
+def gemv(x, w, flush=0, out=None, profile=None, scratch=None):
+    # the latency kernels of kernels.py compute exactly what tiled_matmul/kn2row compute
+    return tiled_matmul(x, w, flush, out, profile)
+
+
+def direct_conv(inputs, kernel, mode="same", strides=(1, 1), flush=0, profile=None, out=None, result=None,
+                filter_block=None, scratch=None):
+    # result, filter_block and scratch are accepted for compatibility
+    y = kn2row(np.asarray(inputs, dtype="float32"), kernel, mode, strides, flush, profile)
+    if out is None:
+        return y
+    np.copyto(out, y)
+    return out
+
+
+def channel_affine(x, scale, offset, flush=0, out=None, profile=None):
+    # same steps as kernels.channel_affine, out may be x
+    x = np.asarray(x, dtype="float32")
+    if out is None:
+        out = np.empty(x.shape, dtype="float32")
+    prod = _fz(x * np.asarray(scale, dtype="float32"), flush, _hist(profile, PROFILE_PRODUCTS))
+    np.add(prod, np.asarray(offset, dtype="float32"), out=prod)
+    _fz(prod, flush, _hist(profile, PROFILE_ACCUMULATORS), out=np.reshape(out, x.shape))
+    return out
+
+
+def elem_add(a, b, flush=0, out=None, profile=None):
+    assert a.shape == b.shape
+    if out is None:
+        out = np.empty(a.shape, dtype="float32")
+    _fz(np.add(a, b, dtype="float32"), flush, _hist(profile, PROFILE_ACCUMULATORS), out=np.reshape(out, a.shape))
+    return out
+
+
+def pool_geometry(size, pool, stride, mode="valid"):
+    # same as kernels.pool_geometry
+    if mode == "same":
+        out = (size + stride - 1) // stride
+        pad = max((out - 1) * stride + pool - size, 0) // 2
+    else:
+        out = (size - pool) // stride + 1
+        pad = 0
+    return out, pad
+
+
+def _pool_windows(shape, pool_size, strides, mode):
+    # [(i, j, ys, ye, xs, xe)] per output position, clipped to the input like in kernels.max_pool/avg_pool
+    _, h_i, w_i, _ = shape
+    p_h, p_w = pool_size
+    str_h, str_w = pool_size if strides is None else strides
+    h_o, pad_h = pool_geometry(h_i, p_h, str_h, mode)
+    w_o, pad_w = pool_geometry(w_i, p_w, str_w, mode)
+    return h_o, w_o, [(i, j, max(i * str_h - pad_h, 0), min(i * str_h - pad_h + p_h, h_i),
+                       max(j * str_w - pad_w, 0), min(j * str_w - pad_w + p_w, w_i))
+                      for i in range(h_o) for j in range(w_o)]
+
+
+def max_pool(inputs, pool_size=(2, 2), strides=None, mode="valid", out=None):
+    # the first window element, replaced by every later one that is larger (the comparisons of kernels.max_pool)
+    n, _, _, c = inputs.shape
+    h_o, w_o, windows = _pool_windows(inputs.shape, pool_size, strides, mode)
+    if out is None:
+        out = np.empty((n, h_o, w_o, c), dtype="float32")
+    for i, j, ys, ye, xs, xe in windows:
+        m = inputs[:, ys, xs, :].copy()
+        for y in range(ys, ye):
+            for x in range(xs, xe):
+                v = inputs[:, y, x, :]
+                np.copyto(m, v, where=v > m)
+        out[:, i, j, :] = m
+    return out
+
+
+def avg_pool(inputs, pool_size=(2, 2), strides=None, mode="valid", flush=0, out=None, profile=None):
+    # sequential flushed sum over the window, then the flushed division, like kernels.avg_pool
+    n, _, _, c = inputs.shape
+    h_o, w_o, windows = _pool_windows(inputs.shape, pool_size, strides, mode)
+    if out is None:
+        out = np.empty((n, h_o, w_o, c), dtype="float32")
+    hpp = _hist(profile, PROFILE_PRODUCTS)
+    hpa = _hist(profile, PROFILE_ACCUMULATORS)
+    acc = np.empty((n, c), dtype="float32")
+    for i, j, ys, ye, xs, xe in windows:
+        acc.fill(0)
+        for y in range(ys, ye):
+            for x in range(xs, xe):
+                np.add(acc, inputs[:, y, x, :], out=acc)
+                _fz(acc, flush, hpa, out=acc)
+        out[:, i, j, :] = _fz(acc / np.float32((ye - ys) * (xe - xs)), flush, hpp)
+    return out
+
+
+def set_num_threads(n):
+    # the numpy kernels run on the calling thread, accepted for compatibility
+    pass
+
+
+def get_max_threads():
+    return 1
@@ -0,0 +1,181 @@
+import numpy as np
+from fastconv.numpy_backend import TILE
+
+
+# Sampled flush-rate estimation for the matrix kernels. tiled_matmul and kn2row_shift_add are computed unflushed
+# through numpy (BLAS for the matmul), and the flushing steps of the cython kernels are replayed only for a random
+# subset of work units: one (row, column, 64-wide k-block) of the matmul, one (filter, output position) of the
+# shift-add. Each unit starts from unflushed values (e.g. the sum of the earlier k-blocks), with the ones below the
+# threshold zeroed as the kernel would have flushed them when they were stored. The number of fz checks is known
+# exactly, the number of flushes is estimated from the sampled units with its variance, so FlushEstimate reports a
+# flush rate with a confidence interval.
+
+Z95 = 1.959963984540054  # two-sided 95% normal quantile
+
+
+def _threshold(flush):
+    # a non-zero float32 has a biased exponent below flush iff its magnitude is below 2^(flush - 127)
+    return np.float32(2.0 ** (flush - 127))
+
+
+def _flushed(v, thr):
+    return (v != 0) & (np.abs(v) < thr)
+
+
+class FlushEstimate:
+    # flushes and fz checks of one layer: exactly counted parts plus estimated totals of sampled units
+
+    def __init__(self):
+        self.checks = 0
+        self.exact = 0
+        self.sampled = 0.0
+        self.variance = 0.0
+        self.units = 0
+
+    def add_exact(self, flushes, checks):
+        self.exact += int(flushes)
+        self.checks += int(checks)
+
+    def add_units(self, flushes, population, checks):
+        # flushes: flush count of each sampled unit, drawn uniformly without replacement out of population units
+        # that perform `checks` fz checks in total
+        n = len(flushes)
+        self.checks += int(checks)
+        self.units += n
+        if n == 0:
+            return
+        flushes = np.asarray(flushes, dtype=np.float64)
+        self.sampled += population * flushes.mean()
+        if n > 1:
+            self.variance += population ** 2 * flushes.var(ddof=1) / n * (1 - n / population)
+
+    def add(self, other):
+        # combine with the estimate of a disjoint set of checks
+        self.checks += other.checks
+        self.exact += other.exact
+        self.sampled += other.sampled
+        self.variance += other.variance
+        self.units += other.units
+
+    @property
+    def flushes(self):
+        return self.exact + self.sampled
+
+    @property
+    def rate(self):
+        return self.flushes / self.checks if self.checks else 0.0
+
+    def interval(self, z=Z95):
+        # normal approximation confidence interval of the flush rate
+        if not self.checks:
+            return 0.0, 0.0
+        half = z * np.sqrt(self.variance) / self.checks
+        return max(self.rate - half, 0.0), min(self.rate + half, 1.0)
+
+
+def _choose(rng, population, samples):
+    return rng.choice(population, size=min(samples, population), replace=False)
+
+
+def sampled_matmul(a, b, flush, estimate, samples=128, rng=None):
+    # a @ b without flushing, estimate: FlushEstimate of the flushes tiled_matmul would have caused
+    rng = rng if rng is not None else np.random.default_rng()
+    a = np.ascontiguousarray(a, dtype="float32")
+    b = np.asarray(b, dtype="float32")
+    out = np.matmul(a, b)
+    rows, inner = a.shape
+    cols = b.shape[1]
+    km = (inner + TILE - 1) // TILE
+    if flush == 0:
+        return out
+    thr = _threshold(flush)
+    units = _choose(rng, rows * cols * km, samples)
+    x, rest = np.divmod(units, cols * km)
+    y, kb = np.divmod(rest, km)
+    # products of the sampled (row, column) pairs in k-block layout, zero-padded to whole blocks
+    prod = np.zeros((len(units), km * TILE), dtype="float32")
+    np.multiply(a[x], b[:, y].T, out=prod[:, :inner])
+    blocks = prod.reshape((len(units), km, TILE))
+    # unflushed result before block kb: block sums added up in block order
+    block_sums = np.cumsum(blocks, axis=2, dtype="float32")[:, :, -1]
+    before = np.concatenate([np.zeros((len(units), 1), dtype="float32"),
+                             np.cumsum(block_sums, axis=1, dtype="float32")[:, :-1]], axis=1)
+    res = before[np.arange(len(units)), kb]
+    res[_flushed(res, thr)] = 0  # flushed by the kernel when it was accumulated
+    p = blocks[np.arange(len(units)), kb]
+    valid = kb[:, None] * TILE + np.arange(TILE)[None, :] < inner
+    counts = np.zeros(len(units), dtype=np.int64)
+    s = np.zeros(len(units), dtype="float32")
+    for z in range(TILE):
+        pz = p[:, z]
+        f = _flushed(pz, thr) & valid[:, z]
+        counts += f
+        s = s + np.where(f, np.float32(0), pz) * valid[:, z]
+        f = _flushed(s, thr) & valid[:, z]
+        counts += f
+        s[f] = 0
+    counts += _flushed(res + s, thr)
+    estimate.add_units(counts, rows * cols * km, rows * cols * (2 * inner + km))
+    return out
+
+
+def _offsets(kh, kw, w_p):
+    # column offset of the product row block of each kernel pixel, in shift-add order
+    return [(y - (kh - 1) // 2) * w_p + x - (kw - 1) // 2 for y in range(kh) for x in range(kw)]
+
+
+def sampled_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, estimate, samples=128, rng=None):
+    # kn2row_shift_add without flushing, estimate: FlushEstimate of the flushes it would have caused
+    rng = rng if rng is not None else np.random.default_rng()
+    n_f = result.shape[0]
+    samp_width = h_p * w_p
+    result.fill(0)
+    offsets = _offsets(kh, kw, w_p)
+    for s in range(n):
+        samp_off = s * samp_width
+        for i, off in enumerate(offsets):
+            length = samp_width - abs(off)
+            res_start = samp_off + max(-off, 0)
+            r = result[:, res_start:res_start + length]
+            np.add(r, prod[i * n_f:(i + 1) * n_f, res_start + off:res_start + off + length], out=r)
+    if flush == 0:
+        return
+    thr = _threshold(flush)
+    units = _choose(rng, n_f * n * samp_width, samples)
+    f, col = np.divmod(units, n * samp_width)
+    pos = col % samp_width
+    r = np.zeros(len(units), dtype="float32")
+    counts = np.zeros(len(units), dtype=np.int64)
+    for i, off in enumerate(offsets):
+        valid = (pos + off >= 0) & (pos + off < samp_width)
+        v = prod[i * n_f + f, np.where(valid, col + off, col)]
+        # products below the threshold would have been flushed by tiled_matmul already
+        r = r + np.where(valid & ~_flushed(v, thr), v, np.float32(0))
+        flushed = _flushed(r, thr) & valid
+        counts += flushed
+        r[flushed] = 0
+    checks = n_f * n * sum(samp_width - abs(off) for off in offsets)
+    estimate.add_units(counts, n_f * n * samp_width, checks)
+
+
+def sampled_kn2row(inputs, kernel, mode="same", strides=(1, 1), flush=0, estimate=None, samples=128, rng=None):
+    # same steps as kernels.kn2row, inputs and kernel are expected to be flushed already
+    estimate = estimate if estimate is not None else FlushEstimate()
+    n, h_i, w_i, c = inputs.shape
+    kh, kw, _, n_f = kernel.shape
+    str_h, str_w = strides
+    pad_h = (kh - 1) // 2
+    pad_w = (kw - 1) // 2
+    if mode == "same":
+        in_padded = np.pad(inputs, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0)))
+    else:
+        in_padded = inputs
+    _, h_p, w_p, _ = in_padded.shape
+    in_mat = in_padded.transpose((3, 0, 1, 2)).reshape((c, -1))
+    kern_mat = kernel.transpose((0, 1, 3, 2)).reshape((-1, c))
+    prod = sampled_matmul(kern_mat, in_mat, flush, estimate, samples, rng)
+    result = np.empty((n_f, n * h_p * w_p), dtype='float32')
+    sampled_shift_add(prod, result, n, h_p, w_p, kh, kw, flush, estimate, samples, rng)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    return result.reshape((n_f, n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:-pad_h:str_h, s_w:-pad_w:str_w, :]
@@ -1,29 +1,43 @@
 from setuptools import Extension, setup
 from Cython.Build import cythonize
+import os
+import shutil
 import sys
 
+# The kernels in kernels.py are compiled once per instruction set, fastconv.py picks the best variant the CPU supports
+# at import time. Floating point contraction stays off in every variant (no fused multiply-adds the generic build
+# would not do), so all variants compute bit-identical results and flush counts.
 if sys.platform.startswith("win"):
     openmp_arg = '/openmp'
+    common_args = ['/O2', '/fp:precise']
+    isa_args = {
+        "generic": [],
+        "avx2": ['/arch:AVX2'],
+        "avx512": ['/arch:AVX512'],
+    }
 else:
     openmp_arg = '-fopenmp'
+    common_args = ['-O3', '-ffp-contract=off']
+    isa_args = {
+        "generic": [],
+        "avx2": ['-mavx2', '-mfma'],
+        "avx512": ['-mavx512f', '-mavx512cd', '-mavx512bw', '-mavx512dq', '-mavx512vl', '-mavx2', '-mfma'],
+    }
 
-
-ext_modules = [
-    Extension(
-        "*",
-        ["fastconv.py"],
-        extra_compile_args=[openmp_arg],
-        extra_link_args=[openmp_arg],
-    ),
-    Extension(
-        "*",
-        ["fastconv.py"],
-        extra_compile_args=[openmp_arg],
+# every variant needs its own module name, so each is built from its own copy of the source
+os.makedirs("build/isa", exist_ok=True)
+ext_modules = []
+for isa, args in isa_args.items():
+    source = "build/isa/_kernels_%s.py" % isa
+    shutil.copyfile("kernels.py", source)
+    ext_modules.append(Extension(
+        "_kernels_%s" % isa,
+        [source],
+        extra_compile_args=[openmp_arg] + common_args + args,
         extra_link_args=[openmp_arg],
-    )
-]
+    ))
 
 
 setup(
     ext_modules=cythonize(ext_modules),
-)
\ No newline at end of file
+)
@@ -0,0 +1,128 @@
+import time
+import argparse
+import numpy as np
+from fastconv.backends import backend, get_flush_count
+from fastconv.sampling import FlushEstimate, sampled_matmul, sampled_shift_add
+from inference_plan import trace_model
+
+
+# Quick flush-rate screening: runs an inference plan with the matrix kernels of conv and dense layers in sampled
+# estimation mode (see fastconv/sampling.py) and the cheap elementwise flushes (layer inputs, bias, normalisation,
+# residual adds, pooling) counted exactly. Reports the flush rate (flushes per fz check) of every layer with a
+# confidence interval. Conv and dense outputs are passed on unflushed, so the rates describe each layer on the
+# activations of the unflushed network.
+
+
+def _exact(estimate, fn, checks):
+    # runs fn and books the flushes it caused as exactly counted
+    before = get_flush_count()
+    result = fn()
+    estimate.add_exact(get_flush_count() - before, checks)
+    return result
+
+
+def _conv(op, x, flush, est, samples, rng):
+    p = op.params
+    n, h, w, c = x.shape
+    pad_h = (p["kh"] - 1) // 2
+    pad_w = (p["kw"] - 1) // 2
+    str_h, str_w = p["strides"]
+    x = _exact(est, lambda: backend().fz_arr(x, flush), x.size)
+    in_mat = np.pad(x, ((0, 0), (pad_h, pad_h), (pad_w, pad_w), (0, 0))).transpose((3, 0, 1, 2))
+    h_p, w_p = in_mat.shape[2:]
+    prod = sampled_matmul(op.arrays["kern_mat"], in_mat.reshape((c, -1)), flush, est, samples, rng)
+    result = np.empty((p["filters"], n * h_p * w_p), dtype="float32")
+    sampled_shift_add(prod, result, n, h_p, w_p, p["kh"], p["kw"], flush, est, samples, rng)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    out = result.reshape((p["filters"], n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:-pad_h:str_h,
+                                                                                s_w:-pad_w:str_w, :]
+    if "bias" in op.arrays:
+        out = out + op.arrays["bias"]
+        out = _exact(est, lambda: backend().fz_arr(out, flush), out.size)
+    return np.ascontiguousarray(out)
+
+
+def _dense(op, x, flush, est, samples, rng):
+    x = _exact(est, lambda: backend().fz_arr(x, flush), x.size)
+    out = sampled_matmul(x, op.arrays["kernel"], flush, est, samples, rng)
+    if "bias" in op.arrays:
+        out = out + op.arrays["bias"]
+        out = _exact(est, lambda: backend().fz_arr(out, flush), out.size)
+    return out
+
+
+def _run(op, ins, est, samples, rng):
+    # output of one op, est: FlushEstimate of the op
+    flush = op.params.get("flush", 0)
+    x = np.ascontiguousarray(ins[0], dtype="float32")
+    if op.kind == "conv":
+        return _conv(op, x, flush, est, samples, rng)
+    if op.kind == "dense":
+        return _dense(op, x, flush, est, samples, rng)
+    if op.kind == "affine":
+        x = _exact(est, lambda: backend().fz_arr(x, flush), x.size)
+        return _exact(est, lambda: backend().channel_affine(x, op.arrays["scale"], op.arrays["offset"], flush),
+                      2 * x.size)
+    if op.kind == "add":
+        out = _exact(est, lambda: backend().fz_arr(x, flush), x.size)
+        for y in ins[1:]:
+            y = _exact(est, lambda: backend().fz_arr(np.ascontiguousarray(y), flush), y.size)
+            out = _exact(est, lambda: backend().elem_add(out, y, flush), y.size)
+        return out
+    if op.kind in ("max_pool", "avg_pool"):
+        p = op.params
+        x = _exact(est, lambda: backend().fz_arr(x, flush), x.size)
+        if op.kind == "max_pool":
+            return backend().max_pool(x, p["pool_size"], p["strides"], p["mode"])
+        before = get_flush_count()
+        out = backend().avg_pool(x, p["pool_size"], p["strides"], p["mode"], flush)
+        # one accumulation per window element and the division, windows clipped at the border counted in full
+        est.add_exact(get_flush_count() - before, out.size * (int(np.prod(p["pool_size"])) + 1))
+        return out
+    if op.kind == "relu":
+        return np.maximum(x, 0)
+    if op.kind == "softmax":
+        e = np.exp(x - x.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+    raise ValueError("unknown op kind " + op.kind)
+
+
+def estimate_plan(plan, x, samples=128, batch_size=50, seed=0):
+    # {op name: FlushEstimate} of the ops with a flush level, samples: sampled units per kernel call and batch
+    rng = np.random.default_rng(seed)
+    estimates = {op.name: FlushEstimate() for op in plan.ops if op.params.get("flush", 0)}
+    for i in range(0, len(x), batch_size):
+        values = {plan.storage(plan.input_name): np.asarray(x[i:i + batch_size], dtype="float32")}
+        for op in plan.ops:
+            est = estimates.get(op.name, FlushEstimate())
+            ins = [values[plan.storage(n)].reshape((-1,) + tuple(plan.shapes[n])) for n in op.inputs]
+            values[plan.storage(op.output)] = _run(op, ins, est, samples, rng)
+    return estimates
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtype", default="resnet")
+    parser.add_argument("--flush", type=int, default=113)
+    parser.add_argument("--n", type=int, default=500, help="test images to run")
+    parser.add_argument("--samples", type=int, default=128, help="sampled units per kernel call and batch")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import cifar10cache
+    from cifar10models import build_model
+    model = build_model(args.modtype, load=True, flush=args.flush)
+    plan = trace_model(model.model)
+    start = time.perf_counter()
+    estimates = estimate_plan(plan, cifar10cache.normalized("test")[:args.n], args.samples, args.batch_size,
+                              args.seed)
+    elapsed = time.perf_counter() - start
+    total = FlushEstimate()
+    for name, est in estimates.items():
+        lo, hi = est.interval()
+        print("%-24s %6.3f%%  [%6.3f%%, %6.3f%%]  %d units" % (name, 100 * est.rate, 100 * lo, 100 * hi, est.units))
+        total.add(est)
+    lo, hi = total.interval()
+    print("%-24s %6.3f%%  [%6.3f%%, %6.3f%%]  %.1f s" % ("total", 100 * total.rate, 100 * lo, 100 * hi, elapsed))
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+# Flushed-value tracking between emulated layers. A value is "flushed at level L" if none of its non-zero elements has
+# a biased exponent below L, so flushing it again at any level <= L is a no-op that flushes nothing. The outputs of
+# the emulated kernels are flushed at the layer's level, and ReLU, max pooling, flattening and dropout only zero,
+# select, reshape or scale up existing values, so they keep the level of their input. The levels are derived once
+# from the model graph (tag_model for keras models, trace_model for inference plans), and an emulated layer skips the
+# flush pass over an input that is already flushed at its own level or above. Flush counts stay the same, and when
+# profiling the input is still histogrammed.
+
+
+def model_graph(model):
+    # (connections [(layer, input value names, output value name)] in execution order, per-sample value shapes,
+    #  input name, output name) of a built keras Sequential or functional model with one input and output
+    from keras import Sequential
+
+    shapes = {}
+    connections = []
+    if isinstance(model, Sequential):
+        input_name = "input"
+        shapes[input_name] = tuple(model.inputs[0].shape[1:])
+        prev = input_name
+        for layer in model.layers:
+            connections.append((layer, [prev], layer.name))
+            shapes[layer.name] = tuple(layer.compute_output_shape((None,) + shapes[prev])[1:])
+            prev = layer.name
+        output_name = prev
+    else:
+        tensor_names = {}
+        for layer in model.layers:
+            node = layer._inbound_nodes[0]
+            inputs = [tensor_names[id(t)] for t in node.input_tensors]
+            tensor_names[id(node.output_tensors[0])] = layer.name
+            shapes[layer.name] = tuple(node.output_tensors[0].shape[1:])
+            if inputs:
+                connections.append((layer, inputs, layer.name))
+        input_name = tensor_names[id(model.inputs[0])]
+        output_name = tensor_names[id(model.outputs[0])]
+    return connections, shapes, input_name, output_name
+
+
+def _emulated(layer):
+    return not getattr(layer, "orig", True) and hasattr(layer, "flush")
+
+
+def output_level(layer, in_levels, in_shapes):
+    # level the output of layer is flushed at in inference, 0 if nothing is known
+    from keras import layers
+
+    if isinstance(layer, (layers.InputLayer, layers.Flatten, layers.Dropout)) or \
+            (isinstance(layer, layers.Activation) and layer.activation.__name__ in ("linear", "relu")):
+        return in_levels[0]
+    if isinstance(layer, layers.MaxPooling2D):
+        # the emulated layer flushes its input first
+        return max(layer.flush, in_levels[0]) if _emulated(layer) else in_levels[0]
+    if not _emulated(layer):
+        return 0
+    # emulated layers that fall back to the stock implementation for some configurations
+    if isinstance(layer, layers.BatchNormalization) and layer.axis not in (-1, len(in_shapes[0])):
+        return 0
+    if isinstance(layer, layers.Add) and any(s != in_shapes[0] for s in in_shapes):
+        return 0
+    if isinstance(layer, layers.Rescaling):
+        try:
+            np.broadcast_to(np.asarray(layer.scale), (in_shapes[0][-1],))
+            np.broadcast_to(np.asarray(layer.offset), (in_shapes[0][-1],))
+        except ValueError:
+            return 0
+    if isinstance(layer, (layers.Conv2D, layers.Dense)) and layer.activation.__name__ not in ("linear", "relu"):
+        return 0
+    if isinstance(layer, (layers.Conv2D, layers.Dense, layers.BatchNormalization, layers.Rescaling, layers.Add,
+                          layers.AveragePooling2D)):
+        return layer.flush
+    return 0
+
+
+def value_levels(connections, input_name, shapes):
+    # value name -> level it is flushed at, the model input is not flushed
+    levels = {input_name: 0}
+    for layer, inputs, output in connections:
+        levels[output] = output_level(layer, [levels[n] for n in inputs], [shapes[n] for n in inputs])
+    return levels
+
+
+def tag_model(model):
+    # stores the levels of their inputs on the emulated layers, to be redone when flush levels change
+    connections, shapes, input_name, _ = model_graph(model)
+    levels = value_levels(connections, input_name, shapes)
+    for layer, inputs, _ in connections:
+        if _emulated(layer):
+            layer.input_flushed = [levels[n] for n in inputs]
+
+
+def input_flush(layer, index=0, training=None):
+    # flush level for the pass over input `index` of an emulated layer, 0 if that input is flushed already
+    # in training, layers in between may run their stock implementations, so nothing is skipped
+    levels = getattr(layer, "input_flushed", None)
+    if training or not levels or levels[index] < layer.flush:
+        return layer.flush
+    return 0
@@ -0,0 +1,547 @@
+import numpy as np
+from fastconv.backends import backend, small_batch, add_flush_count, PROFILE_WEIGHTS, PROFILE_ACTIVATIONS, \
+    PROFILE_ACCUMULATORS
+from exponent_profiler import layer_profile, weight_profile
+
+
+# Static inference plans: a built keras model is traced once into a flat list of ops on named values, kernels are
+# chosen per op, weights are flushed and packed ahead of time, and all intermediate buffers (activations and kernel
+# scratch space) are laid out in one arena according to their liveness. The executor then replays the op list per
+# batch without allocating any arrays. Executors for small batches (see fastconv.backends.SMALL_BATCH) run the
+# latency kernels gemv/direct_conv instead of tiled_matmul/kn2row, with the constant state these need (e.g. conv
+# kernels in their keras layout) prepared when the executor is created.
+
+ALIGN = 16  # arena offsets are multiples of this many float32 elements (64 bytes)
+
+
+class Op:
+    # kind: one of OP_KINDS, inputs/output: value names, params: plain python values, arrays: constant float32 arrays
+    # ops do not reference keras objects or the batch size
+
+    def __init__(self, kind, name, inputs, output, params=None, arrays=None):
+        self.kind = kind
+        self.name = name
+        self.inputs = list(inputs)
+        self.output = output
+        self.params = params if params is not None else {}
+        self.arrays = arrays if arrays is not None else {}
+
+
+class InferencePlan:
+    # shapes: value name -> per-sample shape, aliases: value name -> name of the value whose memory it reuses
+
+    def __init__(self, ops, shapes, aliases, input_name, output_name):
+        self.ops = ops
+        self.shapes = shapes
+        self.aliases = aliases
+        self.input_name = input_name
+        self.output_name = output_name
+
+    def storage(self, name):
+        while name in self.aliases:
+            name = self.aliases[name]
+        return name
+
+    def const_flushes(self, first=0, last=None):
+        # flushes of the pre-flushed constants, accounted once per batch like the keras layers do
+        return sum(op.params.get("const_flushes", 0) for op in self.ops[first:last])
+
+    def boundary(self, first=0, last=None):
+        # storage values an op range reads from before it, and values it produces for ops after it / the plan output
+        last = len(self.ops) if last is None else last
+        produced = [self.storage(op.output) for op in self.ops[first:last]]
+        inputs = []
+        for op in self.ops[first:last]:
+            for name in op.inputs:
+                name = self.storage(name)
+                if name not in produced and name not in inputs:
+                    inputs.append(name)
+        needed = {self.storage(n) for op in self.ops[last:] for n in op.inputs}
+        needed.add(self.storage(self.output_name))
+        outputs = [name for name in produced if name in needed]
+        return inputs, outputs
+
+    def buffers(self, batch_size, first=0, last=None, external=()):
+        # arena buffers of an op range with their size and live interval [first op, last op] relative to the range,
+        # range inputs are live from -1, range outputs until the end, external values are left out
+        ops = self.ops[first:last]
+        inputs, outputs = self.boundary(first, last)
+        buffers = {}
+        for name in inputs:
+            if name not in external:
+                buffers[name] = [batch_size * int(np.prod(self.shapes[name])), -1, -1]
+        for i, op in enumerate(ops):
+            for name in op.inputs:
+                if self.storage(name) in buffers:
+                    buffers[self.storage(name)][2] = i
+            if op.output not in external:
+                buffers[op.output] = [batch_size * int(np.prod(self.shapes[op.output])), i, i]
+            for s_name, s_shape in OP_KINDS[op.kind][0](op, batch_size, [self.shapes[n] for n in op.inputs]).items():
+                buffers[(op.name, s_name)] = [int(np.prod(s_shape)), i, i]
+        for name in outputs:
+            if name in buffers:
+                buffers[name][2] = len(ops)
+        return {k: tuple(v) for k, v in buffers.items()}
+
+    def layout(self, batch_size, first=0, last=None, external=()):
+        # greedy best-fit placement, largest buffers first: returns (offsets, total arena size in elements)
+        buffers = self.buffers(batch_size, first, last, external)
+        placed = []
+        offsets = {}
+        total = 0
+        for key, (size, start, end) in sorted(buffers.items(), key=lambda b: (-b[1][0], b[1][1])):
+            size = (size + ALIGN - 1) // ALIGN * ALIGN
+            conflicts = sorted((o, o + s) for o, s, st, en in placed if st <= end and start <= en)
+            offset = 0
+            best = None
+            for c_start, c_end in conflicts:
+                gap = c_start - offset
+                if gap >= size and (best is None or gap < best[1]):
+                    best = (offset, gap)
+                offset = max(offset, c_end)
+            offset = best[0] if best is not None else offset
+            placed.append((offset, size, start, end))
+            offsets[key] = offset
+            total = max(total, offset + size)
+        return offsets, total
+
+
+class PlanExecutor:
+    # runs the ops [first, last) of a plan, external maps storage value names to caller-owned arrays (e.g. the
+    # buffers between pipeline stages), everything else lives in the executor's own arena, which can be shared with
+    # other executors of the same range that never run at the same time
+
+    def __init__(self, plan, batch_size, first=0, last=None, external=None, arena=None):
+        self.plan = plan
+        self.batch_size = batch_size
+        external = external if external is not None else {}
+        offsets, total = plan.layout(batch_size, first, last, external)
+        if arena is None:
+            arena = np.empty(total, dtype="float32")
+        assert len(arena) >= total
+        self.arena = arena
+
+        def view(key, shape):
+            size = int(np.prod(shape))
+            if key in external:
+                return external[key].reshape(-1)[:size].reshape(shape)
+            return self.arena[offsets[key]:offsets[key] + size].reshape(shape)
+
+        self.values = {}
+        for name, shape in plan.shapes.items():
+            if plan.storage(name) in offsets or plan.storage(name) in external:
+                self.values[name] = view(plan.storage(name), (batch_size,) + tuple(shape))
+        self.steps = []
+        for op in plan.ops[first:last]:
+            in_shapes = [plan.shapes[n] for n in op.inputs]
+            scratch = {s_name: view((op.name, s_name), s_shape)
+                       for s_name, s_shape in OP_KINDS[op.kind][0](op, batch_size, in_shapes).items()}
+            scratch.update(OP_KINDS[op.kind][2](op, batch_size))
+            self.steps.append((OP_KINDS[op.kind][1], op, [self.values[n] for n in op.inputs],
+                               self.values[op.output], scratch))
+        self.const_flushes = plan.const_flushes(first, last)
+
+    def execute(self):
+        for fn, op, ins, out, scratch in self.steps:
+            if op.arrays:
+                _profile_weights(op)
+            fn(op, ins, out, scratch)
+        if self.const_flushes:
+            add_flush_count(self.const_flushes)
+
+    def run(self, x):
+        # returns a view into the arena, only valid until the next call
+        np.copyto(self.values[self.plan.input_name], x)
+        self.execute()
+        return self.values[self.plan.output_name]
+
+    def predict(self, x):
+        n = len(x)
+        result = np.empty((n,) + tuple(self.plan.shapes[self.plan.output_name]), dtype="float32")
+        full = n - n % self.batch_size
+        for i in range(0, full, self.batch_size):
+            result[i:i + self.batch_size] = self.run(x[i:i + self.batch_size])
+        if full < n:
+            # the remainder gets its own (smaller) arena, padding the batch would change the flush counts
+            result[full:] = PlanExecutor(self.plan, n - full).run(x[full:])
+        return result
+
+
+def _flush_inplace(a, flush, prof=None, kind=PROFILE_ACTIVATIONS):
+    if flush or prof is not None:
+        backend().fz_arr(a, flush, out=a, profile=prof, kind=kind)
+
+
+def _input_flush(op, index=0):
+    # flush level for the pass over input `index`, 0 if it is flushed at the op's level already (see flush_levels.py)
+    levels = op.params.get("input_flushed")
+    if levels and levels[index] >= op.params["flush"]:
+        return 0
+    return op.params["flush"]
+
+
+def _flush_input(x, flush, scratch, prof):
+    # flushed copy of an op input in the scratch space, unflushed inputs are only histogrammed when profiling
+    if flush:
+        return backend().fz_arr(x, flush, out=scratch["x"], profile=prof)
+    if prof is not None:
+        backend().fz_arr(x, 0, profile=prof)
+    return x
+
+
+def _profile_weights(op):
+    # constants are flushed at trace time, so this records their flushed values
+    for key, a in op.arrays.items():
+        prof = weight_profile(op.name, key)
+        if prof is not None:
+            backend().fz_arr(a, 0, profile=prof, kind=PROFILE_WEIGHTS)
+
+
+def _no_scratch(op, n, in_shapes):
+    return {}
+
+
+def _no_state(op, n):
+    return {}
+
+
+def _direct(op, n):
+    return op.params["kernel"] == "kn2row" and small_batch(n)
+
+
+def _conv_scratch(op, n, in_shapes):
+    h, w, c = in_shapes[0]
+    p = op.params
+    h_p = h + 2 * ((p["kh"] - 1) // 2)
+    w_p = w + 2 * ((p["kw"] - 1) // 2)
+    if _direct(op, n):
+        scratch = {"result": (n, h_p * w_p, p["filters"]), "sums": (2, n, p["filters"])}
+        if _input_flush(op):
+            scratch["x"] = (n, h, w, c)
+        return scratch
+    return {
+        "in_mat": (c, n, h_p, w_p),
+        "prod": (p["kh"] * p["kw"] * p["filters"], n * h_p * w_p),
+        "result": (p["filters"], n * h_p * w_p),
+    }
+
+
+def _conv_state(op, n):
+    # direct_conv takes the kernel in its keras layout
+    if not _direct(op, n):
+        return {}
+    p = op.params
+    kern_mat = op.arrays["kern_mat"]
+    kernel = kern_mat.reshape((p["kh"], p["kw"], p["filters"], kern_mat.shape[1])).transpose((0, 1, 3, 2))
+    return {"kernel": np.ascontiguousarray(kernel)}
+
+
+def _direct_conv_run(op, x, out, scratch, prof):
+    p = op.params
+    flush = p["flush"]
+    x = _flush_input(x, _input_flush(op), scratch, prof)
+    result = backend().direct_conv(x, scratch["kernel"], "same", p["strides"], flush, profile=prof,
+                                   result=scratch["result"], scratch=scratch["sums"])
+    if "bias" in op.arrays:
+        np.add(result, op.arrays["bias"], out=out)
+        _flush_inplace(out, flush, prof, PROFILE_ACCUMULATORS)
+    else:
+        np.copyto(out, result)
+
+
+def _conv_run(op, ins, out, scratch):
+    # same steps as fastconv.kn2row, but in place on the arena
+    x, = ins
+    p = op.params
+    flush = p["flush"]
+    prof = layer_profile(op.name)
+    if "kernel" in scratch:
+        return _direct_conv_run(op, x, out, scratch, prof)
+    n, h, w, c = x.shape
+    pad_h = (p["kh"] - 1) // 2
+    pad_w = (p["kw"] - 1) // 2
+    str_h, str_w = p["strides"]
+    in_mat = scratch["in_mat"]
+    _, _, h_p, w_p = in_mat.shape
+    in_mat[:, :, :pad_h, :] = 0
+    in_mat[:, :, pad_h + h:, :] = 0
+    in_mat[:, :, :, :pad_w] = 0
+    in_mat[:, :, :, pad_w + w:] = 0
+    in_mat[:, :, pad_h:pad_h + h, pad_w:pad_w + w] = x.transpose((3, 0, 1, 2))
+    in_flat = in_mat.reshape((c, -1))
+    if prof is not None:
+        # like the keras layer, histogram the input itself, not the zero padding around it
+        backend().fz_arr(x, 0, profile=prof)
+    _flush_inplace(in_flat, _input_flush(op))
+    if p["kernel"] == "kn2row":
+        backend().tiled_matmul(op.arrays["kern_mat"], in_flat, flush, out=scratch["prod"], profile=prof)
+    else:
+        np.matmul(op.arrays["kern_mat"], in_flat, out=scratch["prod"])
+    result = scratch["result"]
+    backend().kn2row_shift_add(scratch["prod"], result, n, h_p, w_p, p["kh"], p["kw"], flush, profile=prof)
+    s_h = pad_h + 1 if str_h > 1 else pad_h
+    s_w = pad_w + 1 if str_w > 1 else pad_w
+    cropped = result.reshape((p["filters"], n, h_p, w_p)).transpose((1, 2, 3, 0))[:, s_h:h_p - pad_h:str_h,
+                                                                                   s_w:w_p - pad_w:str_w, :]
+    if "bias" in op.arrays:
+        np.add(cropped, op.arrays["bias"], out=out)
+        _flush_inplace(out, flush, prof, PROFILE_ACCUMULATORS)
+    else:
+        np.copyto(out, cropped)
+
+
+def _dense_scratch(op, n, in_shapes):
+    scratch = {"x": (n,) + tuple(in_shapes[0])} if _input_flush(op) else {}
+    if op.params["kernel"] == "tiled_matmul" and small_batch(n):
+        scratch["sums"] = (op.arrays["kernel"].shape[1],)  # partial sums of gemv
+    return scratch
+
+
+def _dense_run(op, ins, out, scratch):
+    x, = ins
+    flush = op.params["flush"]
+    prof = layer_profile(op.name)
+    x = _flush_input(x, _input_flush(op), scratch, prof)
+    if "sums" in scratch:
+        backend().gemv(x, op.arrays["kernel"], flush, out=out, profile=prof, scratch=scratch["sums"])
+    elif op.params["kernel"] == "tiled_matmul":
+        backend().tiled_matmul(x, op.arrays["kernel"], flush, out=out, profile=prof)
+    else:
+        np.matmul(x, op.arrays["kernel"], out=out)
+    if "bias" in op.arrays:
+        np.add(out, op.arrays["bias"], out=out)
+        _flush_inplace(out, flush, prof, PROFILE_ACCUMULATORS)
+
+
+def _affine_run(op, ins, out, scratch):
+    flush = op.params["flush"]
+    prof = layer_profile(op.name)
+    backend().fz_arr(ins[0], _input_flush(op), out=out, profile=prof)
+    backend().channel_affine(out, op.arrays["scale"], op.arrays["offset"], flush, out=out, profile=prof)
+
+
+def _add_scratch(op, n, in_shapes):
+    return {"x": (n,) + tuple(in_shapes[1])} if any(_input_flush(op, i) for i in range(1, len(in_shapes))) else {}
+
+
+def _add_run(op, ins, out, scratch):
+    flush = op.params["flush"]
+    prof = layer_profile(op.name)
+    backend().fz_arr(ins[0], _input_flush(op), out=out, profile=prof)
+    for i, x in enumerate(ins[1:], 1):
+        x = _flush_input(x, _input_flush(op, i), scratch, prof)
+        backend().elem_add(out, x, flush, out=out, profile=prof)
+
+
+def _pool_scratch(op, n, in_shapes):
+    return {"x": (n,) + tuple(in_shapes[0])} if _input_flush(op) else {}
+
+
+def _pool_run(op, ins, out, scratch):
+    x, = ins
+    p = op.params
+    prof = layer_profile(op.name)
+    x = _flush_input(x, _input_flush(op), scratch, prof)
+    if op.kind == "max_pool":
+        backend().max_pool(x, p["pool_size"], p["strides"], p["mode"], out=out)
+    else:
+        backend().avg_pool(x, p["pool_size"], p["strides"], p["mode"], p["flush"], out=out, profile=prof)
+
+
+def _relu_run(op, ins, out, scratch):
+    np.maximum(ins[0], 0, out=out)
+
+
+def _softmax_scratch(op, n, in_shapes):
+    return {"m": (n, 1)}
+
+
+def _softmax_run(op, ins, out, scratch):
+    m = scratch["m"]
+    np.max(ins[0], axis=-1, keepdims=True, out=m)
+    np.subtract(ins[0], m, out=out)
+    np.exp(out, out=out)
+    np.sum(out, axis=-1, keepdims=True, out=m)
+    np.divide(out, m, out=out)
+
+
+OP_KINDS = {
+    # kind: (scratch shapes for a batch size, run, constant state for a batch size), run finds both in its scratch
+    "conv": (_conv_scratch, _conv_run, _conv_state),
+    "dense": (_dense_scratch, _dense_run, _no_state),
+    "affine": (_no_scratch, _affine_run, _no_state),
+    "add": (_add_scratch, _add_run, _no_state),
+    "max_pool": (_pool_scratch, _pool_run, _no_state),
+    "avg_pool": (_pool_scratch, _pool_run, _no_state),
+    "relu": (_no_scratch, _relu_run, _no_state),
+    "softmax": (_softmax_scratch, _softmax_run, _no_state),
+}
+
+
+def _layer_flush(layer):
+    # emulated layers carry use_original/denorm_flush_zero, stock keras layers run unflushed
+    if getattr(layer, "orig", True):
+        return 0
+    return layer.flush
+
+
+def _flushed(a, flush):
+    # flush a constant ahead of time, returns the array and the number of flushes it causes per batch
+    # the count is not committed here, executors add it once per batch (as the keras layers flush their weights
+    # on every call)
+    a = np.array(a, dtype="float32", order="C")
+    if flush == 0:
+        return a, 0
+    mask = (a.view(np.uint32) & 0x7FFFFFFF) >> 23 < flush
+    count = int(np.count_nonzero(mask & (a != 0)))
+    a[mask] = 0
+    return a, count
+
+
+def _trace_layer(layer, inputs, output, shapes, aliases):
+    from keras import layers
+
+    name = layer.name
+    flush = _layer_flush(layer)
+    if isinstance(layer, (layers.InputLayer, layers.Dropout, layers.RandomZoom, layers.RandomRotation,
+                          layers.RandomFlip, layers.Flatten)) or \
+            (isinstance(layer, layers.Activation) and layer.activation.__name__ == "linear"):
+        aliases[output] = inputs[0]  # no-ops in inference, flatten is a reshape of a contiguous buffer
+        return None
+    if isinstance(layer, layers.Activation) and layer.activation.__name__ in ("relu", "softmax"):
+        return Op(layer.activation.__name__, name, inputs, output)
+    if isinstance(layer, layers.Conv2D):
+        if layer.data_format != "channels_last" or layer.padding != "same" or layer.rank != 2 \
+                or layer.groups != 1 or tuple(layer.dilation_rate) != (1, 1) \
+                or layer.activation.__name__ != "linear":
+            raise ValueError("unsupported convolution configuration in layer " + name)
+        kh, kw, c, n_f = layer.kernel.shape
+        kernel, count = _flushed(layer.kernel.numpy(), flush)
+        arrays = {"kern_mat": np.ascontiguousarray(kernel.transpose((0, 1, 3, 2)).reshape((-1, c)))}
+        if layer.use_bias:
+            arrays["bias"], b_count = _flushed(layer.bias.numpy(), flush)
+            count += b_count
+        params = {"kh": kh, "kw": kw, "filters": n_f, "strides": tuple(layer.strides), "flush": flush,
+                  "kernel": "reference" if getattr(layer, "orig", True) else "kn2row", "const_flushes": count}
+        return Op("conv", name, inputs, output, params, arrays)
+    if isinstance(layer, layers.Dense):
+        if layer.activation.__name__ != "linear" or len(shapes[inputs[0]]) != 1:
+            raise ValueError("unsupported dense configuration in layer " + name)
+        arrays = {}
+        arrays["kernel"], count = _flushed(layer.kernel.numpy(), flush)
+        if layer.use_bias:
+            arrays["bias"], b_count = _flushed(layer.bias.numpy(), flush)
+            count += b_count
+        params = {"flush": flush, "kernel": "reference" if getattr(layer, "orig", True) else "tiled_matmul",
+                  "const_flushes": count}
+        return Op("dense", name, inputs, output, params, arrays)
+    if isinstance(layer, layers.BatchNormalization):
+        if layer.axis not in (-1, len(shapes[inputs[0]])):
+            raise ValueError("unsupported normalization axis in layer " + name)
+        inv = 1 / np.sqrt(layer.moving_variance.numpy() + np.float32(layer.epsilon))
+        if layer.scale:
+            inv = inv * layer.gamma.numpy()
+        offset = -layer.moving_mean.numpy() * inv
+        if layer.center:
+            offset = offset + layer.beta.numpy()
+        scale, count = _flushed(inv, flush)
+        offset, o_count = _flushed(offset, flush)
+        return Op("affine", name, inputs, output, {"flush": flush, "const_flushes": count + o_count},
+                  {"scale": scale, "offset": offset})
+    if isinstance(layer, layers.Rescaling):
+        c = shapes[inputs[0]][-1]
+        scale, count = _flushed(np.broadcast_to(np.asarray(layer.scale, dtype="float32"), (c,)), flush)
+        offset, o_count = _flushed(np.broadcast_to(np.asarray(layer.offset, dtype="float32"), (c,)), flush)
+        return Op("affine", name, inputs, output, {"flush": flush, "const_flushes": count + o_count},
+                  {"scale": scale, "offset": offset})
+    if isinstance(layer, layers.Add):
+        return Op("add", name, inputs, output, {"flush": flush})
+    if isinstance(layer, (layers.MaxPooling2D, layers.AveragePooling2D)):
+        if layer.data_format != "channels_last":
+            raise ValueError("unsupported pooling data format in layer " + name)
+        params = {"pool_size": tuple(layer.pool_size), "strides": tuple(layer.strides), "mode": layer.padding,
+                  "flush": flush}
+        return Op("max_pool" if isinstance(layer, layers.MaxPooling2D) else "avg_pool", name, inputs, output,
+                  params)
+    raise ValueError("layer " + name + " of type " + type(layer).__name__ + " cannot be planned")
+
+
+def trace_model(model):
+    # model: built keras Sequential or functional model with a single input and output
+    from flush_levels import model_graph, value_levels
+
+    aliases = {}
+    ops = []
+    connections, shapes, input_name, output_name = model_graph(model)
+    levels = value_levels(connections, input_name, shapes)
+    for layer, inputs, output in connections:
+        op = _trace_layer(layer, inputs, output, shapes, aliases)
+        if op is not None:
+            if op.params.get("flush"):
+                op.params["input_flushed"] = [levels[n] for n in inputs]
+            ops.append(op)
+    return InferencePlan(ops, shapes, aliases, input_name, output_name)
+
+
+def compile_plan(model, batch_size=50):
+    return PlanExecutor(trace_model(model), batch_size)
+
+
+def count_check(model, x, batch_size):
+    # flushes counted by the keras model and by a plan executor over the same batches, these must be equal
+    from fastconv.backends import flush_scope
+    with flush_scope() as keras_count:
+        for i in range(0, len(x), batch_size):
+            model.predict_on_batch(x[i:i + batch_size])
+    executor = compile_plan(model, batch_size)
+    with flush_scope() as plan_count:
+        executor.predict(x)
+    return keras_count.get(), plan_count.get()
+
+
+def profile_check(model, x, batch_size):
+    # layers whose exponent histograms differ between the keras model and a plan executor over the same batches,
+    # weights aside (the plan records its constants as flushed at trace time, see _profile_weights)
+    from exponent_profiler import ExponentProfiler
+    with ExponentProfiler() as keras_profile:
+        for i in range(0, len(x), batch_size):
+            model.predict_on_batch(x[i:i + batch_size])
+    executor = compile_plan(model, batch_size)
+    with ExponentProfiler() as plan_profile:
+        executor.predict(x)
+    names = set(keras_profile.layers) | set(plan_profile.layers)
+    return sorted(name for name in names if name not in keras_profile.layers or name not in plan_profile.layers or
+                  not np.array_equal(keras_profile.layers[name][PROFILE_ACTIVATIONS:],
+                                     plan_profile.layers[name][PROFILE_ACTIVATIONS:]))
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtypes", default="alexnet,resnet")
+    parser.add_argument("--flushes", default="0,113,120")
+    parser.add_argument("--n", type=int, default=4, help="test images to run")
+    parser.add_argument("--batch-sizes", default="4,1", help="plan batch sizes checked (1 runs the latency kernels)")
+    parser.add_argument("--profiles", action="store_true", help="also compare the keras and plan exponent profiles")
+    args = parser.parse_args()
+
+    import cifar10cache
+    from cifar10models import build_model
+    x = np.asarray(cifar10cache.normalized("test")[:args.n])
+    ok = True
+    for modtype in args.modtypes.split(","):
+        for flush in [int(f) for f in args.flushes.split(",")]:
+            model = build_model(modtype, load=True, flush=flush)
+            for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+                keras_flushes, plan_flushes = count_check(model.model, x, batch_size)
+                ok &= keras_flushes == plan_flushes
+                print("%-8s flush %3d  batch %3d  keras %12d  plan %12d  %s"
+                      % (modtype, flush, batch_size, keras_flushes, plan_flushes,
+                         "ok" if keras_flushes == plan_flushes else "MISMATCH"), flush=True)
+                if args.profiles:
+                    differing = profile_check(model.model, x, batch_size)
+                    ok &= not differing
+                    print("%-8s flush %3d  batch %3d  profiles %s" % (modtype, flush, batch_size,
+                          "ok" if not differing else "MISMATCH in " + ", ".join(differing)), flush=True)
+    sys.exit(0 if ok else 1)
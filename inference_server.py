@@ -0,0 +1,299 @@
+import io
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+import numpy as np
+from cifar10models import MODELS
+
+
+# Long-running inference server for flushed-model predictions. Models are loaded once per (architecture, flush level)
+# and traced into inference plans with pre-flushed weights. Concurrent requests for the same model are coalesced into
+# batches of up to max_batch samples, waiting at most max_wait seconds for more requests once the first one is
+# queued. Batches run one at a time (the kernels use all cores), so every response carries the exact flush count of
+# the batch it was computed in.
+#
+# POST /predict?model=resnet&flush=113  body: .npy of raw images (n, 32, 32, 3), response: .npy of (n, 10) logits,
+#                                       headers X-Flushes, X-Batch-Size
+# GET /metrics                          json with request, batch, queueing and throughput statistics
+
+WINDOW = 1000  # latency samples kept for percentiles
+EXECUTORS = 4  # plan executors (arenas) kept per model, for the most recently used batch sizes
+INPUT_SHAPE = (32, 32, 3)
+
+
+def check_input(x):
+    # requests are validated before they are queued, a malformed one would fail the whole batch it is coalesced into
+    x = np.asarray(x)
+    if x.ndim != 4 or x.shape[1:] != INPUT_SHAPE or len(x) == 0:
+        raise ValueError("expected images of shape (n, %d, %d, %d) with n > 0, got %s" % (INPUT_SHAPE + (x.shape,)))
+    if not (np.issubdtype(x.dtype, np.number) or x.dtype == bool):
+        raise ValueError("expected numeric images, got dtype %s" % x.dtype)
+    return x
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.samples = 0
+        self.batches = 0
+        self.queued = 0
+        self.queue_wait = []
+        self.compute = []
+        self.batch_sizes = []
+
+    def enqueue(self):
+        with self.lock:
+            self.queued += 1
+
+    def batch(self, waits, size, compute):
+        with self.lock:
+            self.queued -= len(waits)
+            self.requests += len(waits)
+            self.samples += size
+            self.batches += 1
+            self.queue_wait = (self.queue_wait + waits)[-WINDOW:]
+            self.compute = (self.compute + [compute])[-WINDOW:]
+            self.batch_sizes = (self.batch_sizes + [size])[-WINDOW:]
+
+    def snapshot(self):
+        def pct(values, q):
+            return float(np.percentile(values, q)) if values else None
+
+        with self.lock:
+            uptime = time.perf_counter() - self.start
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "samples": self.samples,
+                "batches": self.batches,
+                "queued_requests": self.queued,
+                "throughput_samples_per_s": self.samples / uptime if uptime > 0 else 0.0,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                "queue_wait_p50_s": pct(self.queue_wait, 50),
+                "queue_wait_p99_s": pct(self.queue_wait, 99),
+                "batch_compute_p50_s": pct(self.compute, 50),
+                "batch_compute_p99_s": pct(self.compute, 99),
+            }
+
+
+class _Request:
+
+    def __init__(self, x):
+        self.x = x
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.flushes = None
+        self.batch_size = None
+        self.error = None
+
+
+class ModelServer:
+    # one loaded model and its batching queue
+
+    def __init__(self, modtype, flush, max_batch, max_wait, compute_lock, metrics):
+        from cifar10models import build_model
+        from inference_plan import trace_model
+        model = build_model(modtype, load=True, flush=flush)
+        self.normalize = model.normalize_production
+        self.plan = trace_model(model.model)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.compute_lock = compute_lock
+        self.metrics = metrics
+        self.executors = OrderedDict()  # batch size -> PlanExecutor, each with its own arena, least recently used first
+        self.pending = []
+        self.cond = threading.Condition()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, x):
+        req = _Request(check_input(x))
+        self.metrics.enqueue()
+        with self.cond:
+            self.pending.append(req)
+            self.cond.notify()
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result, req.flushes, req.batch_size
+
+    def _take_batch(self):
+        # first pending request plus whatever arrives within max_wait, up to max_batch samples
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = self.pending[0].queued + self.max_wait
+            while sum(len(r.x) for r in self.pending) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = []
+            size = 0
+            while self.pending and (not batch or size + len(self.pending[0].x) <= self.max_batch):
+                size += len(self.pending[0].x)
+                batch.append(self.pending.pop(0))
+            return batch
+
+    def _executor(self, n):
+        # padding to a few batch sizes would change the flush counts, so executors are per size and only the
+        # EXECUTORS most recently used ones are kept
+        from inference_plan import PlanExecutor
+        if n in self.executors:
+            self.executors.move_to_end(n)
+        else:
+            self.executors[n] = PlanExecutor(self.plan, n)
+            while len(self.executors) > EXECUTORS:
+                self.executors.popitem(last=False)
+        return self.executors[n]
+
+    def _loop(self):
+        from fastconv.backends import flush_scope
+        while True:
+            batch = self._take_batch()
+            start = time.perf_counter()
+            try:
+                x = self.normalize(np.concatenate([r.x for r in batch]).astype("float32"))
+                with self.compute_lock, flush_scope() as counter:
+                    started = time.perf_counter()
+                    # a request larger than max_batch is computed in max_batch slices
+                    logits = np.concatenate([self._executor(len(x[i:i + self.max_batch])).run(x[i:i + self.max_batch])
+                                             for i in range(0, len(x), self.max_batch)])
+                    flushes = counter.get()
+                    compute = time.perf_counter() - started
+                offset = 0
+                for r in batch:
+                    r.result = logits[offset:offset + len(r.x)]
+                    r.flushes = flushes
+                    r.batch_size = len(x)
+                    offset += len(r.x)
+            except Exception as e:
+                compute = time.perf_counter() - start
+                for r in batch:
+                    r.error = e
+            self.metrics.batch([start - r.queued for r in batch], sum(len(r.x) for r in batch), compute)
+            for r in batch:
+                r.done.set()
+
+
+class InferenceServer:
+
+    def __init__(self, max_batch=50, max_wait=0.01):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = Metrics()
+        self.models = {}  # (modtype, flush) -> Future of the ModelServer
+        self.lock = threading.Lock()
+        self.compute_lock = threading.Lock()
+
+    def model(self, modtype, flush):
+        # the first request for a model builds it outside the lock, later ones for the same model wait for it
+        if modtype not in MODELS:
+            raise ValueError("unknown model %s" % modtype)
+        key = (modtype, int(flush))
+        with self.lock:
+            future = self.models.get(key)
+            build = future is None
+            if build:
+                future = self.models[key] = Future()
+        if build:
+            try:
+                future.set_result(ModelServer(modtype, int(flush), self.max_batch, self.max_wait, self.compute_lock,
+                                              self.metrics))
+            except BaseException as e:
+                with self.lock:
+                    del self.models[key]  # let a later request retry
+                future.set_exception(e)
+        return future.result()
+
+    def loaded(self):
+        with self.lock:
+            return [k for k, f in self.models.items() if f.done() and f.exception() is None]
+
+    def predict(self, x, modtype, flush):
+        # (logits, flush count of the batch, batch size)
+        x = check_input(x)
+        return self.model(modtype, flush).submit(x)
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _send(self, code, body, content_type, headers=()):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in headers:
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if urlparse(self.path).path != "/metrics":
+                    return self._send(404, b"not found\n", "text/plain")
+                body = json.dumps(dict(server.metrics.snapshot(), models=["%s:%d" % k for k in server.loaded()]))
+                self._send(200, body.encode(), "application/json")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != "/predict":
+                    return self._send(404, b"not found\n", "text/plain")
+                query = parse_qs(url.query)
+                try:
+                    x = np.load(io.BytesIO(self.rfile.read(int(self.headers["Content-Length"]))), allow_pickle=False)
+                    logits, flushes, batch_size = server.predict(x, query.get("model", ["resnet"])[0],
+                                                                 int(query.get("flush", ["0"])[0]))
+                except Exception as e:
+                    return self._send(400, ("%s\n" % e).encode(), "text/plain")
+                out = io.BytesIO()
+                np.save(out, logits)
+                self._send(200, out.getvalue(), "application/octet-stream",
+                           [("X-Flushes", str(flushes)), ("X-Batch-Size", str(batch_size))])
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=8000):
+        httpd = ThreadingHTTPServer((host, port), self.handler())
+        httpd.daemon_threads = True
+        return httpd
+
+
+def predict(url, x, modtype="resnet", flush=0):
+    # client: (logits, flush count of the server batch, server batch size)
+    body = io.BytesIO()
+    np.save(body, np.asarray(x))
+    req = Request("%s/predict?model=%s&flush=%d" % (url.rstrip("/"), modtype, flush), data=body.getvalue(),
+                  headers={"Content-Type": "application/octet-stream"})
+    with urlopen(req) as resp:
+        return np.load(io.BytesIO(resp.read())), int(resp.headers["X-Flushes"]), int(resp.headers["X-Batch-Size"])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch", type=int, default=50)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--preload", default="", help="models to load at startup, e.g. resnet:0,resnet:113")
+    args = parser.parse_args()
+
+    server = InferenceServer(args.max_batch, args.max_wait_ms / 1000)
+    for item in filter(None, args.preload.split(",")):
+        modtype, flush = item.split(":")
+        server.model(modtype, int(flush))
+    httpd = server.serve(args.host, args.port)
+    print("serving on http://%s:%d" % httpd.server_address)
+    httpd.serve_forever()
@@ -0,0 +1,66 @@
+import time
+import argparse
+import numpy as np
+from fastconv import backends
+from fastconv.backends import flush_scope
+from cifar10models import MODELS
+
+
+# Single-image latency: CIFAR test images are predicted one at a time, as requests to a serving process would be,
+# and the distribution of the per-image latency is reported for each model. "plan" is an inference plan executor for
+# batch size 1, which runs the latency kernels gemv/direct_conv with its per-layer state prepared up front. With
+# --compare, the same executor with the batch kernels tiled_matmul/kn2row and the keras model (also on the latency
+# kernels) are timed as well. All modes count the same flushes, the counts are printed to check.
+
+MODES = ("plan", "plan-batch-kernels", "keras")
+
+
+def latencies(predict, x):
+    # seconds per image
+    times = np.empty(len(x))
+    for i in range(len(x)):
+        start = time.perf_counter()
+        predict(x[i:i + 1])
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def measure(model, mode, x, warmup=3):
+    # (seconds per image, flushes of the timed images)
+    from inference_plan import PlanExecutor, trace_model
+    small = backends.SMALL_BATCH
+    if mode == "plan-batch-kernels":
+        backends.SMALL_BATCH = 0
+    try:
+        if mode == "keras":
+            predict = model.model.predict_on_batch
+        else:
+            predict = PlanExecutor(trace_model(model.model), 1).run
+        for i in range(min(warmup, len(x))):
+            predict(x[i:i + 1])
+        with flush_scope() as counter:
+            times = latencies(predict, x)
+    finally:
+        backends.SMALL_BATCH = small
+    return times, counter.get()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtypes", default=",".join(MODELS))
+    parser.add_argument("--flush", type=int, default=0)
+    parser.add_argument("--n", type=int, default=100, help="images timed per model and mode")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--compare", action="store_true", help="also time the batch kernels and the keras model")
+    args = parser.parse_args()
+
+    import cifar10cache
+    from cifar10models import build_model
+    x = np.asarray(cifar10cache.normalized("test")[:args.n])
+    for modtype in args.modtypes.split(","):
+        model = build_model(modtype, load=True, flush=args.flush)
+        for mode in MODES if args.compare else MODES[:1]:
+            times, flushes = measure(model, mode, x, args.warmup)
+            print("%-8s %-18s p50 %8.2f ms  p99 %8.2f ms  mean %8.2f ms  flushes %d"
+                  % (modtype, mode, 1e3 * np.percentile(times, 50), 1e3 * np.percentile(times, 99),
+                     1e3 * times.mean(), flushes), flush=True)
@@ -0,0 +1,70 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+import numpy as np
+from fastconv.backends import backend, PROFILE_WEIGHTS
+from exponent_profiler import layer_profile, weight_profile
+from flush_levels import input_flush
+
+
+class MyBatchNormalization(layers.BatchNormalization):
+
+    def __init__(
+            self,
+            axis=-1,
+            momentum=0.99,
+            epsilon=1e-3,
+            center=True,
+            scale=True,
+            beta_initializer="zeros",
+            gamma_initializer="ones",
+            moving_mean_initializer="zeros",
+            moving_variance_initializer="ones",
+            beta_regularizer=None,
+            gamma_regularizer=None,
+            beta_constraint=None,
+            gamma_constraint=None,
+            use_original=False,
+            denorm_flush_zero=0,
+            **kwargs
+    ):
+        super().__init__(
+            axis=axis,
+            momentum=momentum,
+            epsilon=epsilon,
+            center=center,
+            scale=scale,
+            beta_initializer=beta_initializer,
+            gamma_initializer=gamma_initializer,
+            moving_mean_initializer=moving_mean_initializer,
+            moving_variance_initializer=moving_variance_initializer,
+            beta_regularizer=beta_regularizer,
+            gamma_regularizer=gamma_regularizer,
+            beta_constraint=beta_constraint,
+            gamma_constraint=gamma_constraint,
+            **kwargs
+        )
+
+        self.orig = use_original
+        self.flush = denorm_flush_zero
+
+    def call(self, inputs, training=None, mask=None):
+        if self.orig or training or tf.is_symbolic_tensor(inputs) or self.axis not in (-1, len(inputs.shape) - 1):
+            return super().call(inputs, training=training, mask=mask)
+
+        # same folding as the keras inference path: x * (gamma / sqrt(var + eps)) + (beta - mean * gamma / sqrt(...))
+        inv = 1 / np.sqrt(self.moving_variance.numpy() + np.float32(self.epsilon))
+        if self.scale:
+            inv = inv * self.gamma.numpy()
+        offset = -self.moving_mean.numpy() * inv
+        if self.center:
+            offset = offset + self.beta.numpy()
+
+        be = backend()
+        prof = layer_profile(self.name)
+        wprof = weight_profile(self.name)
+        _i = be.fz_arr(np.asarray(inputs, dtype="float32"), input_flush(self, training=training), profile=prof)
+        _s = be.fz_arr(inv.astype("float32"), self.flush, profile=wprof, kind=PROFILE_WEIGHTS)
+        _o = be.fz_arr(offset.astype("float32"), self.flush, profile=wprof, kind=PROFILE_WEIGHTS)
+
+        return be.channel_affine(_i, _s, _o, flush=self.flush, profile=prof)
+
@@ -1,7 +1,9 @@
 import tensorflow as tf
 from tensorflow.keras import layers
 import numpy as np
-from fastconv.fastconv import kn2row, fz_arr
+from fastconv.backends import backend, small_batch, PROFILE_WEIGHTS, PROFILE_ACCUMULATORS
+from exponent_profiler import layer_profile, weight_profile
+from flush_levels import input_flush
 
 
 class MyConv2D(layers.Conv2D):
@@ -46,7 +48,7 @@ class MyConv2D(layers.Conv2D):
         self.orig = use_original
         self.flush = denorm_flush_zero
 
-    def convolution_op(self, inputs, kernel):
+    def convolution_op(self, inputs, kernel, training=None):
         if self.orig or tf.is_symbolic_tensor(inputs):
             return super().convolution_op(inputs, kernel)
 
@@ -55,30 +57,39 @@ class MyConv2D(layers.Conv2D):
         else:
             inputs = inputs.numpy()
 
-        _i = fz_arr(inputs, self.flush)
-        _k = fz_arr(kernel.numpy(), self.flush)
+        be = backend()
+        prof = layer_profile(self.name)
+        _i = be.fz_arr(inputs, input_flush(self, training=training), profile=prof)
+        _k = be.fz_arr(kernel.numpy(), self.flush, profile=weight_profile(self.name), kind=PROFILE_WEIGHTS)
 
-        output = kn2row(_i, _k, self.padding, self.strides, flush=self.flush)
+        if small_batch(len(_i)):
+            output = be.direct_conv(_i, _k, self.padding, self.strides, flush=self.flush, profile=prof)
+        else:
+            output = be.kn2row(_i, _k, self.padding, self.strides, flush=self.flush, profile=prof)
 
         if self.data_format != "channels_last":
             return output.transpose((0, 3, 1, 2))
         else:
             return output
 
-    def call(self, inputs):
+    def call(self, inputs, training=None):
         if self.orig or tf.is_symbolic_tensor(inputs):
             return super().call(inputs)
         outputs = self.convolution_op(
             inputs,
             self.kernel,
+            training=training,
         )
         if self.use_bias:
             if self.data_format == "channels_last":
                 bias_shape = (1,) * (self.rank + 1) + (self.filters,)
             else:
                 bias_shape = (1, self.filters) + (1,) * self.rank
-            bias = fz_arr(tf.reshape(self.bias, bias_shape).numpy(), self.flush)
-            outputs = fz_arr(outputs + bias, self.flush)
+            be = backend()
+            bias = be.fz_arr(tf.reshape(self.bias, bias_shape).numpy(), self.flush,
+                             profile=weight_profile(self.name, "bias"), kind=PROFILE_WEIGHTS)
+            outputs = be.fz_arr(outputs + bias, self.flush, profile=layer_profile(self.name),
+                                kind=PROFILE_ACCUMULATORS)
 
         if self.activation is not None:
             return self.activation(outputs)
@@ -1,7 +1,9 @@
 import tensorflow as tf
 from tensorflow.keras import layers
 import numpy as np
-from fastconv.fastconv import tiled_matmul, fz_arr
+from fastconv.backends import backend, small_batch, PROFILE_WEIGHTS, PROFILE_ACCUMULATORS
+from exponent_profiler import layer_profile, weight_profile
+from flush_levels import input_flush
 
 
 class MyDense(layers.Dense):
@@ -38,17 +40,24 @@ class MyDense(layers.Dense):
         self.orig = use_original
         self.flush = denorm_flush_zero
 
-    def call(self, inputs):
+    def call(self, inputs, training=None):
         if self.orig or tf.is_symbolic_tensor(inputs):
             return super().call(inputs)
 
-        i = fz_arr(inputs.numpy(), self.flush)
-        k = fz_arr(self.kernel.numpy(), self.flush)
+        be = backend()
+        prof = layer_profile(self.name)
+        i = be.fz_arr(inputs.numpy(), input_flush(self, training=training), profile=prof)
+        k = be.fz_arr(self.kernel.numpy(), self.flush, profile=weight_profile(self.name), kind=PROFILE_WEIGHTS)
 
-        outputs = tiled_matmul(i, k, flush=self.flush)
+        if small_batch(len(i)):
+            outputs = be.gemv(i, k, flush=self.flush, profile=prof)
+        else:
+            outputs = be.tiled_matmul(i, k, flush=self.flush, profile=prof)
 
         if self.use_bias:
-            outputs = fz_arr(outputs + fz_arr(self.bias.numpy(), self.flush), self.flush)
+            bias = be.fz_arr(self.bias.numpy(), self.flush, profile=weight_profile(self.name, "bias"),
+                             kind=PROFILE_WEIGHTS)
+            outputs = be.fz_arr(outputs + bias, self.flush, profile=prof, kind=PROFILE_ACCUMULATORS)
 
         if self.activation is not None:
             outputs = self.activation(outputs)
@@ -0,0 +1,89 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+import numpy as np
+from fastconv.backends import backend
+from exponent_profiler import layer_profile
+from flush_levels import input_flush
+
+
+class MyMaxPooling2D(layers.MaxPooling2D):
+
+    def __init__(
+            self,
+            pool_size=(2, 2),
+            strides=None,
+            padding="valid",
+            data_format=None,
+            use_original=False,
+            denorm_flush_zero=0,
+            **kwargs
+    ):
+        super().__init__(
+            pool_size=pool_size,
+            strides=strides,
+            padding=padding,
+            data_format=data_format,
+            **kwargs
+        )
+
+        self.orig = use_original
+        self.flush = denorm_flush_zero
+
+    def call(self, inputs, training=None):
+        if self.orig or tf.is_symbolic_tensor(inputs):
+            return super().call(inputs)
+
+        inputs = np.asarray(inputs, dtype="float32")
+        if self.data_format != "channels_last":
+            inputs = inputs.transpose((0, 2, 3, 1))
+
+        be = backend()
+        _i = be.fz_arr(inputs, input_flush(self, training=training), profile=layer_profile(self.name))
+        output = be.max_pool(_i, self.pool_size, self.strides, self.padding)
+
+        if self.data_format != "channels_last":
+            return output.transpose((0, 3, 1, 2))
+        else:
+            return output
+
+
+class MyAveragePooling2D(layers.AveragePooling2D):
+
+    def __init__(
+            self,
+            pool_size=(2, 2),
+            strides=None,
+            padding="valid",
+            data_format=None,
+            use_original=False,
+            denorm_flush_zero=0,
+            **kwargs
+    ):
+        super().__init__(
+            pool_size=pool_size,
+            strides=strides,
+            padding=padding,
+            data_format=data_format,
+            **kwargs
+        )
+
+        self.orig = use_original
+        self.flush = denorm_flush_zero
+
+    def call(self, inputs, training=None):
+        if self.orig or tf.is_symbolic_tensor(inputs):
+            return super().call(inputs)
+
+        inputs = np.asarray(inputs, dtype="float32")
+        if self.data_format != "channels_last":
+            inputs = inputs.transpose((0, 2, 3, 1))
+
+        be = backend()
+        prof = layer_profile(self.name)
+        output = be.avg_pool(be.fz_arr(inputs, input_flush(self, training=training), profile=prof), self.pool_size,
+                             self.strides, self.padding, flush=self.flush, profile=prof)
+
+        if self.data_format != "channels_last":
+            return output.transpose((0, 3, 1, 2))
+        else:
+            return output
@@ -0,0 +1,36 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+import numpy as np
+from fastconv.backends import backend, PROFILE_WEIGHTS
+from exponent_profiler import layer_profile, weight_profile
+from flush_levels import input_flush
+
+
+class MyRescaling(layers.Rescaling):
+
+    def __init__(self, scale, offset=0.0, use_original=False, denorm_flush_zero=0, **kwargs):
+        super().__init__(scale, offset=offset, **kwargs)
+
+        self.orig = use_original
+        self.flush = denorm_flush_zero
+
+    def call(self, inputs, training=None):
+        if self.orig or tf.is_symbolic_tensor(inputs):
+            return super().call(inputs)
+
+        inputs = np.asarray(inputs, dtype="float32")
+        c = inputs.shape[-1]
+        try:
+            scale = np.broadcast_to(np.asarray(self.scale, dtype="float32"), (c,))
+            offset = np.broadcast_to(np.asarray(self.offset, dtype="float32"), (c,))
+        except ValueError:
+            return super().call(inputs)  # not a per-channel scale, not emulated
+
+        be = backend()
+        prof = layer_profile(self.name)
+        wprof = weight_profile(self.name)
+        _i = be.fz_arr(inputs, input_flush(self, training=training), profile=prof)
+        _s = be.fz_arr(np.ascontiguousarray(scale), self.flush, profile=wprof, kind=PROFILE_WEIGHTS)
+        _o = be.fz_arr(np.ascontiguousarray(offset), self.flush, profile=wprof, kind=PROFILE_WEIGHTS)
+
+        return be.channel_affine(_i, _s, _o, flush=self.flush, profile=prof)
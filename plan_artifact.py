@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import struct
+import argparse
+import numpy as np
+from inference_plan import Op, InferencePlan, PlanExecutor
+
+
+# Compiled flushed-model artifacts: an inference plan (op list, value shapes and aliases) with its pre-flushed,
+# pre-packed constants in one file. Layout: MAGIC, little-endian uint64 header length, json header, then the raw
+# float32 arrays, each starting at a multiple of ALIGN bytes. load_plan maps the file read-only and hands views of it
+# to the ops, so a worker can run a flushed model through the fastconv kernels without tensorflow, keras or the
+# weight files, and processes loading the same artifact share its pages.
+
+MAGIC = b"NNDPLAN1"
+VERSION = 1
+ALIGN = 64
+
+
+def _plain(v):
+    # json-compatible copy of an op parameter
+    if isinstance(v, (tuple, list)):
+        return [_plain(x) for x in v]
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.floating):
+        return float(v)
+    return v
+
+
+def _restore(v):
+    return tuple(_restore(x) for x in v) if isinstance(v, list) else v
+
+
+def export_plan(plan, path, meta=None):
+    # meta: optional json-compatible dict stored with the plan (model type, flush level, normalisation)
+    arrays = []
+    ops = []
+    offset = 0
+    for op in plan.ops:
+        entry = {"kind": op.kind, "name": op.name, "inputs": op.inputs, "output": op.output,
+                 "params": {k: _plain(v) for k, v in op.params.items()}, "arrays": {}}
+        for key, a in op.arrays.items():
+            a = np.ascontiguousarray(a, dtype="float32")
+            offset = (offset + ALIGN - 1) // ALIGN * ALIGN
+            entry["arrays"][key] = {"offset": offset, "shape": list(a.shape)}
+            arrays.append((offset, a))
+            offset += a.nbytes
+        ops.append(entry)
+    header = json.dumps({
+        "version": VERSION,
+        "meta": meta or {},
+        "input_name": plan.input_name,
+        "output_name": plan.output_name,
+        "shapes": {k: _plain(v) for k, v in plan.shapes.items()},
+        "aliases": plan.aliases,
+        "ops": ops,
+    }).encode()
+    data_start = (len(MAGIC) + 8 + len(header) + ALIGN - 1) // ALIGN * ALIGN
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for a_offset, a in arrays:
+            f.seek(data_start + a_offset)
+            f.write(a.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def load_plan(path):
+    # (InferencePlan with read-only arrays mapped from the file, meta)
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a plan artifact")
+        length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length))
+    if header["version"] != VERSION:
+        raise ValueError("%s has artifact version %d, expected %d" % (path, header["version"], VERSION))
+    data_start = (len(MAGIC) + 8 + length + ALIGN - 1) // ALIGN * ALIGN
+    data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) > data_start else None
+    ops = []
+    for entry in header["ops"]:
+        arrays = {key: np.ndarray(tuple(a["shape"]), dtype=np.float32, buffer=data, offset=data_start + a["offset"])
+                  for key, a in entry["arrays"].items()}
+        ops.append(Op(entry["kind"], entry["name"], entry["inputs"], entry["output"],
+                      {k: _restore(v) for k, v in entry["params"].items()}, arrays))
+    shapes = {k: tuple(v) for k, v in header["shapes"].items()}
+    return InferencePlan(ops, shapes, header["aliases"], header["input_name"], header["output_name"]), header["meta"]
+
+
+def export_model(modtype, flush, path, orig=False):
+    # builds the keras model once and writes its plan
+    from cifar10models import build_model
+    from inference_plan import trace_model
+    import cifar10cache
+    model = build_model(modtype, load=True, orig=orig, flush=flush)
+    meta = {"modtype": modtype, "flush": flush, "orig": orig,
+            "normalize": [cifar10cache.PRODUCTION_MEAN, cifar10cache.PRODUCTION_STD]}
+    export_plan(trace_model(model.model), path, meta)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("--modtype", default="resnet")
+    p.add_argument("--flush", type=int, default=0)
+    p.add_argument("--orig", action="store_true")
+    p.add_argument("-o", "--output")
+    p = sub.add_parser("info", help="load an artifact and report its cold start time")
+    p.add_argument("path")
+    p.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.cmd == "export":
+        path = args.output or "%s-%d.plan" % (args.modtype, args.flush)
+        export_model(args.modtype, args.flush, path, args.orig)
+        print("wrote", path, os.path.getsize(path), "bytes")
+    else:
+        start = time.perf_counter()
+        plan, meta = load_plan(args.path)
+        loaded = time.perf_counter()
+        PlanExecutor(plan, args.batch_size)
+        ready = time.perf_counter()
+        print(meta)
+        print(len(plan.ops), "ops, load %.3f s, executor for batch %d %.3f s" % (loaded - start, args.batch_size,
+                                                                               ready - loaded))
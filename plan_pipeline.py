@@ -0,0 +1,134 @@
+import threading
+import contextvars
+import queue
+import numpy as np
+from fastconv.backends import set_num_threads, get_max_threads
+from inference_plan import PlanExecutor
+
+
+# Layer-pipelined execution of an inference plan: the op list is cut into stages of similar cost, each run by its own
+# python thread with its own OpenMP team, so batch b+1's early layers overlap with batch b's later layers and the
+# numpy glue of one stage overlaps with the parallel kernels of another. A loader thread normalises the next inputs
+# meanwhile. Every batch owns one of `depth` slots holding all values passed between stages until its output has been
+# copied out, so each batch is computed exactly as by a sequential PlanExecutor.
+
+
+def op_cost(plan, op, batch_size):
+    # rough number of multiply-adds, used to balance the stages
+    out = batch_size * int(np.prod(plan.shapes[op.output]))
+    if op.kind == "conv":
+        h, w, c = plan.shapes[op.inputs[0]]
+        p = op.params
+        return p["kh"] * p["kw"] * p["filters"] * batch_size * (h + p["kh"] - 1) * (w + p["kw"] - 1) * (c + 1)
+    if op.kind == "dense":
+        return out * int(np.prod(plan.shapes[op.inputs[0]]))
+    return out
+
+
+def split_stages(plan, stages, batch_size=1):
+    # contiguous op ranges [(first, last), ...] with roughly equal cost
+    costs = np.cumsum([op_cost(plan, op, batch_size) for op in plan.ops])
+    cuts = [0]
+    for k in range(1, stages):
+        cut = int(np.searchsorted(costs, costs[-1] * k / stages)) + 1
+        cut = min(max(cut, cuts[-1] + 1), len(plan.ops) - (stages - k))
+        cuts.append(cut)
+    cuts.append(len(plan.ops))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+class PipelinedExecutor:
+
+    def __init__(self, plan, batch_size, stages=2, threads_per_stage=None, depth=None, normalize=None):
+        # normalize: optional function applied to each input batch by the loader thread
+        self.plan = plan
+        self.batch_size = batch_size
+        self.ranges = split_stages(plan, stages, batch_size)
+        self.threads_per_stage = threads_per_stage if threads_per_stage is not None \
+            else max(1, get_max_threads() // len(self.ranges))
+        self.depth = depth if depth is not None else len(self.ranges) + 1
+        self.normalize = normalize
+
+        # values crossing stage boundaries get one buffer per slot
+        crossing = [plan.storage(plan.input_name), plan.storage(plan.output_name)]
+        for first, last in self.ranges:
+            inputs, outputs = plan.boundary(first, last)
+            crossing += [name for name in inputs + outputs if name not in crossing]
+        self.slots = [{name: np.empty((batch_size,) + tuple(plan.shapes[name]), dtype="float32") for name in crossing}
+                      for _ in range(self.depth)]
+
+        # one arena per stage, shared by that stage's executors of all slots
+        self.stages = []
+        for first, last in self.ranges:
+            arena = None
+            executors = []
+            for slot in self.slots:
+                ex = PlanExecutor(plan, batch_size, first, last, external=slot, arena=arena)
+                arena = ex.arena
+                executors.append(ex)
+            self.stages.append(executors)
+
+    def predict(self, x):
+        n = len(x)
+        plan = self.plan
+        result = np.empty((n,) + tuple(plan.shapes[plan.output_name]), dtype="float32")
+        full = n - n % self.batch_size
+        batches = full // self.batch_size
+        free = queue.Queue()
+        for slot in range(self.depth):
+            free.put(slot)
+        queues = [queue.Queue() for _ in range(len(self.stages) + 1)]
+        errors = []
+        in_name = plan.storage(plan.input_name)
+        out_name = plan.storage(plan.output_name)
+
+        def loader():
+            try:
+                for b in range(batches):
+                    slot = free.get()
+                    if slot is None:
+                        break
+                    xb = x[b * self.batch_size:(b + 1) * self.batch_size]
+                    np.copyto(self.slots[slot][in_name], self.normalize(xb) if self.normalize is not None else xb)
+                    queues[0].put((b, slot))
+            except BaseException as e:
+                errors.append(e)
+            queues[0].put(None)
+
+        def stage(k):
+            set_num_threads(self.threads_per_stage)
+            last = k == len(self.stages) - 1
+            while True:
+                item = queues[k].get()
+                if item is None:
+                    break
+                b, slot = item
+                try:
+                    self.stages[k][slot].execute()
+                    if last:
+                        result[b * self.batch_size:(b + 1) * self.batch_size] = self.slots[slot][out_name]
+                        free.put(slot)
+                    else:
+                        queues[k + 1].put(item)
+                except BaseException as e:
+                    errors.append(e)
+                    free.put(None)  # stop the loader, drain the rest
+                    break
+            queues[k + 1].put(None)
+
+        # stages run in copies of the caller's context, so their flushes count into the caller's flush scopes and
+        # they profile into the caller's exponent profiler
+        threads = [threading.Thread(target=loader)] + \
+                  [threading.Thread(target=contextvars.copy_context().run, args=(stage, k))
+                   for k in range(len(self.stages))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        if full < n:
+            xr = x[full:]
+            result[full:] = PlanExecutor(plan, n - full).run(self.normalize(xr) if self.normalize is not None else xr)
+        return result
@@ -1,21 +1,12 @@
 if __name__ == '__main__':
-    import os.path
-    import keras
-    from keras.datasets import cifar10
-    from cifar10vgg import cifar10vgg
-    from cifar10alexnet import cifar10alexnet
-    from cifar10resnet import cifar10resnet
-    import numpy as np
+    # heavy modules (tensorflow via the model builders, matplotlib) are imported where they are needed, see
+    # startup_bench.py for the resulting startup latency
     import csv
-    import matplotlib.pyplot as plt
-    from fastconv.fastconv import get_flush_count
-
-    (x_train, y_train), (x_test, y_test) = cifar10.load_data()
-
-    x_train = x_train.astype("float32")
-    x_test = x_test.astype("float32")
-    # y_train = keras.utils.to_categorical(y_train, 10)
-    y_test_c = keras.utils.to_categorical(y_test, 10)
+    import numpy as np
+    from cifar10models import MODELS, build_model
+    import cifar10cache
+    from fastconv.backends import get_flush_count, PROFILE_WEIGHTS
+    from exponent_profiler import ExponentProfiler, exponents, ZERO_BIN
 
     MODE_STANDARD = 0
     MODE_ELIM_8 = 1
@@ -25,36 +16,50 @@ if __name__ == '__main__':
     load = True
     orig = False
     flush = MODE_STANDARD
-
-    if modtype == "vgg":
-        model = cifar10vgg(load=load, orig=orig, flush=flush)
-    elif modtype == "alexnet":
-        model = cifar10alexnet(load=load, orig=orig, flush=flush)
-    elif modtype == "resnet":
-        model = cifar10resnet(load=load, orig=orig, flush=flush)
-    else:
+    use_plan = False  # run inference through a compiled static plan instead of keras
+    pipeline_stages = 1  # with use_plan, overlap consecutive batches across this many stage threads
+    shard_workers = 0  # split the test set across this many local worker processes (see sharded_eval.py)
+    weight_histogram = True  # only print and plot the weight exponent histogram, then exit
+    profile_exponents = False  # record per-layer exponent histograms during inference (see exponent_profiler.py)
+    stream_eval = False  # evaluate batch by batch and stop once the accuracy loss against flush 0 is decided
+    accept_margin = 0.005  # with stream_eval, the tolerated accuracy loss (see streaming_eval.py)
+
+    if modtype not in MODELS:
         exit(1)
 
+    # normalised once and shared through the page cache, see cifar10cache.py
+    x_test = cifar10cache.normalized("test")
+    y_test = cifar10cache.labels("test")
+
+    # sharded workers build their own copies
+    model = None
+    if weight_histogram or not load or shard_workers == 0:
+        model = build_model(modtype, load=load, orig=orig, flush=flush)
+
     if not load:
-        model.train(x_train, y_train, x_test, y_test)
+        mean, std = cifar10cache.training_constants()
+        model.train(cifar10cache.normalized("train", mean, std), cifar10cache.labels("train"),
+                    cifar10cache.normalized("test", mean, std), y_test, normalized=True)
+
+    if weight_histogram:
+        import matplotlib.pyplot as plt
 
-    if True:
-        weights = []
-        for l in model.model.layers:
-            if hasattr(l, 'kernel'):
-                weights.append(l.kernel.numpy().reshape((-1)))
-            if hasattr(l, 'bias'):
-                weights.append(l.bias.numpy().reshape((-1)))
-        weight_arr = np.concatenate(weights)
+        profiler = ExponentProfiler()
+        profiler.record_weights(model.model)
+        counts = profiler.total(PROFILE_WEIGHTS)
 
-        log_weights = np.ma.log2(np.abs(weight_arr)).compressed()  #.filled(-50)
-        h = np.histogram(log_weights, np.arange(-54, 10, 4))
+        # floor(log2(|w|)) of a normal float is its unbiased exponent, so the exponent bins regroup exactly
+        exps = exponents()
+        edges = np.arange(-54, 10, 4)
+        h = (np.array([counts[:ZERO_BIN][(exps >= lo) & (exps < hi)].sum() for lo, hi in zip(edges[:-1], edges[1:])]),
+             edges)
 
         hrows = np.vstack([h[1], np.concatenate([h[0], [0]])]).transpose()
 
-        print(np.min(log_weights), np.max(log_weights))
-        print("zeros:", len(weight_arr) - np.count_nonzero(weight_arr))
-        print(np.count_nonzero(log_weights < -14) / len(log_weights))
+        present = exps[counts[:ZERO_BIN] > 0]
+        print(np.min(present), np.max(present))
+        print("zeros:", counts[ZERO_BIN])
+        print(profiler.fraction_below(127 - 14, PROFILE_WEIGHTS))
 
         #with open("weight-hist-" + modtype + ".csv", "w", newline='') as csvfile:
         #    writer = csv.writer(csvfile)
@@ -68,13 +73,44 @@ if __name__ == '__main__':
 
         exit(0)
 
-    predicted_x = model.predict(x_test)
+    if stream_eval:
+        from streaming_eval import stream, batch_predictor
+
+        baseline = np.load("logits-" + modtype + "-0.npy")
+        for step in stream(batch_predictor(model, use_plan), x_test, y_test, baseline=baseline, margin=accept_margin):
+            print(step["seen"], "acc", step["accuracy"], "delta", step["delta"], "interval", step["interval"],
+                  "flushes", step["flushes"])
+        print(step["decision"] or "undecided", "after", step["seen"], "images")
+        exit(0)
+
+    profiler = ExponentProfiler() if profile_exponents else None
+    if profiler is not None:
+        profiler.__enter__()
+
+    flushes = None
+    if shard_workers > 0:
+        from sharded_eval import run_sharded
+        predicted_x, _, flushes = run_sharded(modtype, flush, shard_workers, orig=orig, use_plan=use_plan)
+    elif use_plan and pipeline_stages > 1:
+        from inference_plan import trace_model
+        from plan_pipeline import PipelinedExecutor
+        predicted_x = PipelinedExecutor(trace_model(model.model), 50, stages=pipeline_stages).predict(x_test)
+    elif use_plan:
+        from inference_plan import compile_plan
+        predicted_x = compile_plan(model.model, 50).predict(x_test)
+    else:
+        predicted_x = model.predict(x_test, normalize=False)
     np.save("logits-" + modtype + "-" + str(flush), predicted_x)
 
-    residuals = np.argmax(predicted_x, 1) != np.argmax(y_test_c, 1)
+    if profiler is not None:
+        profiler.__exit__()
+        profiler.to_npz("exponents-" + modtype + "-" + str(flush))
+        profiler.to_csv("exponents-" + modtype + "-" + str(flush) + ".csv")
+
+    residuals = np.argmax(predicted_x, 1) != np.reshape(y_test, -1)
 
     loss = sum(residuals) / len(residuals)
     print("the validation 0/1 loss is: ", loss, " acc ", 1 - loss)
 
-    print("flushes:", get_flush_count(clear=True))
+    print("flushes:", get_flush_count(clear=True) if flushes is None else flushes)
 
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import socket
+import secrets
+import tempfile
+import argparse
+import ipaddress
+import subprocess
+import threading
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from cifar10models import MODELS, build_model
+import cifar10cache
+
+
+# Data-parallel evaluation of the CIFAR-10 test set: a coordinator splits the set into shards and hands them out to
+# worker processes (each with its own OpenMP team and pinned cores) over TCP, workers can run on any host that can
+# reach the coordinator. Shards are aligned to the batch size, so every worker sees exactly the batches a single
+# process would, and the merged logits and flush counts equal those of a single-process run.
+# Coordinator and workers exchange pickles, so anyone holding the shared key (SHARD_AUTHKEY) can run code on either
+# end. The key may only be left unset when the coordinator listens on a loopback address.
+
+ACCEPT_TIMEOUT = 300  # seconds serve waits without any connected worker before giving up
+RESULT_TIMEOUT = 3600  # seconds a worker may take for one shard before it is dropped and the shard handed out again
+STDERR_LINES = 20  # last lines of stderr reported per local worker process that exited early
+
+
+def _loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def authkey(host):
+    key = os.environ.get("SHARD_AUTHKEY")
+    if key is None:
+        if not _loopback(host):
+            raise ValueError("set SHARD_AUTHKEY to serve on or connect to the non-loopback address %r" % host)
+        key = "nn-denorm"
+    return key.encode()
+
+
+def load_test_set():
+    # normalised inputs as a memmap shared by all workers on a host, and labels
+    return cifar10cache.normalized("test"), cifar10cache.labels("test")
+
+
+def make_shards(n, shards, batch_size):
+    # [(start, stop), ...] covering range(n) with all boundaries on multiples of batch_size
+    batches = (n + batch_size - 1) // batch_size
+    edges = [min(n, (batches * k // shards) * batch_size) for k in range(shards + 1)]
+    return [(a, b) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def merge(results, y_test):
+    # results: {start: (logits, flushes)} -> logits in dataset order, accuracy, total flushes
+    logits = np.concatenate([results[start][0] for start in sorted(results)])
+    flushes = sum(results[start][1] for start in sorted(results))
+    acc = np.count_nonzero(np.argmax(logits, 1) == np.reshape(y_test, -1)) / len(logits)
+    return logits, acc, flushes
+
+
+def _exited(procs):
+    # exit code and end of stderr of each local worker process, None while any of them is still running
+    # procs: (Popen, file its stderr goes to) pairs
+    if not procs or any(p.poll() is None for p, _ in procs):
+        return None
+    report = []
+    for p, log in procs:
+        log.seek(0)
+        tail = log.read().decode(errors="replace").splitlines()[-STDERR_LINES:]
+        report.append("exit code %d" % p.returncode + "".join("\n  " + line for line in tail))
+    return report
+
+
+def serve(address, shards, config, y_test=None, on_listen=None, key=None, accept_timeout=ACCEPT_TIMEOUT,
+          result_timeout=RESULT_TIMEOUT, procs=None):
+    # hands out shards to all workers that connect until every shard has a result
+    # raises TimeoutError when no worker is connected for accept_timeout seconds while shards are left
+    # procs: optional list of (Popen, stderr file) pairs of local workers (e.g. filled in by on_listen), RuntimeError
+    # is raised as soon as all of them have exited while no worker is connected and shards are left
+    n = config["n"]
+    todo = list(make_shards(n, shards, config["batch_size"]))
+    total = len(todo)
+    results = {}
+    cond = threading.Condition()
+    done = threading.Event()
+    workers = [0, time.monotonic()]  # connected workers, time the last one left
+
+    def next_task():
+        # shards held by other workers may still come back, so wait for them instead of leaving
+        with cond:
+            while not todo and len(results) < total:
+                cond.wait()
+            return todo.pop(0) if todo else None
+
+    def handle(conn):
+        with cond:
+            workers[0] += 1
+        try:
+            while True:
+                task = next_task()
+                if task is None:
+                    conn.send(None)
+                    return
+                try:
+                    conn.send(dict(config, start=task[0], stop=task[1]))
+                    if not conn.poll(result_timeout):
+                        raise TimeoutError
+                    start, logits, flushes = conn.recv()
+                except (EOFError, OSError):
+                    with cond:
+                        todo.append(task)  # worker died or hangs, give the shard to another one
+                        cond.notify_all()
+                    return
+                with cond:
+                    results[start] = (logits, flushes)
+                    if len(results) == total:
+                        done.set()
+                    cond.notify_all()
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            with cond:
+                workers[0] -= 1
+                workers[1] = time.monotonic()
+
+    with Listener(address, authkey=key if key is not None else authkey(address[0])) as listener:
+        if on_listen is not None:
+            on_listen(listener.address)
+
+        def accept():
+            while not done.is_set():
+                try:
+                    conn = listener.accept()
+                except OSError:
+                    if done.is_set():
+                        return
+                    continue  # failed handshake, e.g. a wrong key
+                threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept, daemon=True).start()
+        while not done.wait(1):
+            with cond:
+                if workers[0] == 0 and time.monotonic() - workers[1] > accept_timeout:
+                    raise TimeoutError("no worker connected for %d s, %d of %d shards done"
+                                       % (accept_timeout, len(results), total))
+                exited = _exited(procs) if workers[0] == 0 else None
+                if exited:
+                    raise RuntimeError("all %d worker processes exited, %d of %d shards done:\n%s"
+                                       % (len(exited), len(results), total, "\n".join(exited)))
+    if y_test is None:
+        y_test = load_test_set()[1]
+    return merge(results, y_test[:n])
+
+
+def worker(address, cores=None):
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+        os.environ.setdefault("OMP_NUM_THREADS", str(len(cores)))  # before fastconv is loaded
+    conn = Client(address, authkey=authkey(address[0]))
+    x_test = None
+    model = None
+    key = None
+    executor, plan_key = None, None
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break  # coordinator is done
+        if task is None:
+            break
+        from fastconv.backends import get_flush_count
+        if x_test is None:
+            x_test = load_test_set()[0]
+        if task.get("artifact"):
+            if key != (task["artifact"], task["batch_size"]):
+                # compiled plan, no keras model needed (see plan_artifact.py)
+                from plan_artifact import load_plan
+                from inference_plan import PlanExecutor
+                key = (task["artifact"], task["batch_size"])
+                model = PlanExecutor(load_plan(task["artifact"])[0], task["batch_size"])
+        elif key != (task["modtype"], task["orig"], task["flush"]):
+            key = (task["modtype"], task["orig"], task["flush"])
+            model = build_model(task["modtype"], orig=task["orig"], flush=task["flush"])
+        if not task.get("artifact") and task["use_plan"] and plan_key != key + (task["batch_size"],):
+            from inference_plan import compile_plan
+            plan_key = key + (task["batch_size"],)
+            executor = compile_plan(model.model, task["batch_size"])
+        x = x_test[task["start"]:task["stop"]]
+        get_flush_count(clear=True)
+        if task.get("artifact"):
+            logits = model.predict(x)
+        elif task["use_plan"]:
+            logits = executor.predict(x)
+        else:
+            logits = model.predict(x, normalize=False, batch_size=task["batch_size"])
+        conn.send((task["start"], np.asarray(logits, dtype="float32"), get_flush_count(clear=True)))
+    conn.close()
+
+
+def split_cores(workers, cores=None):
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else cores
+    per = max(1, len(cores) // workers)
+    return [cores[(i * per) % len(cores):(i * per) % len(cores) + per] for i in range(workers)]
+
+
+def run_sharded(modtype, flush, workers, orig=False, use_plan=False, batch_size=50, shards=None, n=10000,
+                host="127.0.0.1", port=0, artifact=None):
+    # local stand-in for a multi-host run: coordinator in this process, workers as pinned subprocesses
+    # artifact: optional plan artifact file the workers run instead of building the model
+    config = {"modtype": modtype, "flush": flush, "orig": orig, "use_plan": use_plan, "batch_size": batch_size,
+              "n": n, "artifact": artifact}
+    key = os.environ.get("SHARD_AUTHKEY") or secrets.token_hex(16)
+    procs = []
+
+    def spawn(address):
+        for cores in split_cores(workers):
+            env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), SHARD_AUTHKEY=key)
+            log = tempfile.TemporaryFile()  # not a pipe, nobody reads it while the worker runs
+            procs.append((subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "worker", "--connect", "%s:%d" % address,
+                 "--cores", ",".join(map(str, cores))],
+                env=env, cwd=os.path.dirname(os.path.abspath(__file__)), stderr=log), log))
+
+    try:
+        return serve((host, port), shards if shards is not None else workers, config, on_listen=spawn,
+                     key=key.encode(), procs=procs)
+    except BaseException:
+        for p, _ in procs:
+            p.kill()
+        raise
+    finally:
+        for p, log in procs:
+            p.wait()
+            log.close()
+
+
+def _address(s):
+    host, port = s.rsplit(":", 1)
+    return host, int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("serve", help="coordinate workers started separately, possibly on other hosts")
+    p.add_argument("--bind", type=_address, default=("127.0.0.1", 6000),
+                   help="host:port, binding to a non-loopback address requires SHARD_AUTHKEY")
+    p.add_argument("--shards", type=int, default=8)
+    p.add_argument("--modtype", default="resnet", choices=MODELS)
+    p.add_argument("--flush", type=int, default=0)
+    p.add_argument("--orig", action="store_true")
+    p.add_argument("--use-plan", action="store_true")
+    p.add_argument("--batch-size", type=int, default=50)
+    p.add_argument("--n", type=int, default=10000)
+    p.add_argument("--artifact", help="plan artifact to run instead of the keras model")
+    p.add_argument("--accept-timeout", type=float, default=ACCEPT_TIMEOUT)
+    p.add_argument("--result-timeout", type=float, default=RESULT_TIMEOUT)
+    p = sub.add_parser("worker")
+    p.add_argument("--connect", type=_address, required=True)
+    p.add_argument("--cores", type=lambda s: [int(c) for c in s.split(",")])
+    p = sub.add_parser("local", help="coordinator and workers on this host")
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--modtype", default="resnet", choices=MODELS)
+    p.add_argument("--flush", type=int, default=0)
+    p.add_argument("--orig", action="store_true")
+    p.add_argument("--use-plan", action="store_true")
+    p.add_argument("--batch-size", type=int, default=50)
+    p.add_argument("--n", type=int, default=10000)
+    p.add_argument("--artifact", help="plan artifact to run instead of the keras model")
+    args = parser.parse_args()
+
+    if args.cmd == "worker":
+        worker(args.connect, args.cores)
+        exit(0)
+    if args.cmd == "serve":
+        config = {"modtype": args.modtype, "flush": args.flush, "orig": args.orig, "use_plan": args.use_plan,
+                  "batch_size": args.batch_size, "n": args.n, "artifact": args.artifact}
+        logits, acc, flushes = serve(args.bind, args.shards, config, accept_timeout=args.accept_timeout,
+                                     result_timeout=args.result_timeout)
+    else:
+        logits, acc, flushes = run_sharded(args.modtype, args.flush, args.workers, orig=args.orig,
+                                           use_plan=args.use_plan, batch_size=args.batch_size, n=args.n,
+                                           artifact=args.artifact)
+    print("the validation 0/1 loss is: ", 1 - acc, " acc ", acc)
+    print("flushes:", flushes)
@@ -0,0 +1,69 @@
+import sys
+import os
+import json
+import argparse
+import subprocess
+import numpy as np
+from cifar10models import MODELS
+
+
+# Startup latency of a fresh interpreter, split into phases: each phase is timed in a new process (so nothing is
+# already imported or cached in memory) and reported as the median over several runs. The phases are cumulative, a
+# model phase includes the tensorflow/keras imports its module triggers if they were not measured before.
+
+CHILD = """
+import sys, time, json
+times = []
+t = time.perf_counter()
+def lap(name):
+    global t
+    now = time.perf_counter()
+    times.append((name, now - t))
+    t = now
+import numpy
+lap("numpy")
+import fastconv.fastconv
+lap("fastconv")
+import inference_plan, exponent_profiler
+lap("plan+profiler")
+if len(sys.argv) > 1:
+    from cifar10models import model_class
+    import tensorflow
+    lap("tensorflow")
+    import keras
+    lap("keras")
+    cls = model_class(sys.argv[1])
+    lap("model module")
+    cls(load=sys.argv[2] == "1")
+    lap("build+load" if sys.argv[2] == "1" else "build")
+print(json.dumps(times))
+"""
+
+
+def measure(modtype=None, load=True, runs=5):
+    # {phase: [seconds per run]}
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL="3")
+    args = [] if modtype is None else [modtype, "1" if load else "0"]
+    phases = {}
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", CHILD] + args, cwd=cwd, env=env, check=True,
+                             capture_output=True, text=True).stdout
+        for name, dt in json.loads(out.strip().splitlines()[-1]):
+            phases.setdefault(name, []).append(dt)
+    return phases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtype", default="resnet", choices=list(MODELS) + ["none"])
+    parser.add_argument("--no-load", action="store_true", help="do not load the weight file")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    phases = measure(None if args.modtype == "none" else args.modtype, not args.no_load, args.runs)
+    total = 0
+    for name, times in phases.items():
+        total += np.median(times)
+        print("%-14s %8.3f s  (min %.3f, max %.3f)" % (name, np.median(times), np.min(times), np.max(times)))
+    print("%-14s %8.3f s" % ("total", total))
@@ -0,0 +1,93 @@
+import math
+import argparse
+from statistics import NormalDist
+import numpy as np
+from fastconv.backends import get_flush_count
+
+
+# Streaming evaluation with sequential early stopping. The test set is predicted batch by batch, each step reports
+# the batch logits, the running accuracy and flush counts. With a baseline (the predictions of the unflushed model on
+# the same images, e.g. from logits-<modtype>-0.npy), the paired accuracy difference delta = acc - baseline acc gets a
+# confidence interval after every batch. The interval uses the normal approximation with the error probability split
+# evenly over all batches (Bonferroni), so it holds at every step simultaneously and peeking after each batch is
+# allowed. Evaluation stops as soon as the interval lies entirely above -margin (accept: the flush level loses at most
+# margin accuracy) or entirely below it (reject).
+
+
+def batch_predictor(model, use_plan=False, batch_size=50):
+    # function mapping a normalised batch to its logits
+    if use_plan:
+        from inference_plan import compile_plan
+        executor = compile_plan(model.model, batch_size)
+        return executor.predict
+    return lambda x: np.asarray(model.model.predict_on_batch(x))
+
+
+def delta_interval(correct, base_correct, looks, confidence=0.95):
+    # simultaneous confidence interval of mean(correct) - mean(base_correct) valid over `looks` peeks
+    d = np.asarray(correct, dtype=np.float64) - np.asarray(base_correct, dtype=np.float64)
+    n = len(d)
+    mean = d.mean()
+    # one pseudo discordant pair in each direction keeps the variance positive while all predictions agree
+    var = max((np.abs(d).sum() + 2) / (n + 2) - mean ** 2, 0.0)
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / (2 * looks))
+    half = z * math.sqrt(var / n)
+    return mean - half, mean + half
+
+
+def stream(predict, x, y, batch_size=50, baseline=None, margin=0.005, confidence=0.95):
+    # yields one dict per batch, stops early once a baseline comparison is decided
+    # predict: normalised batch -> logits, y: labels, baseline: logits or predicted classes of the unflushed model
+    y = np.reshape(y, -1)
+    n = len(x)
+    looks = (n + batch_size - 1) // batch_size
+    if baseline is not None:
+        baseline = np.asarray(baseline)
+        base_correct = (np.argmax(baseline, 1) if baseline.ndim > 1 else baseline)[:n] == y
+    correct = np.empty(n, dtype=bool)
+    flushes = 0
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        before = get_flush_count()
+        logits = predict(x[start:stop])
+        batch_flushes = get_flush_count() - before
+        flushes += batch_flushes
+        correct[start:stop] = np.argmax(logits, 1) == y[start:stop]
+        step = {"seen": stop, "logits": logits, "accuracy": float(correct[:stop].mean()),
+                "batch_flushes": batch_flushes, "flushes": flushes, "decision": None}
+        if baseline is not None:
+            lo, hi = delta_interval(correct[:stop], base_correct[:stop], looks, confidence)
+            step["baseline_accuracy"] = float(base_correct[:stop].mean())
+            step["delta"] = step["accuracy"] - step["baseline_accuracy"]
+            step["interval"] = (lo, hi)
+            if lo > -margin:
+                step["decision"] = "accept"
+            elif hi < -margin:
+                step["decision"] = "reject"
+        yield step
+        if step["decision"] is not None:
+            return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modtype", default="resnet")
+    parser.add_argument("--flush", type=int, default=113)
+    parser.add_argument("--baseline", help="unflushed logits, default logits-<modtype>-0.npy")
+    parser.add_argument("--margin", type=float, default=0.005, help="tolerated accuracy loss")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--use-plan", action="store_true")
+    args = parser.parse_args()
+
+    import cifar10cache
+    from cifar10models import build_model
+    baseline = np.load(args.baseline or "logits-%s-0.npy" % args.modtype)
+    model = build_model(args.modtype, load=True, flush=args.flush)
+    predict = batch_predictor(model, args.use_plan, args.batch_size)
+    for step in stream(predict, cifar10cache.normalized("test"), cifar10cache.labels("test"), args.batch_size,
+                       baseline, args.margin, args.confidence):
+        print("%5d acc %.4f delta %+.4f [%+.4f, %+.4f] flushes %d" % (step["seen"], step["accuracy"], step["delta"],
+                                                                      step["interval"][0], step["interval"][1],
+                                                                      step["flushes"]))
+    print(step["decision"] or "undecided", "after", step["seen"], "images")